@@ -1,18 +1,67 @@
+import typing as T
+
 from flask import Flask
 
 from config import Config, settings
-from geoapp.db import init
+from geoapp import db, metrics
+from geoapp.commands import ingest_payments_command, init_data, load_data, reload_payments
 from geoapp.DTOs import ValidationError
-from geoapp.handlers import query_blueprint, validation_error_handler
+from geoapp.geometry import LEVELS
+from geoapp.handlers import geometries, metrics_blueprint, query_blueprint, query_service, validation_error_handler
+from geoapp.warmup import CacheWarmer, start_warmer
+
+# Keeps the cache of this process warm once serving starts
+warmer: T.Optional[CacheWarmer] = None
 
 
 def setup(config: Config = settings):
-    init(config)
+    """Connects to the database and migrates it. Data is loaded beforehand, by `flask init-data`"""
+    db.init(config)
+
+
+def create_app(config: Config = settings) -> Flask:
+    """Builds the app, for `flask` commands and WSGI servers: `gunicorn 'app:create_app()'`"""
+    setup(config)
+
+    app = Flask(__name__)
+    app.register_blueprint(query_blueprint, url_prefix='/api')
+    app.register_blueprint(metrics_blueprint)
+    app.register_error_handler(ValidationError, validation_error_handler)
+    metrics.instrument(app)
+    app.cli.add_command(init_data)
+    app.cli.add_command(load_data)
+    app.cli.add_command(ingest_payments_command)
+    app.cli.add_command(reload_payments)
+
+    # Not right away, as commands build the app too
+    app.before_first_request(lambda: warm_up(config))
+
+    return app
+
+
+def warm_up(config: Config = settings, background: bool = True):
+    """Fills the cache of this process from a background thread that keeps it warm, right away without `background`"""
+    global warmer
+
+    if config.test:
+        return
+
+    if warmer is None:
+        warmer = start_warmer(query_service, config.warmup, background)
+    elif background:
+        warmer.start()
+
 
+def before_fork(config: Config = settings):
+    """Builds what worker processes share copy-on-write, then drops the connections they mustn't share"""
+    geometries.ids()
+    for level in range(len(LEVELS)):
+        geometries.simplify(level)
 
-app = Flask(__name__)
+    warm_up(config, background=False)
+    db.database.shutdown()
 
-setup(settings)
 
-app.register_blueprint(query_blueprint, url_prefix='/api')
-app.register_error_handler(ValidationError, validation_error_handler)
+def after_fork(config: Config = settings):
+    """Starts what doesn't survive a fork in a worker process. Its connections are opened on first use"""
+    warm_up(config)
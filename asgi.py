@@ -0,0 +1,5 @@
+from config import settings
+from geoapp.asgi import QueryApp
+
+# Async serving mode, run with an ASGI server: uvicorn asgi:app
+app = QueryApp(settings)
@@ -0,0 +1,302 @@
+"""Throughput and latency percentiles of every query service method and HTTP route, on synthetic data.
+
+Generates payments with `benchmarks.synthetic` (or reuses the ones in `--data`), loads them into a
+scratch database next to the configured one, dropped afterwards, then calls each method over ranges
+of several widths at several concurrency levels:
+
+    python -m benchmarks.suite --rows 10000000 --postal-codes 2000 --concurrency 1 8 32 --output results.json
+
+HTTP routes are measured too against a running app given with `--url`, which has to serve the same data.
+Results are written as JSON, `--baseline` prints how they compare with a previous run.
+"""
+import argparse
+import concurrent.futures
+from datetime import date, datetime, timezone
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import typing as T
+import urllib.request
+
+from dateutil.relativedelta import relativedelta
+
+from benchmarks.synthetic import Generator, Profile
+from config import settings
+from geoapp.db import DataVersion, PooledPostgresDatabase, partition_payments, refresh_rollups
+from geoapp.geometry import GeometryStore
+from geoapp.loader import CsvLoader
+from geoapp.migrations import migrate
+from geoapp.services import PostgresQueryService
+
+METHODS = (
+    'get_map',
+    'get_map_topology',
+    'stream_map',
+    'get_turnover',
+    'get_turnover_by_age_and_gender',
+    'get_turnover_by_time_and_gender',
+    'get_turnover_by_postal_code',
+    'get_dashboard',
+)
+
+ROUTES = (
+    '/api/map',
+    '/api/map?format=topojson',
+    '/api/map?stream=true',
+    '/api/turnover',
+    '/api/turnover/age-gender',
+    '/api/turnover/time-gender',
+    '/api/dashboard',
+)
+
+# Keys results are matched on when comparing runs
+RESULT_KEY = ('target', 'name', 'months', 'concurrency')
+
+
+class Result(T.NamedTuple):
+    target: str
+    name: str
+    months: int
+    concurrency: int
+    calls: int
+    errors: int
+    throughput: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+
+
+def run(name: str, target: str, months: int, concurrency: int, calls: int, call: T.Callable[[], T.Any]) -> Result:
+    """Makes `calls` calls spread over `concurrency` threads, after one to warm up"""
+    call()
+
+    timings: T.List[float] = []
+    errors = 0
+    lock = threading.Lock()
+
+    def timed():
+        nonlocal errors
+
+        started = time.perf_counter()
+        try:
+            call()
+        except Exception:
+            with lock:
+                errors += 1
+            return
+
+        with lock:
+            timings.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(timed) for _ in range(calls)]:
+            future.result()
+    elapsed = time.perf_counter() - started
+
+    return Result(target, name, months, concurrency, calls, errors, calls / elapsed, *percentiles(timings))
+
+
+def percentiles(timings: T.List[float]) -> T.Tuple[float, float, float, float]:
+    """p50, p95, p99 and max of `timings`"""
+    if not timings:
+        return 0.0, 0.0, 0.0, 0.0
+    if len(timings) == 1:
+        return timings[0], timings[0], timings[0], timings[0]
+
+    cuts = statistics.quantiles(timings, n=100, method='inclusive')
+    return cuts[49], cuts[94], cuts[98], max(timings)
+
+
+def ranges(first: date, months: int, widths: T.Iterable[int]) -> T.Iterator[T.Tuple[int, date, date]]:
+    """(width, start, end) of ranges of `widths` months ending with the data, widths over it dropped"""
+    end = first + relativedelta(months=months) - relativedelta(days=1)
+
+    for width in sorted(set(widths)):
+        if width <= months:
+            yield width, first + relativedelta(months=months - width), end
+
+
+def load(db: PooledPostgresDatabase, postal_codes_path: str, payments_path: str, workers: int) -> T.List[dict]:
+    """Loads both files and builds what derives from them, returns how long each step took"""
+    loader = CsvLoader(db, workers=workers)
+    steps = []
+
+    for table, path in (('PostalCodes', postal_codes_path), ('Payments', payments_path)):
+        report = loader.load(table, path)
+        steps.append({'step': f"load_{table.lower()}", 'rows': report.rows, 'seconds': report.seconds})
+
+    for step, execute in (
+            ('partition', lambda: partition_payments(db)),
+            ('rollups', lambda: refresh_rollups(db)),
+            ('analyze', lambda: db.execute_statement("ANALYZE")),
+    ):
+        started = time.perf_counter()
+        execute()
+        steps.append({'step': step, 'rows': None, 'seconds': time.perf_counter() - started})
+
+    return steps
+
+
+def benchmark_service(
+        service: PostgresQueryService,
+        spans: T.List[T.Tuple[int, date, date]],
+        concurrency: T.List[int],
+        calls: int,
+) -> T.Iterator[Result]:
+    for name in METHODS:
+        method = getattr(service, name)
+
+        for width, start, end in spans:
+            # Streamed results are only computed as they're consumed
+            if name == 'stream_map':
+                def call():
+                    return list(method(start, end))
+            else:
+                def call():
+                    return method(start, end)
+
+            for threads in concurrency:
+                result = run(name, 'service', width, threads, calls, call)
+                _log(result)
+                yield result
+
+
+def benchmark_http(
+        url: str,
+        spans: T.List[T.Tuple[int, date, date]],
+        concurrency: T.List[int],
+        calls: int,
+) -> T.Iterator[Result]:
+    for route in ROUTES:
+        for width, start, end in spans:
+            separator = '&' if '?' in route else '?'
+            request_url = f"{url.rstrip('/')}{route}{separator}startDate={start}&endDate={end}"
+
+            def call():
+                with urllib.request.urlopen(request_url) as response:
+                    return response.read()
+
+            for threads in concurrency:
+                result = run(route, 'http', width, threads, calls, call)
+                _log(result)
+                yield result
+
+
+def compare(results: T.List[dict], baseline: T.List[dict]) -> T.Iterator[T.Tuple[dict, T.Optional[dict]]]:
+    """Each result along with the baseline one measuring the same thing, if any"""
+    previous = {tuple(result[key] for key in RESULT_KEY): result for result in baseline}
+
+    for result in results:
+        yield result, previous.get(tuple(result[key] for key in RESULT_KEY))
+
+
+def environment(args: argparse.Namespace, db: PooledPostgresDatabase) -> dict:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'postgres': db.execute_query("SHOW server_version")[0][0],
+        'cpus': os.cpu_count(),
+        'data': os.path.abspath(args.data),
+        'calls': args.calls,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--postal-codes', type=int, default=1000)
+    parser.add_argument('--months', type=int, default=60)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fit', help="Paystats file to fit the distributions of the synthetic data to")
+    parser.add_argument('--data', default='synthetic', help="Directory of the synthetic files, generated if missing")
+    parser.add_argument('--widths', type=int, nargs='+', default=[1, 3, 12, 60], help="Range widths in months")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--calls', type=int, default=50, help="Calls per method, range width and concurrency")
+    parser.add_argument('--load-workers', type=int, default=4)
+    parser.add_argument('--url', help="Base URL of a running app serving the same data, to measure HTTP routes")
+    parser.add_argument('--output', help="JSON file to write results to")
+    parser.add_argument('--baseline', help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    postal_codes_path = os.path.join(args.data, 'postal_codes.csv')
+    payments_path = os.path.join(args.data, 'paystats.csv')
+    if not (os.path.exists(postal_codes_path) and os.path.exists(payments_path)):
+        profile = Profile.from_csv(args.fit) if args.fit else None
+        generator = Generator(args.rows, args.postal_codes, args.months, profile=profile, seed=args.seed)
+        postal_codes_path, payments_path = generator.write(args.data)
+
+    config = settings.db_config.copy(update={
+        'database': f"benchmark_{settings.db_config.database}",
+        'pool_max_size': max([*args.concurrency, args.load_workers, settings.db_config.pool_max_size]),
+    })
+    db = PooledPostgresDatabase(config)
+    db.init(config)
+
+    try:
+        migrate(db)
+        steps = load(db, postal_codes_path, payments_path, args.load_workers)
+
+        first = db.execute_query("SELECT MIN(p_month) FROM Payments")[0][0]
+        months = len(db.execute_query("SELECT DISTINCT p_month FROM Payments"))
+        spans = list(ranges(first, months, args.widths))
+
+        geometries = GeometryStore(db, version=DataVersion(db))
+        service = PostgresQueryService(db, geometries=geometries)
+
+        results = list(benchmark_service(service, spans, args.concurrency, args.calls))
+        if args.url:
+            results.extend(benchmark_http(args.url, spans, args.concurrency, args.calls))
+
+        report = {
+            'environment': environment(args, db),
+            'load': steps,
+            'results': [result._asdict() for result in results],
+        }
+    finally:
+        db.teardown()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+        print(f"{'target':<8} {'name':<32} {'months':>6} {'threads':>7} {'p50 ms':>9} {'was':>9} {'rps':>9} {'was':>9}")
+        for result, previous in compare(report['results'], baseline):
+            was_p50 = f"{previous['p50_ms']:>9.2f}" if previous else f"{'-':>9}"
+            was_rps = f"{previous['throughput']:>9.1f}" if previous else f"{'-':>9}"
+            print(
+                f"{result['target']:<8} {result['name']:<32} {result['months']:>6} {result['concurrency']:>7} "
+                f"{result['p50_ms']:>9.2f} {was_p50} {result['throughput']:>9.1f} {was_rps}"
+            )
+
+
+def _log(result: Result):
+    print(
+        f"{result.target} {result.name} {result.months} months x{result.concurrency}: "
+        f"p50 {result.p50_ms:.1f} ms, p99 {result.p99_ms:.1f} ms, {result.throughput:.1f}/s",
+        file=sys.stderr,
+    )
+
+
+if __name__ == '__main__':
+    main()
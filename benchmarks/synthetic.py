@@ -0,0 +1,184 @@
+"""Synthetic postal codes and payments shaped like the paystats data, at any scale.
+
+Writes `postal_codes.csv` and `paystats.csv` in the format of `data/`, loadable by `flask load-data` or
+the benchmark suite. The same seed always yields the same files:
+
+    python -m benchmarks.synthetic --rows 10000000 --postal-codes 2000 --months 60 --out /tmp/synthetic
+"""
+import argparse
+import csv
+from datetime import date
+import math
+import os
+import random
+import statistics
+import struct
+import typing as T
+
+from dateutil.relativedelta import relativedelta
+
+from geoapp.models import Age, Gender
+
+# Rows drawn at once, random.choices being much faster over a batch than row by row
+BATCH_SIZE = 10000
+# Where the grid of synthetic postal codes starts, next to the real ones around Madrid
+ORIGIN = (-3.9, 40.3)
+CELL_SIZE = 0.01
+# Postal codes go from FIRST_CODE on, they have 5 digits
+FIRST_CODE = 10000
+MAX_POSTAL_CODES = 99999 - FIRST_CODE
+
+
+class Profile(T.NamedTuple):
+    """Distributions payments are drawn from"""
+    age_weights: T.Dict[str, float]
+    gender_weights: T.Dict[str, float]
+    # Parameters of the log-normal distribution of amounts
+    amount_mu: float
+    amount_sigma: float
+    # Exponent of the Zipf-like popularity of postal codes, 0 spreads payments evenly
+    postal_code_skew: float = 0.5
+
+    @classmethod
+    def from_csv(cls, path: str) -> 'Profile':
+        """Fits the distributions to an existing paystats file"""
+        ages, genders, logs = {}, {}, []
+
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                ages[row['p_age']] = ages.get(row['p_age'], 0) + 1
+                genders[row['p_gender']] = genders.get(row['p_gender'], 0) + 1
+                logs.append(math.log(float(row['amount'])))
+
+        return cls(ages, genders, statistics.fmean(logs), statistics.pstdev(logs))
+
+    @classmethod
+    def default(cls) -> 'Profile':
+        """Roughly that of `data/paystats.csv`: even ages and genders, a median amount around 70k"""
+        return cls(
+            age_weights={age.value: 1.0 for age in Age},
+            gender_weights={gender.value: 1.0 for gender in Gender},
+            amount_mu=11.1,
+            amount_sigma=1.0,
+        )
+
+
+class Generator:
+    def __init__(
+            self,
+            rows: int,
+            postal_codes: int,
+            months: int,
+            start: date = date(2015, 1, 1),
+            profile: Profile = None,
+            seed: int = 0,
+            vertices: int = 32,
+    ):
+        if not 0 < postal_codes <= MAX_POSTAL_CODES:
+            raise ValueError(f"Between 1 and {MAX_POSTAL_CODES} postal codes can be generated, got {postal_codes}")
+
+        self.rows = rows
+        self.postal_codes = postal_codes
+        self.months = [start + relativedelta(months=i) for i in range(months)]
+        self.profile = profile or Profile.default()
+        self.seed = seed
+        self.vertices = vertices
+
+    def postal_code_rows(self) -> T.Iterator[T.Tuple[str, str, int]]:
+        """(the_geom, code, id) of each postal code: jagged polygons laid out on a square grid"""
+        rng = random.Random(self.seed)
+        side = math.ceil(math.sqrt(self.postal_codes))
+
+        for i in range(self.postal_codes):
+            x = ORIGIN[0] + (i % side) * CELL_SIZE
+            y = ORIGIN[1] + (i // side) * CELL_SIZE
+            yield _polygon_ewkb(_jagged_ring(rng, x, y, self.vertices)), str(FIRST_CODE + i), i + 1
+
+    def payment_rows(self) -> T.Iterator[T.Tuple[str, str, str, str, int, int]]:
+        """(amount, p_month, p_age, p_gender, postal_code_id, id) of each payment"""
+        rng = random.Random(self.seed + 1)
+        profile = self.profile
+
+        ages, age_weights = zip(*profile.age_weights.items())
+        genders, gender_weights = zip(*profile.gender_weights.items())
+        months = [month.isoformat() for month in self.months]
+        postal_code_ids = list(range(1, self.postal_codes + 1))
+        # Popularity is shuffled, so neighbouring postal codes don't share it
+        postal_code_weights = [1 / (rank ** profile.postal_code_skew) for rank in postal_code_ids]
+        rng.shuffle(postal_code_weights)
+
+        generated = 0
+        while generated < self.rows:
+            size = min(BATCH_SIZE, self.rows - generated)
+
+            batch = zip(
+                rng.choices(months, k=size),
+                rng.choices(ages, age_weights, k=size),
+                rng.choices(genders, gender_weights, k=size),
+                rng.choices(postal_code_ids, postal_code_weights, k=size),
+            )
+            for i, (month, age, gender, postal_code_id) in enumerate(batch, start=generated + 1):
+                amount = rng.lognormvariate(profile.amount_mu, profile.amount_sigma)
+                yield f"{amount:.2f}", month, age, gender, postal_code_id, i
+
+            generated += size
+
+    def write(self, directory: str) -> T.Tuple[str, str]:
+        """Writes both files into `directory`, returns the paths of the postal codes and payments ones"""
+        os.makedirs(directory, exist_ok=True)
+        postal_codes_path = os.path.join(directory, 'postal_codes.csv')
+        payments_path = os.path.join(directory, 'paystats.csv')
+
+        _write_csv(postal_codes_path, ('the_geom', 'code', 'id'), self.postal_code_rows())
+        _write_csv(
+            payments_path, ('amount', 'p_month', 'p_age', 'p_gender', 'postal_code_id', 'id'), self.payment_rows()
+        )
+
+        return postal_codes_path, payments_path
+
+
+def _jagged_ring(rng: random.Random, x: float, y: float, vertices: int) -> T.List[T.Tuple[float, float]]:
+    """A closed ring within the grid cell at (x, y), around its center with a jittered radius"""
+    center_x, center_y = x + CELL_SIZE / 2, y + CELL_SIZE / 2
+    ring = []
+
+    for i in range(vertices):
+        angle = 2 * math.pi * i / vertices
+        radius = CELL_SIZE / 2 * rng.uniform(0.7, 1.0)
+        ring.append((center_x + radius * math.cos(angle), center_y + radius * math.sin(angle)))
+
+    return ring + ring[:1]
+
+
+def _polygon_ewkb(ring: T.List[T.Tuple[float, float]]) -> str:
+    """Hex EWKB of a single ring polygon in EPSG:4326, as PostGIS exports them"""
+    header = struct.pack('<BIIII', 1, 0x20000003, 4326, 1, len(ring))
+    return (header + b''.join(struct.pack('<dd', x, y) for x, y in ring)).hex().upper()
+
+
+def _write_csv(path: str, header: T.Sequence[str], rows: T.Iterable[T.Sequence]):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--postal-codes', type=int, default=1000)
+    parser.add_argument('--months', type=int, default=60)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fit', help="Paystats file to fit the distributions of amounts, ages and genders to")
+    parser.add_argument('--out', default='synthetic')
+    args = parser.parse_args()
+
+    profile = Profile.from_csv(args.fit) if args.fit else None
+    generator = Generator(args.rows, args.postal_codes, args.months, profile=profile, seed=args.seed)
+
+    for path in generator.write(args.out):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""Latency of date range queries on Payments as it grows, partitioned by month against the former plain table.
+
+Runs on a scratch database next to the configured one, dropped afterwards:
+
+    python -m benchmarks.table_size --sizes 10000 100000 1000000 --months 60
+"""
+import argparse
+import json
+import statistics
+import time
+import typing as T
+
+from config import settings
+from geoapp.db import PostgresDatabase, partition_payments
+from geoapp.loader import CsvLoader
+from geoapp.migrations import migrate
+from geoapp.models import Age, Gender
+
+# Query name -> SQL over `{table}`, all of them aggregating a range of months like the API does
+QUERIES = {
+    'month_by_age_gender': (
+        "SELECT p_age, p_gender, SUM(amount) FROM {table} "
+        "WHERE p_month BETWEEN '2015-03-01' AND '2015-03-31' GROUP BY p_age, p_gender"
+    ),
+    'quarter_by_postal_code': (
+        "SELECT postal_code_id, p_age, p_gender, SUM(amount) FROM {table} "
+        "WHERE p_month BETWEEN '2015-04-01' AND '2015-06-30' GROUP BY postal_code_id, p_age, p_gender"
+    ),
+    'year_total': "SELECT SUM(amount) FROM {table} WHERE p_month BETWEEN '2015-01-01' AND '2015-12-31'",
+    'viewport_year': (
+        "SELECT postal_code_id, SUM(amount) FROM {table} "
+        "WHERE p_month BETWEEN '2015-01-01' AND '2015-12-31' AND postal_code_id = ANY(%s) GROUP BY postal_code_id"
+    ),
+}
+
+# The schema Payments had before partitioning: a primary key and nothing else
+FLAT_TABLE = """
+CREATE TABLE IF NOT EXISTS PaymentsFlat (
+    amount DECIMAL NOT NULL,
+    p_month DATE NOT NULL,
+    p_age VARCHAR(8) NOT NULL,
+    p_gender CHAR(1) NOT NULL,
+    postal_code_id INT NOT NULL,
+    id INT NOT NULL,
+    PRIMARY KEY (id)
+)
+"""
+
+# Random payments with ids in [%(start)s, %(end)s), spread over %(months)s months from 2015-01
+GENERATE = """
+INSERT INTO {table} (amount, p_month, p_age, p_gender, postal_code_id, id)
+SELECT
+    ROUND((RANDOM() * 1000)::NUMERIC, 2),
+    DATE '2015-01-01' + (FLOOR(RANDOM() * %(months)s)::INT * INTERVAL '1 month'),
+    (%(ages)s::TEXT[])[1 + FLOOR(RANDOM() * CARDINALITY(%(ages)s::TEXT[]))::INT],
+    (%(genders)s::TEXT[])[1 + FLOOR(RANDOM() * CARDINALITY(%(genders)s::TEXT[]))::INT],
+    (%(postal_codes)s::INT[])[1 + FLOOR(RANDOM() * CARDINALITY(%(postal_codes)s::INT[]))::INT],
+    id
+FROM generate_series(%(start)s, %(end)s - 1) AS id
+"""
+
+
+def grow(db: PostgresDatabase, start: int, end: int, months: int, postal_codes: T.List[int]):
+    params = {
+        'start': start,
+        'end': end,
+        'months': months,
+        'ages': [age.value for age in Age],
+        'genders': [gender.value for gender in Gender],
+        'postal_codes': postal_codes,
+    }
+
+    db.execute_statement("SELECT setseed(0.5)")
+    db.execute_statement(GENERATE.format(table='Payments'), params)
+    db.execute_statement("SELECT setseed(0.5)")
+    db.execute_statement(GENERATE.format(table='PaymentsFlat'), params)
+
+    partition_payments(db)
+    db.execute_statement("ANALYZE Payments")
+    db.execute_statement("ANALYZE PaymentsFlat")
+
+
+def measure(db: PostgresDatabase, query: str, params: T.Tuple, repeat: int) -> float:
+    """Median latency of a query in milliseconds, after a warm up run"""
+    db.execute_query(query, params)
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        db.execute_query(query, params)
+        timings.append((time.perf_counter() - started) * 1000)
+
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--months', type=int, default=60, help="Months payments are spread over")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--json', action='store_true', help="Print results as JSON")
+    args = parser.parse_args()
+
+    config = settings.db_config.copy(update={'database': f"benchmark_{settings.db_config.database}"})
+    db = PostgresDatabase(config)
+    db.init(config)
+
+    try:
+        migrate(db)
+        db.execute_statement(FLAT_TABLE)
+        CsvLoader(db).load('PostalCodes', settings.data.postalcodes)
+
+        postal_codes = [id_ for id_, in db.execute_query("SELECT id FROM PostalCodes")]
+        viewport = (postal_codes[:10],)
+
+        results, size = [], 0
+        for target in sorted(args.sizes):
+            grow(db, size, target, args.months, postal_codes)
+            size = target
+
+            for name, query in QUERIES.items():
+                params = viewport if '%s' in query else None
+                results.append({
+                    'rows': size,
+                    'query': name,
+                    'partitioned_ms': measure(db, query.format(table='Payments'), params, args.repeat),
+                    'flat_ms': measure(db, query.format(table='PaymentsFlat'), params, args.repeat),
+                })
+    finally:
+        db.teardown()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'rows':>10} {'query':<24} {'partitioned ms':>15} {'flat ms':>10}")
+    for result in results:
+        print(
+            f"{result['rows']:>10} {result['query']:<24} "
+            f"{result['partitioned_ms']:>15.2f} {result['flat_ms']:>10.2f}"
+        )
+
+
+if __name__ == '__main__':
+    main()
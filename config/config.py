@@ -1,9 +1,17 @@
-from typing import Optional
+from typing import List, Optional
 
 from pydantic import BaseModel
 import yaml
 
 
+class ReplicaConfig(BaseModel):
+    host: str
+    # The primary's when missing
+    port: Optional[str]
+    # Seconds to wait for a connection, a replica down is skipped rather than waited for
+    connect_timeout: int = 2
+
+
 class DatabaseConfig(BaseModel):
     host: str
     port: Optional[str]
@@ -11,16 +19,110 @@ class DatabaseConfig(BaseModel):
     user: str
     password: str
     database_class: str
+    pool_min_size: int = 1
+    pool_max_size: int = 10
+    pool_timeout: float = 30.0
+    pool_health_check: bool = True
+    # Rows fetched per round trip by `Database.stream_query`
+    stream_itersize: int = 2000
+    # Queries taking longer, in seconds, are logged by `geoapp.db.slow`. None logs none
+    slow_query_threshold: Optional[float] = None
+    # Connections of the ASGI app's pool, requests past them wait without holding a thread
+    async_pool_min_size: int = 2
+    async_pool_max_size: int = 50
+    # Run the queries of `PostgresQueryService` as statements prepared once per connection
+    prepare_statements: bool = True
+    # How Postgres plans prepared statements: `auto`, `force_generic_plan` or `force_custom_plan`. Server's when missing
+    plan_cache_mode: Optional[str] = None
+    # Seconds to wait for a connection to the server, forever when missing
+    connect_timeout: Optional[int] = None
+    # Read-only copies of the database, same name and credentials, `ReplicatedPostgresDatabase` reads from
+    replicas: List[ReplicaConfig] = []
+    # Replicas further behind the primary, in seconds, are skipped until they catch up
+    replica_max_lag: float = 5.0
+    # Seconds between checks of the health and lag of replicas
+    replica_check_interval: float = 5.0
 
 
 class DataConfig(BaseModel):
+    # CSV files read from the app side, they don't need to be on the database server
     payments: str
     postalcodes: str
+    # Rows validated and sent per `COPY`, and connections loading them in parallel
+    load_chunk_size: int = 50000
+    load_workers: int = 1
+
+
+class CacheConfig(BaseModel):
+    enabled: bool = False
+    backend: str = 'MemoryCache'
+    max_entries: int = 1024
+    ttl: Optional[float] = None
+    path: Optional[str] = None
+    version_check_interval: float = 1.0
+
+
+class CoalescingConfig(BaseModel):
+    enabled: bool = True
+    # Directory of the lock files sharing computations across processes, only within each one when missing
+    lock_dir: Optional[str] = None
+    timeout: float = 30.0
+
+
+class QueryServiceConfig(BaseModel):
+    query_service_class: str = 'PostgresQueryService'
+    # Where ColumnarQueryService loads payments from: `database` or `csv` (the `data` paths)
+    columnar_source: str = 'database'
+    # Answer ColumnarQueryService queries from a prefix sum cube rather than the raw columns
+    prefix_sum_cube: bool = False
+    # How /map renders geometries: `wkb` (as stored) or `geojson`
+    geometry_format: str = 'wkb'
+    prerender_geometries: bool = False
+    # Grid size TopoJSON coordinates are quantized to, over the bounding box of all postal codes
+    topology_quantization: int = 100000
+
+
+class WarmupConfig(BaseModel):
+    enabled: bool = False
+    # Date ranges precomputed: all data, each calendar year and quarter, and trailing windows of months
+    all_data: bool = True
+    years: bool = True
+    quarters: bool = True
+    last_months: List[int] = [1, 3, 6]
+    # Most requested queries of late precomputed on top of those ranges
+    top_observed: int = 20
+    methods: List[str] = [
+        'get_dashboard',
+        'get_map',
+        'get_turnover',
+        'get_turnover_by_age_and_gender',
+        'get_turnover_by_time_and_gender',
+    ]
+    # Recompute warm entries in the background after data changes, serving the outdated ones meanwhile
+    refresh: bool = True
+    # Where the queries requested of late are kept between restarts
+    popularity_path: Optional[str] = None
+    save_interval: float = 60.0
+
+
+class ServerConfig(BaseModel):
+    bind: str = '0.0.0.0:8000'
+    # Worker processes, one per core when missing
+    workers: Optional[int] = None
+    threads: int = 4
+    # Seconds a worker can take to answer before it's restarted
+    timeout: int = 60
 
 
 class Config(BaseModel):
     db_config: DatabaseConfig
     data: DataConfig
+    cache: CacheConfig = CacheConfig()
+    tile_cache: CacheConfig = CacheConfig(enabled=True, max_entries=4096)
+    query_service: QueryServiceConfig = QueryServiceConfig()
+    coalescing: CoalescingConfig = CoalescingConfig()
+    warmup: WarmupConfig = WarmupConfig()
+    server: ServerConfig = ServerConfig()
     test: bool = False
 
 def init_config(config_path: str = 'config/config.yml'):
@@ -0,0 +1,50 @@
+CREATE TABLE IF NOT EXISTS PostalCodes (
+    the_geom TEXT NOT NULL,
+    code CHAR(5) NOT NULL,
+    id INT NOT NULL,
+    PRIMARY KEY (id)
+);
+
+CREATE TABLE IF NOT EXISTS Payments (
+    amount DECIMAL NOT NULL,
+    p_month DATE NOT NULL,
+    p_age VARCHAR(8) NOT NULL,
+    p_gender CHAR(1) NOT NULL,
+    postal_code_id INT NOT NULL,
+    id INT NOT NULL,
+    PRIMARY KEY (id),
+    CONSTRAINT fk_postal_code_id
+        FOREIGN KEY (postal_code_id)
+        REFERENCES PostalCodes (id)
+);
+
+-- Rollups of Payments maintained by `geoapp.db.refresh_rollups`
+CREATE TABLE IF NOT EXISTS PaymentsByMonthPostalCode (
+    p_month DATE NOT NULL,
+    postal_code_id INT NOT NULL,
+    p_age VARCHAR(8) NOT NULL,
+    p_gender CHAR(1) NOT NULL,
+    amount DECIMAL NOT NULL,
+    PRIMARY KEY (p_month, postal_code_id, p_age, p_gender)
+);
+
+CREATE TABLE IF NOT EXISTS PaymentsByMonth (
+    p_month DATE NOT NULL,
+    p_age VARCHAR(8) NOT NULL,
+    p_gender CHAR(1) NOT NULL,
+    amount DECIMAL NOT NULL,
+    PRIMARY KEY (p_month, p_age, p_gender)
+);
+
+CREATE TABLE IF NOT EXISTS DataVersion (
+    id INT NOT NULL DEFAULT 1,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id),
+    CONSTRAINT single_row CHECK (id = 1)
+);
+
+-- Months changed by the last bump, NULL when it could have changed any
+ALTER TABLE DataVersion ADD COLUMN IF NOT EXISTS months DATE[];
+
+INSERT INTO DataVersion (id) VALUES (1) ON CONFLICT DO NOTHING;
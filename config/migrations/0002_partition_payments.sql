@@ -0,0 +1,58 @@
+-- Payments partitioned by month, so date ranges only scan the partitions of their months.
+-- Rows of months without a partition of their own land in Payments_default until
+-- `partition_payments()` moves them out of it.
+ALTER TABLE Payments RENAME TO PaymentsUnpartitioned;
+ALTER INDEX payments_pkey RENAME TO paymentsunpartitioned_pkey;
+
+CREATE TABLE Payments (
+    amount DECIMAL NOT NULL,
+    p_month DATE NOT NULL,
+    p_age VARCHAR(8) NOT NULL,
+    p_gender CHAR(1) NOT NULL,
+    postal_code_id INT NOT NULL,
+    id INT NOT NULL,
+    -- Unique keys of partitioned tables must include the partition key, ingestion keeps ids unique
+    PRIMARY KEY (id, p_month),
+    CONSTRAINT fk_postal_code_id
+        FOREIGN KEY (postal_code_id)
+        REFERENCES PostalCodes (id)
+) PARTITION BY RANGE (p_month);
+
+CREATE TABLE Payments_default PARTITION OF Payments DEFAULT;
+
+-- Creates the partitions of the months found in Payments_default and moves their rows there.
+-- Returns the months partitioned.
+CREATE OR REPLACE FUNCTION partition_payments() RETURNS SETOF DATE AS $$
+DECLARE
+    months DATE[];
+    month DATE;
+BEGIN
+    SELECT ARRAY_AGG(DISTINCT DATE_TRUNC('month', p_month)::DATE) INTO months FROM Payments_default;
+    IF months IS NULL THEN
+        RETURN;
+    END IF;
+
+    -- A default partition can't hold rows of a partition being created, it goes aside meanwhile
+    ALTER TABLE Payments DETACH PARTITION Payments_default;
+
+    FOREACH month IN ARRAY months LOOP
+        EXECUTE format(
+            'CREATE TABLE payments_%s PARTITION OF Payments FOR VALUES FROM (%L) TO (%L)',
+            TO_CHAR(month, 'YYYY_MM'), month, (month + INTERVAL '1 month')::DATE
+        );
+        RETURN NEXT month;
+    END LOOP;
+
+    INSERT INTO Payments SELECT * FROM Payments_default;
+    TRUNCATE Payments_default;
+
+    ALTER TABLE Payments ATTACH PARTITION Payments_default DEFAULT;
+END
+$$ LANGUAGE plpgsql;
+
+INSERT INTO Payments (amount, p_month, p_age, p_gender, postal_code_id, id)
+SELECT amount, p_month, p_age, p_gender, postal_code_id, id FROM PaymentsUnpartitioned;
+
+SELECT partition_payments();
+
+DROP TABLE PaymentsUnpartitioned;
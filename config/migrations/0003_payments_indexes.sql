@@ -0,0 +1,10 @@
+-- Month ranges within a partition, or across the default one, without the size of a B-tree
+CREATE INDEX IF NOT EXISTS payments_p_month_brin ON Payments USING BRIN (p_month);
+
+-- Index-only scans for the (age, gender) aggregates, over a range of months...
+CREATE INDEX IF NOT EXISTS payments_month_age_gender
+    ON Payments (p_month, p_age, p_gender) INCLUDE (postal_code_id, amount);
+
+-- ...and over the postal codes of a viewport
+CREATE INDEX IF NOT EXISTS payments_postal_code_month
+    ON Payments (postal_code_id, p_month) INCLUDE (p_age, p_gender, amount);
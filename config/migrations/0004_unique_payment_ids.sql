@@ -0,0 +1,85 @@
+-- Payment ids are unique again. The primary key of partitioned Payments has to include p_month, so it
+-- only keeps an id from appearing twice within the same month: PaymentIds, not partitioned, holds each
+-- id of Payments once, kept in step by the statement triggers below. Loads copying an id already
+-- stored, in any month, fail on its primary key. Rows written to a partition directly bypass them.
+CREATE TABLE PaymentIds (
+    id INT PRIMARY KEY
+);
+
+INSERT INTO PaymentIds SELECT id FROM Payments;
+
+CREATE OR REPLACE FUNCTION payment_ids_inserted() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO PaymentIds SELECT id FROM inserted;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION payment_ids_deleted() RETURNS TRIGGER AS $$
+BEGIN
+    DELETE FROM PaymentIds i USING deleted d WHERE i.id = d.id;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION payment_ids_updated() RETURNS TRIGGER AS $$
+BEGIN
+    DELETE FROM PaymentIds i USING deleted d WHERE i.id = d.id;
+    INSERT INTO PaymentIds SELECT id FROM inserted;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION payment_ids_truncated() RETURNS TRIGGER AS $$
+BEGIN
+    TRUNCATE PaymentIds;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- Once per statement, with the rows it changed, so COPY and bulk inserts don't pay a trigger call per row
+CREATE TRIGGER payment_ids_inserted AFTER INSERT ON Payments
+    REFERENCING NEW TABLE AS inserted
+    FOR EACH STATEMENT EXECUTE FUNCTION payment_ids_inserted();
+
+CREATE TRIGGER payment_ids_deleted AFTER DELETE ON Payments
+    REFERENCING OLD TABLE AS deleted
+    FOR EACH STATEMENT EXECUTE FUNCTION payment_ids_deleted();
+
+CREATE TRIGGER payment_ids_updated AFTER UPDATE ON Payments
+    REFERENCING OLD TABLE AS deleted NEW TABLE AS inserted
+    FOR EACH STATEMENT EXECUTE FUNCTION payment_ids_updated();
+
+CREATE TRIGGER payment_ids_truncated AFTER TRUNCATE ON Payments
+    FOR EACH STATEMENT EXECUTE FUNCTION payment_ids_truncated();
+
+-- As in 0002, except that the rows moved out of the default partition give up their ids first: they are
+-- inserted into Payments again, their ids along with them.
+CREATE OR REPLACE FUNCTION partition_payments() RETURNS SETOF DATE AS $$
+DECLARE
+    months DATE[];
+    month DATE;
+BEGIN
+    SELECT ARRAY_AGG(DISTINCT DATE_TRUNC('month', p_month)::DATE) INTO months FROM Payments_default;
+    IF months IS NULL THEN
+        RETURN;
+    END IF;
+
+    -- A default partition can't hold rows of a partition being created, it goes aside meanwhile
+    ALTER TABLE Payments DETACH PARTITION Payments_default;
+
+    FOREACH month IN ARRAY months LOOP
+        EXECUTE format(
+            'CREATE TABLE payments_%s PARTITION OF Payments FOR VALUES FROM (%L) TO (%L)',
+            TO_CHAR(month, 'YYYY_MM'), month, (month + INTERVAL '1 month')::DATE
+        );
+        RETURN NEXT month;
+    END LOOP;
+
+    DELETE FROM PaymentIds i USING Payments_default d WHERE i.id = d.id;
+    INSERT INTO Payments SELECT * FROM Payments_default;
+    TRUNCATE Payments_default;
+
+    ALTER TABLE Payments ATTACH PARTITION Payments_default DEFAULT;
+END
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,4 @@
+-- Every month has a partition of its own once loaded, so partition pruning already narrows a range of
+-- months down to theirs and the BRIN index of 0003 never excluded anything more. Only Payments_default
+-- holds several months, and only until `partition_payments()` empties it.
+DROP INDEX IF EXISTS payments_p_month_brin;
@@ -2,4 +2,12 @@
 
 export FLASK_ENV=production
 
-flask run --host=0.0.0.0 --port 8000
+# Migrates the database and loads the data files into empty tables, before any worker starts
+flask init-data
+
+# SERVING_MODE=asgi serves the query API asynchronously, it needs the `asgi` extra
+if [ "$SERVING_MODE" = "asgi" ]; then
+    exec uvicorn asgi:app --host 0.0.0.0 --port 8000
+fi
+
+exec gunicorn 'app:create_app()'
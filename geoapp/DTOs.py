@@ -2,7 +2,9 @@ from datetime import date
 import typing as T
 
 from flask import request as FlaskRequest
-from pydantic import BaseModel, ValidationError as PyValidationError
+from pydantic import BaseModel, ValidationError as PyValidationError, confloat, conint, validator
+
+from geoapp.models import Dimension
 
 
 class ValidationError(Exception):
@@ -36,3 +38,99 @@ class QueryRequestModel(Request):
         return req
 
 
+class TurnoverRequestModel(QueryRequestModel):
+    # Dimensions to group by, in nesting order
+    by: T.List[Dimension] = []
+
+    @validator('by', pre=True)
+    def split_by(cls, value):
+        if isinstance(value, str):
+            return [dimension for dimension in value.split(',') if dimension]
+        return value
+
+    @validator('by')
+    def check_by(cls, value):
+        if len(set(value)) != len(value):
+            raise ValueError("Can't group twice by the same dimension")
+        return value
+
+    @classmethod
+    def from_request(cls, request: FlaskRequest) -> TRequest:
+        try:
+            req = cls(
+                start_date=request.args.get('startDate'),
+                end_date=request.args.get('endDate'),
+                by=request.args.get('by', []),
+            )
+        except PyValidationError:
+            raise ValidationError(message="Missing or invalid query params", status_code=400)
+        return req
+
+
+class DashboardRequestModel(QueryRequestModel):
+    zoom: T.Optional[conint(ge=0, le=24)]
+    tolerance: T.Optional[confloat(ge=0)]
+
+    @classmethod
+    def from_request(cls, request: FlaskRequest) -> TRequest:
+        try:
+            req = cls(
+                start_date=request.args.get('startDate'),
+                end_date=request.args.get('endDate'),
+                zoom=request.args.get('zoom'),
+                tolerance=request.args.get('tolerance'),
+            )
+        except PyValidationError:
+            raise ValidationError(message="Missing or invalid query params", status_code=400)
+        return req
+
+
+# Media types of the formats /map can be rendered in
+MAP_FORMATS = {
+    'json': 'application/json',
+    'topojson': 'application/topo+json',
+}
+
+
+class MapRequestModel(QueryRequestModel):
+    # Picked with the `format` query param, or else negotiated through the Accept header
+    map_format: T.Literal['json', 'topojson'] = 'json'
+    # Send JSON results as they are computed, in a chunked response
+    stream: bool = False
+    zoom: T.Optional[conint(ge=0, le=24)]
+    tolerance: T.Optional[confloat(ge=0)]
+    # (min longitude, min latitude, max longitude, max latitude)
+    bbox: T.Optional[T.Tuple[float, float, float, float]]
+
+    @validator('bbox', pre=True)
+    def split_bbox(cls, value):
+        if isinstance(value, str):
+            return value.split(',')
+        return value
+
+    @validator('bbox')
+    def check_bbox(cls, value):
+        if value is not None and (value[0] > value[2] or value[1] > value[3]):
+            raise ValueError("bbox minimums must not be greater than its maximums")
+        return value
+
+    @classmethod
+    def from_request(cls, request: FlaskRequest) -> TRequest:
+        try:
+            req = cls(
+                start_date=request.args.get('startDate'),
+                end_date=request.args.get('endDate'),
+                zoom=request.args.get('zoom'),
+                tolerance=request.args.get('tolerance'),
+                bbox=request.args.get('bbox'),
+                map_format=request.args.get('format') or cls._negotiate_format(request),
+                stream=request.args.get('stream', False),
+            )
+        except PyValidationError:
+            raise ValidationError(message="Missing or invalid query params", status_code=400)
+        return req
+
+    @staticmethod
+    def _negotiate_format(request: FlaskRequest) -> str:
+        best = request.accept_mimetypes.best_match(list(MAP_FORMATS.values()), default=MAP_FORMATS['json'])
+        return next(name for name, mimetype in MAP_FORMATS.items() if mimetype == best)
@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import time
+import typing as T
+
+from flask import json
+from werkzeug.wrappers import Request
+
+from config import Config
+from geoapp import db, metrics
+from geoapp.conditional import Validators
+from geoapp.DTOs import (
+    MAP_FORMATS,
+    DashboardRequestModel,
+    MapRequestModel,
+    QueryRequestModel,
+    TurnoverRequestModel,
+    ValidationError,
+)
+from geoapp.geometry import level_for
+from geoapp.services import AsyncPostgresQueryService, build_geometry_store
+
+logger = logging.getLogger(__name__)
+
+
+Scope = T.Dict[str, T.Any]
+Receive = T.Callable[[], T.Awaitable[dict]]
+Send = T.Callable[[dict], T.Awaitable[None]]
+
+
+class Response(T.NamedTuple):
+    status: int
+    # Sent at once, or chunk by chunk as they are computed
+    body: T.Union[bytes, T.AsyncIterator[str]]
+    headers: T.Tuple[T.Tuple[str, str], ...] = (('Content-Type', 'application/json'),)
+
+    @classmethod
+    def json(cls, data: dict, status: int = 200, headers: T.Dict[str, str] = None) -> 'Response':
+        headers = {'Content-Type': 'application/json', **(headers or {})}
+        return cls(status, json.dumps(data).encode(), tuple(headers.items()))
+
+
+class QueryApp:
+    """The routes of the query blueprint as a bare ASGI app, awaiting Postgres instead of blocking a thread.
+
+    Requests are validated by the same models as the Flask views and answered by an
+    `AsyncPostgresQueryService`, so responses are the same. Schema migrations and loads still run on the
+    synchronous adapter on start up, and so does reading the postal code geometries.
+    """
+
+    def __init__(self, config: Config, service: AsyncPostgresQueryService = None, version: db.DataVersion = None):
+        if version is None:
+            version = db.data_version
+
+        self.config = config
+        self.service = service
+        self.version = version
+
+        self.routes: T.Dict[str, T.Callable[[Request], T.Awaitable[Response]]] = {
+            '/api/map': self.get_map,
+            '/api/turnover': self.get_turnover,
+            '/api/turnover/age-gender': self.get_turnover_by_age_and_gender,
+            '/api/turnover/time-gender': self.get_turnover_by_time_and_gender,
+            '/api/dashboard': self.get_dashboard,
+            '/metrics': self.get_metrics,
+        }
+        # Routes answering from the data, validated by its version
+        self.versioned = {path for path in self.routes if path.startswith('/api/')}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, send)
+
+    async def startup(self):
+        if self.service is not None:
+            return
+
+        await asyncio.to_thread(db.init, self.config)
+
+        geometries = build_geometry_store(self.config)
+        # Read once up front, so no request blocks the loop on it
+        await asyncio.to_thread(geometries.ids)
+
+        database = db.AsyncPostgresDatabase()
+        await database.init(self.config.db_config)
+
+        self.service = AsyncPostgresQueryService(
+            database, geometries=geometries, geometry_format=self.config.query_service.geometry_format
+        )
+
+    async def shutdown(self):
+        if self.service is not None:
+            await self.service.db.shutdown()
+
+    async def get_map(self, request: Request) -> Response:
+        query: MapRequestModel = MapRequestModel.from_request(request)
+        level = level_for(zoom=query.zoom, tolerance=query.tolerance)
+        headers = {'Content-Type': MAP_FORMATS[query.map_format], 'Vary': 'Accept'}
+
+        if query.map_format == 'topojson':
+            topology = await self.service.get_map_topology(
+                query.start_date, query.end_date, level=level, bbox=query.bbox
+            )
+            return Response.json(topology, headers=headers)
+
+        if query.stream:
+            results = self.service.stream_map(query.start_date, query.end_date, level=level, bbox=query.bbox)
+            return Response(200, _stream_results(results), tuple(headers.items()))
+
+        data = await self.service.get_map(query.start_date, query.end_date, level=level, bbox=query.bbox)
+        return Response.json(data, headers=headers)
+
+    async def get_turnover(self, request: Request) -> Response:
+        query: TurnoverRequestModel = TurnoverRequestModel.from_request(request)
+        return Response.json(await self.service.get_turnover(query.start_date, query.end_date, by=query.by))
+
+    async def get_turnover_by_age_and_gender(self, request: Request) -> Response:
+        query: QueryRequestModel = QueryRequestModel.from_request(request)
+        return Response.json(await self.service.get_turnover_by_age_and_gender(query.start_date, query.end_date))
+
+    async def get_turnover_by_time_and_gender(self, request: Request) -> Response:
+        query: QueryRequestModel = QueryRequestModel.from_request(request)
+        return Response.json(await self.service.get_turnover_by_time_and_gender(query.start_date, query.end_date))
+
+    async def get_dashboard(self, request: Request) -> Response:
+        query: DashboardRequestModel = DashboardRequestModel.from_request(request)
+        level = level_for(zoom=query.zoom, tolerance=query.tolerance)
+        return Response.json(await self.service.get_dashboard(query.start_date, query.end_date, level=level))
+
+    async def get_metrics(self, request: Request) -> Response:
+        return Response(200, metrics.registry.render().encode(), (('Content-Type', metrics.CONTENT_TYPE),))
+
+    async def _lifespan(self, receive: Receive, send: Send):
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as ex:
+                    logger.exception("Could not start up")
+                    await send({'type': 'lifespan.startup.failed', 'message': str(ex)})
+                    return
+
+                await send({'type': 'lifespan.startup.complete'})
+
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope: Scope, send: Send):
+        started = time.perf_counter()
+        request = _request(scope)
+        handler = self.routes.get(request.path)
+
+        if handler is None:
+            response = Response.json({"message": "Not found"}, status=404)
+        elif request.method != 'GET':
+            response = Response.json({"message": "Method not allowed"}, status=405, headers={'Allow': 'GET'})
+        else:
+            try:
+                response = await self._respond(request, handler)
+            except ValidationError as ex:
+                response = Response.json({"message": ex.message}, status=ex.status_code)
+            except Exception:
+                logger.exception(f"Could not answer {request.method} {request.full_path}")
+                response = Response.json({"message": "Internal server error"}, status=500)
+
+        await send({
+            'type': 'http.response.start',
+            'status': response.status,
+            'headers': [(name.lower().encode(), value.encode()) for name, value in response.headers],
+        })
+
+        route = request.path if handler is not None else 'unmatched'
+        metrics.request_duration.observe(
+            time.perf_counter() - started, route=route, method=request.method, status=response.status
+        )
+
+        if isinstance(response.body, bytes):
+            metrics.response_bytes.observe(len(response.body), route=route)
+            await send({'type': 'http.response.body', 'body': response.body})
+            return
+
+        try:
+            async for chunk in response.body:
+                await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+        finally:
+            await response.body.aclose()
+
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+    async def _respond(self, request: Request, handler: T.Callable[[Request], T.Awaitable[Response]]) -> Response:
+        if request.path not in self.versioned:
+            return await handler(request)
+
+        # Reading the version may take a query, at most every `version_check_interval`
+        validators = await asyncio.to_thread(Validators.of, request, self.version)
+        if validators.matches(request):
+            return Response(304, b'', tuple(validators.headers.items()))
+
+        response = await handler(request)
+        if response.status != 200:
+            return response
+
+        return response._replace(headers=tuple({**dict(response.headers), **validators.headers}.items()))
+
+
+def _request(scope: Scope) -> Request:
+    """The parts of a Werkzeug request the request models and validators read, out of an ASGI scope"""
+    headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']}
+
+    return Request({
+        **{f"HTTP_{name.upper().replace('-', '_')}": value for name, value in headers.items()},
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'HTTP_ACCEPT': headers.get('accept', '*/*'),
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+    })
+
+
+async def _stream_results(results: T.AsyncIterator[dict]) -> T.AsyncIterator[str]:
+    """Serializes results as `{"results": [...]}` one at a time"""
+    yield '{"results": ['
+
+    try:
+        i = 0
+        async for result in results:
+            yield (',' if i else '') + json.dumps(result)
+            i += 1
+    finally:
+        # Releases the connection of a stream the client gave up on
+        await results.aclose()
+
+    yield ']}'
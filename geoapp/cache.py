@@ -0,0 +1,294 @@
+import abc
+import collections
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import typing as T
+
+from config.config import CacheConfig
+
+logger = logging.getLogger(__name__)
+
+
+MISSING = object()
+
+
+class InvalidCacheBackend(Exception):
+    pass
+
+
+class UnsafeDirectory(Exception):
+    pass
+
+
+def private_directory(path: str):
+    """Makes sure the directory at `path` exists and only its owner, this user, can read or write it.
+    Whatever is unpickled from there must not be writable by anyone else."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+
+    stat = os.stat(path)
+    if stat.st_uid != os.getuid():
+        raise UnsafeDirectory(f"{path} belongs to another user")
+
+    if stat.st_mode & 0o077:
+        os.chmod(path, 0o700)
+
+
+class CacheBackend(abc.ABC):
+    def __init__(self, max_entries: int = 1024, ttl: T.Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._counters = collections.Counter()
+        self._counters_lock = threading.Lock()
+
+    @abc.abstractmethod
+    def get(self, key: str) -> T.Any:
+        """Returns the cached value or `MISSING`"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set(self, key: str, value: T.Any):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def clear(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        with self._counters_lock:
+            counters = dict(self._counters)
+
+        lookups = counters.get('hits', 0) + counters.get('misses', 0)
+
+        return {
+            "hits": counters.get('hits', 0),
+            "misses": counters.get('misses', 0),
+            "evictions": counters.get('evictions', 0),
+            "expirations": counters.get('expirations', 0),
+            "hit_ratio": counters.get('hits', 0) / lookups if lookups else 0.0,
+            "entries": len(self),
+            "max_entries": self.max_entries,
+        }
+
+    def _count(self, counter: str, amount: int = 1):
+        with self._counters_lock:
+            self._counters[counter] += amount
+
+    def _expires_at(self) -> T.Optional[float]:
+        if self.ttl is None:
+            return None
+
+        return time.monotonic() + self.ttl
+
+
+class MemoryCache(CacheBackend):
+    """Per-process LRU cache with an optional TTL"""
+
+    def __init__(self, max_entries: int = 1024, ttl: T.Optional[float] = None):
+        super().__init__(max_entries, ttl)
+
+        self._data: T.OrderedDict[str, T.Tuple[T.Optional[float], T.Any]] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> T.Any:
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None:
+                self._count('misses')
+                return MISSING
+
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self._count('expirations')
+                self._count('misses')
+                return MISSING
+
+            self._data.move_to_end(key)
+            self._count('hits')
+            return value
+
+    def set(self, key: str, value: T.Any):
+        with self._lock:
+            self._data[key] = (self._expires_at(), value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self._count('evictions')
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class LocalSharedCache(CacheBackend):
+    """LRU cache stored in a SQLite file, shared by every worker process on the same host.
+
+    Values are pickled. Expiry uses wall-clock time since entries outlive the process that wrote them.
+    Counters are kept per process.
+    """
+
+    def __init__(self, path: str, max_entries: int = 1024, ttl: T.Optional[float] = None):
+        super().__init__(max_entries, ttl)
+
+        self.path = path
+        self._local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory:
+            private_directory(directory)
+
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+
+    def get(self, key: str) -> T.Any:
+        now = time.time()
+
+        with self._connection() as conn:
+            row = conn.execute("SELECT value, expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+
+            if row is None:
+                self._count('misses')
+                return MISSING
+
+            value, expires_at = row
+            if expires_at is not None and expires_at <= now:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._count('expirations')
+                self._count('misses')
+                return MISSING
+
+            conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+
+        self._count('hits')
+        return pickle.loads(value)
+
+    def set(self, key: str, value: T.Any):
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl is not None else None
+
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), expires_at, now)
+            )
+
+            evicted = conn.execute(
+                "DELETE FROM entries WHERE key IN ("
+                "SELECT key FROM entries ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            ).rowcount
+
+        if evicted:
+            self._count('evictions', evicted)
+
+    def delete(self, key: str):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM entries")
+
+    def __len__(self) -> int:
+        with self._connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+
+        return conn
+
+
+class PopularityTracker:
+    """Counts the keys among the last `window` ones recorded, to tell the most popular of late"""
+
+    def __init__(self, window: int = 10000):
+        self._recent: T.Deque[T.Hashable] = collections.deque(maxlen=window)
+        self._counts: T.Counter[T.Hashable] = collections.Counter()
+        self._lock = threading.Lock()
+
+    def record(self, key: T.Hashable):
+        with self._lock:
+            if len(self._recent) == self._recent.maxlen:
+                oldest = self._recent[0]
+                self._counts[oldest] -= 1
+                if not self._counts[oldest]:
+                    del self._counts[oldest]
+
+            self._recent.append(key)
+            self._counts[key] += 1
+
+    def top(self, n: int) -> T.List[T.Hashable]:
+        with self._lock:
+            return [key for key, _ in self._counts.most_common(n)]
+
+    def save(self, path: str):
+        with self._lock:
+            recent = list(self._recent)
+
+        directory = os.path.dirname(path)
+        if directory:
+            private_directory(directory)
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(recent, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            private_directory(directory)
+
+        try:
+            with open(path, 'rb') as f:
+                recent = pickle.load(f)
+        except FileNotFoundError:
+            return
+
+        for key in recent:
+            self.record(key)
+
+
+def build_cache(config: CacheConfig) -> CacheBackend:
+    if config.backend == 'MemoryCache':
+        return MemoryCache(max_entries=config.max_entries, ttl=config.ttl)
+
+    if config.backend == 'LocalSharedCache':
+        if not config.path:
+            raise InvalidCacheBackend("LocalSharedCache requires a `path`")
+
+        return LocalSharedCache(config.path, max_entries=config.max_entries, ttl=config.ttl)
+
+    raise InvalidCacheBackend(f"Cache backend {config.backend} not found")
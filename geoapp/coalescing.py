@@ -0,0 +1,217 @@
+import collections
+import fcntl
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+import typing as T
+
+from geoapp.cache import private_directory
+
+logger = logging.getLogger(__name__)
+
+
+MISSING = object()
+# How often a process waiting on another one's lock file checks whether it's released
+POLL_INTERVAL = 0.01
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: T.Any = None
+        self.error: T.Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Runs a single computation per key at a time, whose result every concurrent caller shares.
+
+    Threads asking for a key already being computed wait for it rather than computing it again. With
+    a `lock_dir`, processes on the same host do as well: the computing one holds a lock file per key
+    and leaves its result next to it, for the ones which waited on the lock. Results aren't kept for
+    later callers, that's what caches are for: those older than `timeout`, which nobody waits for
+    anymore, are swept away along with the lock files of keys no longer computed.
+
+    Callers waiting longer than `timeout` seconds give up and compute the result themselves.
+    """
+
+    def __init__(self, lock_dir: str = None, timeout: float = 30.0):
+        self.lock_dir = lock_dir
+        self.timeout = timeout
+
+        self._calls: T.Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._swept_at = 0.0
+
+        if lock_dir:
+            private_directory(lock_dir)
+
+    def do(self, key: str, compute: T.Callable[[], T.Any]) -> T.Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            return self._follow(call, compute)
+
+        try:
+            call.value = self._lead(key, compute)
+            return call.value
+        except BaseException as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "computed": self._counters['computed'],
+                "shared": self._counters['shared'],
+                "shared_across_processes": self._counters['shared_across_processes'],
+                "timeouts": self._counters['timeouts'],
+                "in_flight": len(self._calls),
+            }
+
+    def _follow(self, call: _Call, compute: T.Callable[[], T.Any]) -> T.Any:
+        if not call.done.wait(self.timeout):
+            self._count('timeouts')
+            logger.warning("Gave up waiting for a computation in flight, computing it again")
+            return self._compute(compute)
+
+        self._count('shared')
+        if call.error is not None:
+            raise call.error
+
+        return call.value
+
+    def _lead(self, key: str, compute: T.Callable[[], T.Any]) -> T.Any:
+        if not self.lock_dir:
+            return self._compute(compute)
+
+        self._sweep()
+        path = os.path.join(self.lock_dir, hashlib.sha1(key.encode()).hexdigest())
+        waiting_since = time.time()
+
+        lock_file, locked, waited = self._acquire(path)
+        with lock_file:
+            if waited:
+                # Another process was computing it, its result will do once it's done
+                value = self._read_result(path, waiting_since) if locked else MISSING
+                if value is not MISSING:
+                    self._count('shared_across_processes')
+                    return value
+
+            try:
+                value = self._compute(compute)
+                self._write_result(path, value)
+                return value
+            finally:
+                if locked:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _compute(self, compute: T.Callable[[], T.Any]) -> T.Any:
+        self._count('computed')
+        return compute()
+
+    def _acquire(self, path: str) -> T.Tuple[T.IO, bool, bool]:
+        """The lock file of `path`, whether it got locked before the timeout, and whether another process held it"""
+        deadline = time.monotonic() + self.timeout
+        waited = False
+
+        while True:
+            lock_file = open(f"{path}.lock", 'a')
+            locked = self._try_lock(lock_file)
+
+            if not locked:
+                waited = True
+                locked = self._wait_for_lock(lock_file, deadline)
+
+            if not locked or self._is_current(lock_file, path):
+                return lock_file, locked, waited
+
+            # Swept away while waiting on it, whoever came next locks the new one
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def _wait_for_lock(self, lock_file: T.IO, deadline: float) -> bool:
+        while time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+            if self._try_lock(lock_file):
+                return True
+
+        self._count('timeouts')
+        logger.warning("Gave up waiting for another process computing the same result, computing it again")
+        return False
+
+    def _sweep(self):
+        """Removes results older than `timeout` and lock files nobody holds, at most every `timeout` seconds"""
+        now = time.time()
+        with self._lock:
+            if now - self._swept_at < self.timeout:
+                return
+            self._swept_at = now
+
+        for entry in os.scandir(self.lock_dir):
+            try:
+                if entry.stat().st_mtime > now - self.timeout:
+                    continue
+
+                if not entry.name.endswith('.lock'):
+                    # Results, and whatever writers that died halfway left
+                    os.unlink(entry.path)
+                    continue
+
+                with open(entry.path, 'a') as lock_file:
+                    if self._try_lock(lock_file):
+                        os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _is_current(lock_file: T.IO, path: str) -> bool:
+        """Whether `lock_file` is still the one at `path`, rather than one swept away since it was opened"""
+        try:
+            return os.stat(f"{path}.lock").st_ino == os.fstat(lock_file.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _try_lock(lock_file: T.IO) -> bool:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    @staticmethod
+    def _read_result(path: str, since: float) -> T.Any:
+        """The result left at `path`, unless it was computed before the caller started waiting"""
+        try:
+            with open(f"{path}.result", 'rb') as f:
+                stored_at, value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return MISSING
+
+        return value if stored_at >= since else MISSING
+
+    def _write_result(self, path: str, value: T.Any):
+        # Written aside and renamed, so readers never see half a result
+        fd, tmp_path = tempfile.mkstemp(dir=self.lock_dir)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((time.time(), value), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp_path, f"{path}.result")
+
+    def _count(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
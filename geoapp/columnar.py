@@ -0,0 +1,333 @@
+from datetime import date
+import typing as T
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+from geoapp.models import Age, Dimension, Gender
+
+
+AGES = [age.value for age in Age]
+GENDERS = [gender.value for gender in Gender]
+# Axes of the arrays returned by `group_by`, minus those grouped away
+AXES = (Dimension.Month, Dimension.PostalCode, Dimension.Age, Dimension.Gender)
+
+
+class NumpyNotInstalled(Exception):
+    pass
+
+
+def month_ordinal(day: date) -> int:
+    return day.year * 12 + day.month - 1
+
+
+def month_from_ordinal(ordinal: int) -> date:
+    return date(ordinal // 12, ordinal % 12 + 1, 1)
+
+
+class ColumnStore:
+    """Payments held in memory as dictionary-encoded NumPy columns, sorted by month.
+
+    Ages, genders and postal codes are stored as indexes into `AGES`, `GENDERS` and `postal_code_ids`,
+    months as `month_ordinal`s. Date ranges resolve to a slice of the columns through a binary
+    search, group-bys are `bincount`s over a combined index.
+    """
+
+    def __init__(
+            self,
+            months: 'np.ndarray',
+            ages: 'np.ndarray',
+            genders: 'np.ndarray',
+            postal_codes: 'np.ndarray',
+            amounts: 'np.ndarray',
+            postal_code_ids: 'np.ndarray',
+    ):
+        order = np.argsort(months, kind='stable')
+
+        self.months = months[order]
+        self.ages = ages[order]
+        self.genders = genders[order]
+        self.postal_codes = postal_codes[order]
+        self.amounts = amounts[order]
+        self.postal_code_ids = postal_code_ids
+
+    @classmethod
+    def from_rows(cls, rows: T.Iterable[T.Tuple], postal_code_ids: T.Iterable[int]) -> 'ColumnStore':
+        """Builds the store from `(p_month, p_age, p_gender, postal_code_id, amount)` rows"""
+        if np is None:
+            raise NumpyNotInstalled("The columnar engine requires numpy")
+
+        postal_code_ids = np.array(sorted(postal_code_ids), dtype=np.int64)
+        age_codes = {age: i for i, age in enumerate(AGES)}
+        gender_codes = {gender: i for i, gender in enumerate(GENDERS)}
+
+        months, ages, genders, postal_codes, amounts = [], [], [], [], []
+        for p_month, p_age, p_gender, postal_code_id, amount in rows:
+            if isinstance(p_month, str):
+                p_month = date.fromisoformat(p_month)
+
+            months.append(month_ordinal(p_month))
+            ages.append(age_codes[p_age])
+            genders.append(gender_codes[p_gender])
+            postal_codes.append(int(postal_code_id))
+            amounts.append(float(amount))
+
+        return cls(
+            months=np.array(months, dtype=np.int32),
+            ages=np.array(ages, dtype=np.int8),
+            genders=np.array(genders, dtype=np.int8),
+            postal_codes=np.searchsorted(postal_code_ids, np.array(postal_codes, dtype=np.int64)).astype(np.int32),
+            amounts=np.array(amounts, dtype=np.float64),
+            postal_code_ids=postal_code_ids,
+        )
+
+    def __len__(self) -> int:
+        return len(self.months)
+
+    @property
+    def nbytes(self) -> dict:
+        columns = {
+            "months": self.months.nbytes,
+            "ages": self.ages.nbytes,
+            "genders": self.genders.nbytes,
+            "postal_codes": self.postal_codes.nbytes,
+            "amounts": self.amounts.nbytes,
+            "postal_code_ids": self.postal_code_ids.nbytes,
+        }
+        return {**columns, "total": sum(columns.values())}
+
+    @staticmethod
+    def month_bounds(start_date: date, end_date: date) -> T.Tuple[int, int]:
+        """First and last month ordinals whose first day falls within the range, like `p_month BETWEEN`"""
+        first = month_ordinal(start_date) + (start_date.day > 1)
+        return first, month_ordinal(end_date)
+
+    def rows_between(self, start_date: date, end_date: date) -> slice:
+        first, last = self.month_bounds(start_date, end_date)
+        return slice(
+            int(np.searchsorted(self.months, first, side='left')),
+            int(np.searchsorted(self.months, last, side='right')),
+        )
+
+    def total(self, start_date: date, end_date: date) -> float:
+        return float(self.amounts[self.rows_between(start_date, end_date)].sum())
+
+    def by_age_and_gender(self, start_date: date, end_date: date) -> 'np.ndarray':
+        """Turnover as an (age, gender) matrix"""
+        rows = self.rows_between(start_date, end_date)
+        index = self.ages[rows].astype(np.intp) * len(GENDERS) + self.genders[rows]
+
+        return np.bincount(
+            index, weights=self.amounts[rows], minlength=len(AGES) * len(GENDERS)
+        ).reshape(len(AGES), len(GENDERS))
+
+    def by_month_and_gender(self, start_date: date, end_date: date) -> T.Tuple[int, 'np.ndarray']:
+        """First month ordinal of the range and turnover as a (month, gender) matrix"""
+        first, last = self.month_bounds(start_date, end_date)
+        n_months = max(last - first + 1, 0)
+
+        rows = self.rows_between(start_date, end_date)
+        index = (self.months[rows] - first).astype(np.intp) * len(GENDERS) + self.genders[rows]
+
+        return first, np.bincount(
+            index, weights=self.amounts[rows], minlength=n_months * len(GENDERS)
+        ).reshape(n_months, len(GENDERS))
+
+    def by_postal_code_age_and_gender(self, start_date: date, end_date: date) -> T.Tuple['np.ndarray', 'np.ndarray']:
+        """Indexes of postal codes with payments in the range and their turnover as (age, gender) matrices"""
+        rows = self.rows_between(start_date, end_date)
+        n_postal_codes = len(self.postal_code_ids)
+        cells = len(AGES) * len(GENDERS)
+
+        postal_codes = self.postal_codes[rows].astype(np.intp)
+        index = postal_codes * cells + self.ages[rows].astype(np.intp) * len(GENDERS) + self.genders[rows]
+
+        sums = np.bincount(index, weights=self.amounts[rows], minlength=n_postal_codes * cells)
+        present = np.flatnonzero(np.bincount(postal_codes, minlength=n_postal_codes))
+
+        return present, sums.reshape(n_postal_codes, len(AGES), len(GENDERS))[present]
+
+    def group_by(
+            self, start_date: date, end_date: date, dimensions: T.Iterable[Dimension],
+    ) -> T.Tuple[int, 'np.ndarray', 'np.ndarray']:
+        """First month ordinal of the range, turnover by `dimensions` with axes ordered as `AXES`,
+        and payment counts of each postal code in the range"""
+        first, last = self.month_bounds(start_date, end_date)
+        shape = (max(last - first + 1, 0), len(self.postal_code_ids), len(AGES), len(GENDERS))
+
+        rows = self.rows_between(start_date, end_date)
+        postal_codes = self.postal_codes[rows].astype(np.intp)
+        cells = (
+            (((self.months[rows] - first).astype(np.intp) * shape[1] + postal_codes) * shape[2] + self.ages[rows])
+            * shape[3] + self.genders[rows]
+        )
+
+        sums = np.bincount(cells, weights=self.amounts[rows], minlength=int(np.prod(shape))).reshape(shape)
+        counts = np.bincount(postal_codes, minlength=shape[1])
+
+        return first, _sum_other_axes(sums, dimensions), counts
+
+
+class PrefixSumCube:
+    """Cumulative turnover over months of a month x postal code x age x gender cube.
+
+    The turnover of any date range is the difference of two cumulative slices, so queries cost the
+    same regardless of how many months or payments they cover. Exposes the same query methods as
+    `ColumnStore`. Cubes are immutable, `append` returns a new one extended with later months.
+    """
+
+    def __init__(
+            self,
+            first_month: int,
+            postal_code_ids: 'np.ndarray',
+            cumulative: 'np.ndarray',
+            cumulative_age_gender: 'np.ndarray',
+            cumulative_total: 'np.ndarray',
+            cumulative_counts: 'np.ndarray',
+            month_gender: 'np.ndarray',
+    ):
+        self.first_month = first_month
+        self.postal_code_ids = postal_code_ids
+
+        # Cumulative arrays have one more row than months, the first one being all zeros
+        self.cumulative = cumulative
+        self.cumulative_age_gender = cumulative_age_gender
+        self.cumulative_total = cumulative_total
+        self.cumulative_counts = cumulative_counts
+        self.month_gender = month_gender
+
+    @classmethod
+    def from_store(cls, store: ColumnStore, first_month: int = None) -> 'PrefixSumCube':
+        if first_month is None:
+            first_month = int(store.months[0]) if len(store) else 0
+
+        n_months = int(store.months[-1]) - first_month + 1 if len(store) else 0
+        n_postal_codes = len(store.postal_code_ids)
+        shape = (n_months, n_postal_codes, len(AGES), len(GENDERS))
+
+        offsets = (store.months - first_month).astype(np.intp)
+        postal_codes = offsets * n_postal_codes + store.postal_codes
+        cells = (postal_codes * len(AGES) + store.ages) * len(GENDERS) + store.genders
+
+        monthly = np.bincount(cells, weights=store.amounts, minlength=int(np.prod(shape))).reshape(shape)
+        counts = np.bincount(postal_codes, minlength=n_months * n_postal_codes).reshape(n_months, n_postal_codes)
+        monthly_age_gender = monthly.sum(axis=1)
+
+        return cls(
+            first_month=first_month,
+            postal_code_ids=store.postal_code_ids,
+            cumulative=_prefix_sum(monthly),
+            cumulative_age_gender=_prefix_sum(monthly_age_gender),
+            cumulative_total=_prefix_sum(monthly_age_gender.sum(axis=(1, 2))),
+            cumulative_counts=_prefix_sum(counts),
+            month_gender=monthly_age_gender.sum(axis=1),
+        )
+
+    def __len__(self) -> int:
+        return len(self.month_gender)
+
+    @property
+    def last_month(self) -> int:
+        return self.first_month + len(self) - 1
+
+    @property
+    def nbytes(self) -> dict:
+        arrays = {
+            "cumulative": self.cumulative.nbytes,
+            "cumulative_age_gender": self.cumulative_age_gender.nbytes,
+            "cumulative_total": self.cumulative_total.nbytes,
+            "cumulative_counts": self.cumulative_counts.nbytes,
+            "month_gender": self.month_gender.nbytes,
+            "postal_code_ids": self.postal_code_ids.nbytes,
+        }
+        return {**arrays, "total": sum(arrays.values())}
+
+    def can_append(self, store: ColumnStore) -> bool:
+        return (
+            np.array_equal(store.postal_code_ids, self.postal_code_ids)
+            and (not len(store) or int(store.months[0]) > self.last_month)
+        )
+
+    def append(self, store: ColumnStore) -> 'PrefixSumCube':
+        """Returns a cube extended with the payments of `store`, which must all be after `last_month`"""
+        if not self.can_append(store):
+            raise ValueError("Only payments of later months and known postal codes can be appended")
+
+        new = PrefixSumCube.from_store(store, first_month=self.last_month + 1)
+
+        def extend(old: 'np.ndarray', appended: 'np.ndarray') -> 'np.ndarray':
+            return np.concatenate([old, old[-1] + appended[1:]])
+
+        return PrefixSumCube(
+            first_month=self.first_month,
+            postal_code_ids=self.postal_code_ids,
+            cumulative=extend(self.cumulative, new.cumulative),
+            cumulative_age_gender=extend(self.cumulative_age_gender, new.cumulative_age_gender),
+            cumulative_total=extend(self.cumulative_total, new.cumulative_total),
+            cumulative_counts=extend(self.cumulative_counts, new.cumulative_counts),
+            month_gender=np.concatenate([self.month_gender, new.month_gender]),
+        )
+
+    def rows_between(self, start_date: date, end_date: date) -> T.Tuple[int, int]:
+        """Bounds of the range in the cumulative arrays, `cumulative[stop] - cumulative[start]`"""
+        first, last = ColumnStore.month_bounds(start_date, end_date)
+
+        start = min(max(first - self.first_month, 0), len(self))
+        stop = min(max(last - self.first_month + 1, 0), len(self))
+
+        return start, max(start, stop)
+
+    def total(self, start_date: date, end_date: date) -> float:
+        start, stop = self.rows_between(start_date, end_date)
+        return float(self.cumulative_total[stop] - self.cumulative_total[start])
+
+    def by_age_and_gender(self, start_date: date, end_date: date) -> 'np.ndarray':
+        start, stop = self.rows_between(start_date, end_date)
+        return self.cumulative_age_gender[stop] - self.cumulative_age_gender[start]
+
+    def by_month_and_gender(self, start_date: date, end_date: date) -> T.Tuple[int, 'np.ndarray']:
+        first, last = ColumnStore.month_bounds(start_date, end_date)
+        start, stop = self.rows_between(start_date, end_date)
+
+        sums = np.zeros((max(last - first + 1, 0), len(GENDERS)))
+        offset = self.first_month + start - first
+        sums[offset:offset + stop - start] = self.month_gender[start:stop]
+
+        return first, sums
+
+    def by_postal_code_age_and_gender(self, start_date: date, end_date: date) -> T.Tuple['np.ndarray', 'np.ndarray']:
+        start, stop = self.rows_between(start_date, end_date)
+        present = np.flatnonzero(self.cumulative_counts[stop] - self.cumulative_counts[start])
+
+        return present, self.cumulative[stop][present] - self.cumulative[start][present]
+
+    def group_by(
+            self, start_date: date, end_date: date, dimensions: T.Iterable[Dimension],
+    ) -> T.Tuple[int, 'np.ndarray', 'np.ndarray']:
+        first, last = ColumnStore.month_bounds(start_date, end_date)
+        start, stop = self.rows_between(start_date, end_date)
+        offset = self.first_month + start - first
+
+        if Dimension.Month in dimensions:
+            sums = np.zeros((max(last - first + 1, 0), *self.cumulative.shape[1:]))
+            sums[offset:offset + stop - start] = np.diff(self.cumulative[start:stop + 1], axis=0)
+        else:
+            sums = (self.cumulative[stop] - self.cumulative[start])[np.newaxis]
+
+        counts = self.cumulative_counts[stop] - self.cumulative_counts[start]
+
+        return first, _sum_other_axes(sums, dimensions), counts
+
+
+def _sum_other_axes(cube: 'np.ndarray', dimensions: T.Iterable[Dimension]) -> 'np.ndarray':
+    """Sums a month x postal code x age x gender cube over the axes not in `dimensions`"""
+    dimensions = set(dimensions)
+    return cube.sum(axis=tuple(i for i, axis in enumerate(AXES) if axis not in dimensions))
+
+
+def _prefix_sum(monthly: 'np.ndarray') -> 'np.ndarray':
+    cumulative = np.zeros((len(monthly) + 1, *monthly.shape[1:]), dtype=monthly.dtype)
+    np.cumsum(monthly, axis=0, out=cumulative[1:])
+    return cumulative
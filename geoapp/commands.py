@@ -0,0 +1,63 @@
+from datetime import datetime
+import typing as T
+
+import click
+
+from config import settings
+from geoapp import db
+from geoapp.loader import TABLES, CsvLoader, ingest_payments
+
+
+@click.command('load-data')
+@click.argument('table', type=click.Choice(list(TABLES), case_sensitive=False))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--workers', default=settings.data.load_workers, show_default=True,
+              help="Connections copying chunks in parallel")
+@click.option('--chunk-size', default=settings.data.load_chunk_size, show_default=True,
+              help="Rows validated and sent per COPY")
+@click.option('--max-errors', default=0, show_default=True,
+              help="Invalid rows skipped before aborting the load")
+def load_data(table: str, path: str, workers: int, chunk_size: int, max_errors: int):
+    """Streams the CSV file at PATH into TABLE, from this machine to the database"""
+    loader = CsvLoader(db.database, chunk_size=chunk_size, workers=workers, max_errors=max_errors)
+    report = loader.load(table, path)
+    click.echo(str(report))
+
+    if report.table != 'Payments':
+        db.data_version.bump(db=db.database)
+        return
+
+    db.partition_payments(db.database)
+    db.refresh_rollups(db.database)
+
+    # Payments only add to the months they fall in, what is read from postal codes is left alone
+    months = [month for month, in db.database.execute_query("SELECT DISTINCT p_month FROM PaymentsByMonth")]
+    db.data_version.bump(months=months, db=db.database)
+
+
+@click.command('init-data')
+def init_data():
+    """Loads the configured CSV files into the tables still empty, to run once before serving"""
+    db.load_initial_data(db.database, settings)
+
+
+@click.command('reload-payments')
+@click.option('--month', 'months', multiple=True, type=click.DateTime(formats=['%Y-%m']),
+              help="Month whose payments changed, repeated for several. All of them when missing")
+def reload_payments(months: T.Tuple[datetime, ...]):
+    """Has serving processes read payments again, after the CSV files they are read from changed"""
+    changed = [month.date() for month in months] or None
+    version = db.data_version.bump(months=changed, db=db.database)
+    click.echo(f"Data version {version}")
+
+
+@click.command('ingest-payments')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--chunk-size', default=settings.data.load_chunk_size, show_default=True,
+              help="Rows validated and sent per COPY")
+@click.option('--max-errors', default=0, show_default=True,
+              help="Invalid rows skipped before aborting the ingestion")
+def ingest_payments_command(path: str, chunk_size: int, max_errors: int):
+    """Adds the payments in the CSV file at PATH, replacing those with the same id"""
+    report = ingest_payments(path, db.database, chunk_size=chunk_size, max_errors=max_errors)
+    click.echo(str(report))
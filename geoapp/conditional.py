@@ -0,0 +1,84 @@
+import contextlib
+import contextvars
+from datetime import datetime
+import hashlib
+import threading
+import typing as T
+
+from werkzeug.http import http_date, quote_etag
+from werkzeug.wrappers import Request
+
+from geoapp import db
+
+# Set while a response is computed, for whatever serves it data from before the current version to say so
+_stale: contextvars.ContextVar[T.Optional[threading.Event]] = contextvars.ContextVar('stale', default=None)
+
+# Data older than the version can't be validated by it, nor should anyone keep it
+STALE_HEADERS = {'Cache-Control': 'no-store', 'Vary': 'Accept'}
+
+
+class Validators(T.NamedTuple):
+    """What tells a client whether its copy of a query response is still current.
+
+    Query responses only change when the data does, so they are validated by the data version rather than
+    by their body: a client holding the response can be answered before anything is computed.
+    """
+    etag: str
+    last_modified: datetime
+
+    @classmethod
+    def of(cls, request: Request, version: db.DataVersion = None) -> 'Validators':
+        """Validators of the response to `request` at the current data version"""
+        if version is None:
+            version = db.data_version
+
+        # Every URL and format of a response gets its own tag, should anyone send it along with another
+        representation = hashlib.sha1(
+            f"{request.full_path}\n{request.headers.get('Accept', '')}".encode()
+        ).hexdigest()[:16]
+
+        # HTTP dates have no fractions of a second
+        return cls(f"{version.current()}-{representation}", version.updated_at.replace(microsecond=0))
+
+    def matches(self, request: Request) -> bool:
+        """Whether the client holds the current response, by `If-None-Match` or else by `If-Modified-Since`"""
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(self.etag)
+
+        if request.if_modified_since is not None:
+            return self.last_modified <= request.if_modified_since
+
+        return False
+
+    @property
+    def headers(self) -> T.Dict[str, str]:
+        return {
+            # Responses of the same data are equivalent, not necessarily the same bytes once compressed
+            'ETag': quote_etag(self.etag, weak=True),
+            'Last-Modified': http_date(self.last_modified),
+            # Clients may keep responses, as long as they check they are current before using them
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept',
+        }
+
+
+@contextlib.contextmanager
+def tracking_staleness() -> T.Iterator[threading.Event]:
+    """Within the block, the event is set if the response being computed is served outdated data.
+    Blocks may nest, outer ones are told as well."""
+    stale = threading.Event()
+    token = _stale.set(stale)
+    try:
+        yield stale
+    finally:
+        _stale.reset(token)
+
+        if stale.is_set():
+            served_stale()
+
+
+def served_stale():
+    """Tells the response being computed, if any, that it holds data from before the current version"""
+    stale = _stale.get()
+    if stale is not None:
+        stale.set()
@@ -1,19 +1,46 @@
 import abc
+import asyncio
+import contextlib
 import csv
+from datetime import date, datetime
+import itertools
 import logging
+import os
+import re
+import threading
+import time
 import typing as T
 
 import psycopg2
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, ISOLATION_LEVEL_READ_COMMITTED
+from psycopg2 import errorcodes
+import psycopg2.errors
+from psycopg2.extensions import (
+    connection as PsycopgBaseConnection,
+    ISOLATION_LEVEL_AUTOCOMMIT,
+    ISOLATION_LEVEL_READ_COMMITTED,
+    TRANSACTION_STATUS_IDLE,
+    TRANSACTION_STATUS_UNKNOWN,
+)
 from tenacity import Retrying, wait_exponential, stop_after_attempt
 
+try:
+    import asyncpg
+except ImportError:  # pragma: no cover
+    asyncpg = None
+
 from config.config import Config, DatabaseConfig, settings
+from geoapp import metrics
 
 logger = logging.getLogger(__name__)
+# Queries slower than `DatabaseConfig.slow_query_threshold`, to route them apart
+slow_query_logger = logging.getLogger(f"{__name__}.slow")
 
 
 PsycopgConnection = T.Type[T.Any]
 
+# What replicas cancel queries conflicting with the changes they replay with
+RECOVERY_CONFLICTS = {errorcodes.SERIALIZATION_FAILURE, errorcodes.DEADLOCK_DETECTED}
+
 
 class DatabaseError(Exception):
     pass
@@ -27,13 +54,21 @@ class DatabaseNotInitialized(DatabaseError):
     pass
 
 
+class PoolTimeout(DatabaseError):
+    pass
+
+
 class InvalidDatabaseClass(Exception):
     pass
 
 
+class AsyncpgNotInstalled(DatabaseError):
+    pass
+
+
 class Database(abc.ABC):
     def __init__(self, config: DatabaseConfig = None):
-        self.config: config
+        self.config = config
 
         if config:
             self.init(config)
@@ -46,11 +81,20 @@ class Database(abc.ABC):
         return self.config.database
 
     @abc.abstractmethod
-    def execute_query(self, query: str, params: str) -> T.List:
+    def execute_query(self, query: str, params: str, name: str = None, prepare: bool = False) -> T.List:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def execute_statement(self, query: str, params: T.Tuple = None, name: str = None):
         raise NotImplementedError
 
     @abc.abstractmethod
-    def execute_statement(self, query: str, params: T.Tuple = None):
+    def stream_query(
+            self, query: str, params: T.Tuple = None, itersize: int = None, name: str = None) -> T.Iterator[T.Tuple]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def copy_rows(self, table: str, columns: T.Sequence[str], chunks: T.Iterable[T.IO]):
         raise NotImplementedError
 
     @abc.abstractmethod
@@ -61,6 +105,16 @@ class Database(abc.ABC):
     def init(self, config: Config):
         pass
 
+    def after_fork(self):
+        """Forgets the connections inherited from the parent process, new ones are opened on first use"""
+
+    def reader(self) -> 'Database':
+        """Where to run read-only queries that can do with data slightly behind, this same database by default"""
+        return self
+
+    def data_changed(self, version: int, months: T.Optional[T.List[date]]):
+        """Called when the data version changes, by this process or any other"""
+
     @abc.abstractmethod
     def atomic(self, effect: str = 'commit'):
         raise NotImplementedError
@@ -82,18 +136,64 @@ class Database(abc.ABC):
         raise NotImplementedError
 
 
+class _Measure:
+    rows = 0
+
+
+class StatementConnection(PsycopgBaseConnection):
+    """psycopg2 connection keeping track of the statements prepared on its session, and of its `atomic()` block"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared: T.Set[str] = set()
+        # Within an `atomic()` block, statements are part of its transaction rather than committed one by one
+        self.atomic = False
+
+
+class Statement(T.NamedTuple):
+    """A query registered to run as a prepared statement"""
+    # Server-side name, that of the query numbered, as the same name may come with different SQL
+    name: str
+    query: str
+    # Labels its metrics
+    query_name: str
+
+    @property
+    def prepare(self) -> str:
+        return f"PREPARE {self.name} AS {_numbered_placeholders(self.query)}"
+
+    @property
+    def execute(self) -> str:
+        params = self.query.replace('%%', '').count('%s')
+        return f"EXECUTE {self.name} ({', '.join(['%s'] * params)})" if params else f"EXECUTE {self.name}"
+
+
 class PostgresDatabase(Database):
+    # Numbers the server-side cursors opened by `stream_query`, their names must be unique
+    _cursor_ids = itertools.count()
+    # Numbers the savepoints of nested `atomic()` blocks
+    _savepoint_ids = itertools.count()
+
     def __init__(self, config: DatabaseConfig = None):
         self._conn: T.Optional[PsycopgConnection] = None
+        # Queries run with `prepare`, by SQL. Every connection prepares each of them on its first run
+        self.statements: T.Dict[str, Statement] = {}
+        self._statement_ids = itertools.count()
+        self._statements_lock = threading.Lock()
         super().__init__(config)
 
     def shutdown(self):
-        self._conn.rollback()
-        self._conn.close()
+        if self._conn:
+            self._conn.rollback()
+            self._conn.close()
+            self._conn = None
+
+    def after_fork(self):
+        if self._conn:
+            _detach(self._conn)
+            self._conn = None
 
-    def _set_autocommit(self, autocommit: bool):
-        self._conn.commit()
-        self._conn.autocommit = autocommit
+        self._statements_lock = threading.Lock()
 
     def init(self, config: Config):
         if self._conn:
@@ -109,42 +209,239 @@ class PostgresDatabase(Database):
             with attempt:
                 self._conn = self._init_conn()
 
+    @contextlib.contextmanager
     def atomic(self, effect: str = 'commit'):
+        """Runs the statements of the block in a single transaction, committed when it exits with `effect`
+        `commit` and rolled back otherwise, or when it raises. Blocks within blocks are savepoints."""
         assert effect in ['commit', 'rollback'], f"Effect must be either `commit` or `rollback`. Got `{effect}`"
 
-        class atomic:
-            def __enter__(self_):
-                self_._old_state = self._conn.autocommit
-                self._set_autocommit(False)
+        with self._atomic(self._connected(), effect):
+            yield
+
+    def execute_query(
+            self, query: str, params: T.Tuple = None, name: str = None, prepare: bool = False) -> T.List[T.Tuple]:
+        """Runs a query and fetches its rows. `name` labels its metrics, `unnamed` when missing.
+
+        With `prepare`, the query is registered in `statements` and parsed once per connection, as a prepared
+        statement every later run only executes. Only worth it for queries run over and over.
+        """
+        if prepare and self.config.prepare_statements:
+            return self._execute_prepared(self.register_statement(query, name), params)
+
+        with self._connection() as connection:
+            with self._transaction(connection) as conn:
+                with conn.cursor() as cursor, self._measured(query, name) as measure:
+                    cursor.execute(query, params)
+                    rows = cursor.fetchall()
+                    measure.rows = len(rows)
+
+                    return rows
+
+    def execute_statement(self, query: str, params: T.Tuple = None, name: str = None):
+        with self._connection() as connection:
+            with self._transaction(connection) as conn:
+                with conn.cursor() as cursor, self._measured(query, name):
+                    cursor.execute(query, params)
+
+    def stream_query(
+            self, query: str, params: T.Tuple = None, itersize: int = None, name: str = None) -> T.Iterator[T.Tuple]:
+        """Yields the rows of a query from a server-side cursor, fetching `itersize` rows at a time.
+
+        The connection is held until the generator is exhausted or closed, so consume it promptly. Its
+        metrics time it until then, consumer included.
+        """
+        with self._connection() as connection:
+            with self._transaction(connection) as conn:
+                with conn.cursor(name=f"stream_{next(self._cursor_ids)}") as cursor, \
+                        self._measured(query, name) as measure:
+                    cursor.itersize = itersize or self.config.stream_itersize
+                    cursor.execute(query, params)
+
+                    for row in cursor:
+                        measure.rows += 1
+                        yield row
+
+    def register_statement(self, query: str, name: str = None) -> Statement:
+        """The statement `query` runs as, registered on its first call"""
+        statement = self.statements.get(query)
+        if statement is not None:
+            return statement
+
+        with self._statements_lock:
+            if query not in self.statements:
+                name = name or 'unnamed'
+                server_name = f"{re.sub(r'[^a-z0-9_]', '_', name.lower())}_{next(self._statement_ids)}"
+                self.statements[query] = Statement(server_name, query, name)
+
+        return self.statements[query]
+
+    def _execute_prepared(self, statement: Statement, params: T.Tuple) -> T.List[T.Tuple]:
+        for attempt in range(2):
+            with self._connection() as connection:
+                try:
+                    with self._transaction(connection) as conn:
+                        with conn.cursor() as cursor, self._measured(statement.query, statement.query_name) as measure:
+                            if statement.name in conn.prepared:
+                                reused = True
+                            else:
+                                self._prepare(cursor, statement)
+                                conn.prepared.add(statement.name)
+                                reused = False
+
+                            cursor.execute(statement.execute, params)
+                            rows = cursor.fetchall()
+                            measure.rows = len(rows)
+                except (psycopg2.errors.InvalidSqlStatementName, psycopg2.errors.FeatureNotSupported) as ex:
+                    # Dropped from the session, or its tables changed in a way its plan can't follow. Within an
+                    # `atomic()` block the error aborted the transaction, trying again is up to the caller.
+                    if statement.name not in connection.prepared or attempt or connection.atomic:
+                        raise
+
+                    logger.info(f"Preparing {statement.name} again: {ex}")
+                    self._deallocate(connection, statement)
+                    continue
+
+            if reused:
+                metrics.statement_reuses.inc(query=statement.query_name)
+                count = metrics.statement_prepare_duration.count(query=statement.query_name)
+                if count:
+                    saved = metrics.statement_prepare_duration.sum(query=statement.query_name) / count
+                    metrics.statement_seconds_saved.inc(saved, query=statement.query_name)
+
+            return rows
+
+    def _prepare(self, cursor: psycopg2.extensions.cursor, statement: Statement):
+        with metrics.statement_prepare_duration.time(query=statement.query_name):
+            cursor.execute(statement.prepare)
+        metrics.statement_preparations.inc(query=statement.query_name)
+
+    def _deallocate(self, conn: StatementConnection, statement: Statement):
+        conn.prepared.discard(statement.name)
+
+        try:
+            with conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(f"DEALLOCATE {statement.name}")
+        except psycopg2.errors.InvalidSqlStatementName:
+            pass
+
+    def copy_rows(self, table: str, columns: T.Sequence[str], chunks: T.Iterable[T.IO]):
+        """Copies CSV `chunks` into the `columns` of `table` through `COPY ... FROM STDIN`.
+
+        Every chunk is a `COPY` of its own, all of them within a single transaction.
+        """
+        query = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+
+        with self._connection() as connection:
+            with self._transaction(connection) as conn:
+                with conn.cursor() as cursor:
+                    for chunk in chunks:
+                        cursor.copy_expert(query, chunk)
+
+    @contextlib.contextmanager
+    def _atomic(self, conn: StatementConnection, effect: str) -> T.Iterator[None]:
+        if conn.atomic:
+            savepoint = f"atomic_{next(self._savepoint_ids)}"
+            with conn.cursor() as cursor:
+                cursor.execute(f"SAVEPOINT {savepoint}")
 
-            def __exit__(self_, *args, **kwargs):
-                self._set_autocommit(self_._old_state)
-                getattr(self._conn, effect)()
-        
-        return atomic()
+            try:
+                yield
+            except BaseException:
+                with conn.cursor() as cursor:
+                    cursor.execute(f"ROLLBACK TO SAVEPOINT {savepoint}")
+                raise
 
-    def execute_query(self, query: str, params: T.Tuple = None) -> T.List[T.Tuple]:
-        with self._conn as conn:
             with conn.cursor() as cursor:
-                cursor.execute(query, params)
-                return cursor.fetchall()
+                if effect == 'rollback':
+                    cursor.execute(f"ROLLBACK TO SAVEPOINT {savepoint}")
+                else:
+                    cursor.execute(f"RELEASE SAVEPOINT {savepoint}")
+            return
 
-    def execute_statement(self, query: str, params: T.Tuple = None):
-        with self._conn as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(query, params)
+        autocommit = conn.autocommit
+        conn.commit()
+        conn.autocommit = False
+        conn.atomic = True
+
+        try:
+            yield
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            getattr(conn, effect)()
+        finally:
+            conn.atomic = False
+            if not conn.closed:
+                conn.autocommit = autocommit
+
+    @contextlib.contextmanager
+    def _transaction(self, conn: StatementConnection) -> T.Iterator[StatementConnection]:
+        """The transaction statements run in: that of the `atomic()` block `conn` is in, or one of their own"""
+        if conn.atomic:
+            yield conn
+            return
+
+        try:
+            yield conn
+        except Exception:
+            # A dropped connection can't roll back, let the error that dropped it through instead
+            if not conn.closed:
+                conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+    @contextlib.contextmanager
+    def _measured(self, query: str, name: T.Optional[str]) -> T.Iterator['_Measure']:
+        """Times a query and records its metrics, along with the rows the caller counts in the measure"""
+        name = name or 'unnamed'
+        measure = _Measure()
+        started = time.perf_counter()
+
+        try:
+            yield measure
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.query_duration.observe(elapsed, query=name)
+            metrics.query_rows.observe(measure.rows, query=name)
+
+            threshold = self.config.slow_query_threshold
+            if threshold is not None and elapsed >= threshold:
+                metrics.slow_queries.inc(query=name)
+                slow_query_logger.warning(
+                    f"Query {name} took {elapsed * 1000:.1f} ms for {measure.rows} rows: {' '.join(query.split())}"
+                )
+
+    @contextlib.contextmanager
+    def _connection(self) -> T.Iterator[PsycopgConnection]:
+        yield self._connected()
+
+    def _connected(self) -> PsycopgConnection:
+        # Reconnects after `shutdown` or a fork
+        if self._conn is None:
+            self._conn = self._connect()
+
+        return self._conn
 
     def _init_conn(self) -> PsycopgConnection:
         logger.info("Initializing to database")
 
         self.create_database_if_not_exists()
 
+        return self._connect()
+
+    def _connect(self) -> PsycopgConnection:
         conn = psycopg2.connect(
             host=self.config.host,
             port=self.config.port,
             user=self.config.user,
             database=self.config.database,
-            password=self.config.password
+            password=self.config.password,
+            connect_timeout=self.config.connect_timeout,
+            options=f"-c plan_cache_mode={self.config.plan_cache_mode}" if self.config.plan_cache_mode else None,
+            connection_factory=StatementConnection,
         )
 
         if not conn:
@@ -207,27 +504,729 @@ class PostgresDatabase(Database):
         conn.close()
 
 
+class ConnectionPool:
+    """Thread-safe pool of psycopg2 connections.
+
+    Connections are handed out LIFO so idle ones can be recycled by the server. When `health_check`
+    is set, every connection is pinged before being borrowed and silently replaced if it's gone.
+    """
+
+    def __init__(
+            self,
+            connect: T.Callable[[], PsycopgConnection],
+            min_size: int = 1,
+            max_size: int = 10,
+            timeout: float = 30.0,
+            health_check: bool = True,
+    ):
+        assert 0 <= min_size <= max_size, f"Invalid pool size bounds: min={min_size} max={max_size}"
+
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check = health_check
+
+        self._idle: T.List[PsycopgConnection] = []
+        # Every connection opened, borrowed or idle, to detach them all after a fork
+        self._connections: T.Set[PsycopgConnection] = set()
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        for _ in range(min_size):
+            self._idle.append(self._open())
+            self._size += 1
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def getconn(self, timeout: float = None) -> PsycopgConnection:
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise DatabaseError("Connection pool is closed")
+
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+
+                if self._size < self.max_size:
+                    # Reserve the slot now, connect outside the lock
+                    self._size += 1
+                    conn = None
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"Could not get a connection within {timeout}s")
+
+                self._cond.wait(remaining)
+
+        if conn is not None and self._is_healthy(conn):
+            return conn
+
+        if conn is not None:
+            logger.warning("Discarding broken connection")
+            self._close(conn)
+
+        try:
+            return self._open()
+        except Exception:
+            self._release_slot()
+            raise
+
+    def putconn(self, conn: PsycopgConnection, discard: bool = False):
+        if not discard and not conn.closed:
+            status = conn.get_transaction_status()
+
+            if status == TRANSACTION_STATUS_UNKNOWN:
+                discard = True
+            elif status != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+
+        if discard or conn.closed:
+            self._close(conn)
+            self._release_slot()
+            return
+
+        with self._cond:
+            if self._closed:
+                self._size -= 1
+                self._close(conn)
+            else:
+                self._idle.append(conn)
+
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+
+        for conn in idle:
+            self._close(conn)
+
+    def detach(self):
+        """Gives up every connection without ending their sessions, which belong to the parent process after a fork"""
+        self._closed = True
+        self._idle = []
+
+        for conn in self._connections:
+            _detach(conn)
+        self._connections = set()
+
+    def _open(self) -> PsycopgConnection:
+        conn = self._connect()
+        self._connections.add(conn)
+        return conn
+
+    def _is_healthy(self, conn: PsycopgConnection) -> bool:
+        if conn.closed:
+            return False
+
+        if not self.health_check:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            if not conn.autocommit:
+                conn.rollback()
+        except psycopg2.Error:
+            return False
+
+        return True
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _close(self, conn: PsycopgConnection):
+        self._connections.discard(conn)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+
+class PooledPostgresDatabase(PostgresDatabase):
+    """Postgres adapter backed by a `ConnectionPool`, safe to share between threads.
+
+    Every query borrows a connection for its own duration, except inside `atomic()`, where the
+    calling thread keeps the same connection until the block exits. The pool is opened on first use,
+    so processes forked after `init` each open their own.
+
+    Lost connections are only recovered from while borrowing: the pool pings and replaces them, and
+    retries connecting. A query failing once sent is never run again, the server may have applied it.
+    """
+
+    def __init__(self, config: DatabaseConfig = None):
+        self._pool: T.Optional[ConnectionPool] = None
+        self._pool_lock = threading.Lock()
+        self._local = threading.local()
+        super().__init__(config)
+
+    def init(self, config: DatabaseConfig):
+        self.shutdown()
+        self.config = config
+
+        for attempt in Retrying(
+                stop=stop_after_attempt(4),
+                wait=wait_exponential(),
+                reraise=True
+        ):
+            with attempt:
+                self.create_database_if_not_exists()
+
+    def shutdown(self):
+        if self._pool:
+            self._pool.close()
+            self._pool = None
+
+    def after_fork(self):
+        super().after_fork()
+
+        if self._pool:
+            self._pool.detach()
+            self._pool = None
+
+        # Whatever the forking thread held is gone along with the other threads
+        self._pool_lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def atomic(self, effect: str = 'commit'):
+        """`PostgresDatabase.atomic`, the calling thread keeping the same connection until the outermost block exits"""
+        assert effect in ['commit', 'rollback'], f"Effect must be either `commit` or `rollback`. Got `{effect}`"
+
+        pinned = getattr(self._local, 'conn', None)
+        if pinned is not None:
+            with self._atomic(pinned, effect):
+                yield
+            return
+
+        pool = self._get_pool()
+        conn = pool.getconn()
+        self._local.conn = conn
+        broken = False
+        try:
+            with self._atomic(conn, effect):
+                yield
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self._local.conn = None
+            pool.putconn(conn, discard=broken or bool(conn.closed))
+
+    @contextlib.contextmanager
+    def _connection(self) -> T.Iterator[PsycopgConnection]:
+        pinned = getattr(self._local, 'conn', None)
+        if pinned is not None:
+            yield pinned
+            return
+
+        pool = self._get_pool()
+        conn = pool.getconn()
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            pool.putconn(conn, discard=broken or bool(conn.closed))
+
+    def _get_pool(self) -> ConnectionPool:
+        if self._pool is None:
+            if self.config is None:
+                raise DatabaseNotInitialized
+
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ConnectionPool(
+                        connect=self._connect_with_retries,
+                        min_size=self.config.pool_min_size,
+                        max_size=self.config.pool_max_size,
+                        timeout=self.config.pool_timeout,
+                        health_check=self.config.pool_health_check,
+                    )
+
+        return self._pool
+
+    def _connect_with_retries(self) -> PsycopgConnection:
+        for attempt in Retrying(
+                stop=stop_after_attempt(4),
+                wait=wait_exponential(),
+                reraise=True
+        ):
+            with attempt:
+                return self._connect()
+
+
+class ReplicaDatabase(PooledPostgresDatabase):
+    """A read-only copy of the primary database, along with what its last check found.
+
+    A replica down is skipped rather than waited for, so connecting to it isn't retried.
+    """
+
+    CHECK_QUERY = (
+        "SELECT "
+        "(SELECT version FROM DataVersion WHERE id = 1), "
+        # Nothing left to replay means no lag, however long ago the last change was
+        "CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+        "ELSE EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()) END"
+    )
+
+    def __init__(self, config: DatabaseConfig):
+        super().__init__()
+        # Not `init`, creating the database is up to the primary
+        self.config = config
+
+        self.healthy = False
+        # Seconds behind the primary and data version, unknown until checked
+        self.lag: T.Optional[float] = None
+        self.version: T.Optional[int] = None
+
+    @property
+    def address(self) -> str:
+        return f"{self.config.host}:{self.config.port or 5432}"
+
+    def readable(self, max_lag: float, version: T.Optional[int]) -> bool:
+        """Whether it answered the last check, close enough behind the primary and with its data `version`"""
+        if not self.healthy or self.lag is None or self.lag > max_lag:
+            return False
+
+        return version is None or (self.version is not None and self.version >= version)
+
+    def check(self):
+        try:
+            self.version, lag = self.execute_query(self.CHECK_QUERY, name='replica_check')[0]
+        except (psycopg2.Error, DatabaseError) as ex:
+            self.mark_down(ex)
+            return
+
+        # Unknown when it never replayed anything since it started
+        self.lag = None if lag is None else float(lag)
+        if not self.healthy:
+            logger.info(f"Replica {self.address} is up, {self.lag}s behind")
+        self.healthy = True
+
+    def mark_down(self, error: Exception):
+        if self.healthy:
+            logger.warning(f"Replica {self.address} is down: {error}")
+
+        self.healthy = False
+        self.lag = None
+        self.version = None
+
+    def _connect_with_retries(self) -> PsycopgConnection:
+        return self._connect()
+
+
+class ReplicatedPostgresDatabase(PooledPostgresDatabase):
+    """`PooledPostgresDatabase` on the primary, spreading the queries of `reader()` over `replicas` of the config.
+
+    Replicas are checked from a background thread every `replica_check_interval` seconds, and right after
+    the data version changes, so reads never wait for a replica to answer. They go round-robin to those
+    answering the last check, lagging at most `replica_max_lag` seconds behind and holding the data version
+    of the primary, and to the primary itself when none does. Everything else, writes and loads included,
+    runs on the primary.
+    """
+
+    def __init__(self, config: DatabaseConfig = None):
+        self.replicas: T.List[ReplicaDatabase] = []
+        self._primary_version: T.Optional[int] = None
+        self._checked_at: T.Optional[float] = None
+        self._check_lock = threading.Lock()
+        self._checker: T.Optional[threading.Thread] = None
+        self._checker_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._turns = itertools.count()
+        super().__init__(config)
+
+    def init(self, config: DatabaseConfig):
+        super().init(config)
+
+        self.replicas = [
+            ReplicaDatabase(config.copy(update={
+                'host': replica.host,
+                'port': replica.port or config.port,
+                'connect_timeout': replica.connect_timeout,
+                'replicas': [],
+            }))
+            for replica in config.replicas
+        ]
+        self._checked_at = None
+
+    def shutdown(self):
+        self._stop_checker()
+        super().shutdown()
+
+        for replica in self.replicas:
+            replica.shutdown()
+
+    def after_fork(self):
+        super().after_fork()
+
+        for replica in self.replicas:
+            replica.after_fork()
+        # The checker thread is gone along with the other threads
+        self._check_lock = threading.Lock()
+        self._checker = None
+        self._checker_lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def reader(self) -> 'ReplicaReader':
+        return ReplicaReader(self)
+
+    def data_changed(self, version: int, months: T.Optional[T.List[date]]):
+        # Replicas may not have replayed the change yet
+        self._wake.set()
+
+    def read_targets(self) -> T.Iterator[PooledPostgresDatabase]:
+        """The replicas readable as of the last check, starting with the next one's turn, then the primary"""
+        self._start_checker()
+
+        readable = [
+            replica for replica in self.replicas
+            if replica.readable(self.config.replica_max_lag, self._primary_version)
+        ]
+        if readable:
+            turn = next(self._turns) % len(readable)
+            yield from readable[turn:] + readable[:turn]
+
+        yield self
+
+    def check_replicas(self):
+        """Checks the primary's data version and the replicas, after any check already under way"""
+        if not self.replicas:
+            return
+
+        with self._check_lock:
+            try:
+                self._primary_version = self.execute_query(
+                    "SELECT version FROM DataVersion WHERE id = 1", name='replica_check'
+                )[0][0]
+            except (psycopg2.Error, DatabaseError) as ex:
+                # Replicas keep serving reads while the primary is down, however far behind it
+                logger.warning(f"Could not read the data version of the primary: {ex}")
+                self._primary_version = None
+
+            for replica in self.replicas:
+                replica.check()
+
+            self._checked_at = time.monotonic()
+
+    def _start_checker(self):
+        """Starts checking the replicas in the background, again in a forked process"""
+        if not self.replicas or (self._checker is not None and self._checker.is_alive()):
+            return
+
+        with self._checker_lock:
+            if self._checker is None or not self._checker.is_alive():
+                self._checker = threading.Thread(target=self._check_periodically, name='replica-checker', daemon=True)
+                self._checker.start()
+
+    def _stop_checker(self):
+        checker, self._checker = self._checker, None
+        if checker is not None:
+            self._wake.set()
+
+    def _check_periodically(self):
+        while self._checker is threading.current_thread():
+            due_in = 0.0 if self._checked_at is None else (
+                self._checked_at + self.config.replica_check_interval - time.monotonic()
+            )
+            if due_in <= 0 or self._wake.wait(due_in):
+                self._wake.clear()
+                if self._checker is threading.current_thread():
+                    self.check_replicas()
+
+
+class ReplicaReader:
+    """Runs read-only queries on the replicas of a `ReplicatedPostgresDatabase`, or its primary.
+
+    A replica that can't be reached is marked down and the query moves on to the next one, and so does a
+    query finding all connections to one busy, or cancelled by a conflict with recovery. Other errors
+    reported by the server are raised as they are.
+    """
+
+    def __init__(self, database: ReplicatedPostgresDatabase):
+        self.database = database
+
+    def execute_query(
+            self, query: str, params: T.Tuple = None, name: str = None, prepare: bool = False) -> T.List[T.Tuple]:
+        for target in self.database.read_targets():
+            try:
+                res = target.execute_query(query, params, name, prepare=prepare)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout) as ex:
+                if not self._moves_on(target, ex):
+                    raise
+                continue
+
+            metrics.replica_reads.inc(target=self._label(target))
+            return res
+
+    def stream_query(
+            self, query: str, params: T.Tuple = None, itersize: int = None, name: str = None) -> T.Iterator[T.Tuple]:
+        """Streams from the first target answering. Once rows came through, errors are raised as they are"""
+        for target in self.database.read_targets():
+            rows = target.stream_query(query, params, itersize, name)
+            try:
+                first = next(rows, None)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout) as ex:
+                if not self._moves_on(target, ex):
+                    raise
+                continue
+
+            metrics.replica_reads.inc(target=self._label(target))
+            if first is None:
+                return
+
+            try:
+                yield first
+                yield from rows
+            finally:
+                rows.close()
+            return
+
+    def _moves_on(self, target: PooledPostgresDatabase, error: Exception) -> bool:
+        if target is self.database:
+            return False
+
+        if isinstance(error, PoolTimeout):
+            return True
+
+        # Queries the replica cancelled to replay changes, the next target may well answer them
+        if error.pgcode in RECOVERY_CONFLICTS:
+            return True
+
+        if error.pgcode is not None:
+            return False
+
+        target.mark_down(error)
+        return True
+
+    def _label(self, target: PooledPostgresDatabase) -> str:
+        return 'primary' if target is self.database else target.address
+
+
+class AsyncPostgresDatabase:
+    """Postgres through asyncpg and a pool of its own, for the ASGI app.
+
+    Queries are awaited instead of holding a thread while the server works on them, so a single process can
+    have as many in flight as `async_pool_max_size`, the rest waiting for a connection just as cheaply.
+    Takes the same `%s` placeholders as the other adapters. Schema set up and loads stay with those.
+    """
+
+    _measured = PostgresDatabase._measured
+
+    def __init__(self, config: DatabaseConfig = None):
+        if asyncpg is None:
+            raise AsyncpgNotInstalled("The async database requires asyncpg")
+
+        self.config = config
+        self._pool: T.Optional['asyncpg.Pool'] = None
+
+    async def init(self, config: DatabaseConfig):
+        if self._pool:
+            await self._pool.close()
+
+        self.config = config
+        self._pool = await asyncpg.create_pool(
+            host=config.host,
+            port=config.port,
+            user=config.user,
+            database=config.database,
+            password=config.password,
+            min_size=config.async_pool_min_size,
+            max_size=config.async_pool_max_size,
+        )
+
+    async def shutdown(self):
+        if self._pool:
+            await self._pool.close()
+            self._pool = None
+
+    async def execute_query(self, query: str, params: T.Tuple = None, name: str = None) -> T.List[T.Tuple]:
+        """Runs a query and fetches its rows as tuples. `name` labels its metrics, `unnamed` when missing"""
+        query = _numbered_placeholders(query)
+
+        async with self._connection() as conn:
+            with self._measured(query, name) as measure:
+                rows = await conn.fetch(query, *(params or ()))
+                measure.rows = len(rows)
+
+        return [tuple(row) for row in rows]
+
+    async def execute_statement(self, query: str, params: T.Tuple = None, name: str = None):
+        query = _numbered_placeholders(query)
+
+        async with self._connection() as conn:
+            with self._measured(query, name):
+                await conn.execute(query, *(params or ()))
+
+    async def stream_query(
+            self, query: str, params: T.Tuple = None, itersize: int = None, name: str = None,
+    ) -> T.AsyncIterator[T.Tuple]:
+        """Yields the rows of a query from a server-side cursor, fetching `itersize` rows at a time.
+
+        The connection is held until the generator is exhausted or closed, like `PostgresDatabase.stream_query`.
+        """
+        query = _numbered_placeholders(query)
+
+        async with self._connection() as conn, conn.transaction():
+            with self._measured(query, name) as measure:
+                cursor = conn.cursor(query, *(params or ()), prefetch=itersize or self.config.stream_itersize)
+
+                async for row in cursor:
+                    measure.rows += 1
+                    yield tuple(row)
+
+    @contextlib.asynccontextmanager
+    async def _connection(self) -> T.AsyncIterator['asyncpg.Connection']:
+        if not self._pool:
+            raise DatabaseNotInitialized
+
+        try:
+            conn = await self._pool.acquire(timeout=self.config.pool_timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(f"Could not get a connection within {self.config.pool_timeout}s")
+
+        try:
+            yield conn
+        finally:
+            await self._pool.release(conn)
+
+
+class DataVersion:
+    """Monotonic stamp of the data loaded into the database, stored in the `DataVersion` table.
+
+    Derived structures (caches, rollups...) key or invalidate themselves on it. Bumps done by this
+    process notify subscribers straight away, bumps done elsewhere are picked up when the stamp is
+    re-read, at most every `check_interval` seconds.
+    """
+
+    TListener = T.Callable[[int, T.Optional[T.List[date]]], None]
+
+    def __init__(self, db: Database, check_interval: float = 1.0):
+        self.db = db
+        self.check_interval = check_interval
+
+        self._version: T.Optional[int] = None
+        self._updated_at: T.Optional[datetime] = None
+        self._checked_at = 0.0
+        self._listeners: T.List[DataVersion.TListener] = []
+        self._lock = threading.Lock()
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    def current(self) -> int:
+        if self._version is None or time.monotonic() - self._checked_at >= self.check_interval:
+            self.refresh()
+
+        return self._version
+
+    @property
+    def updated_at(self) -> datetime:
+        self.current()
+        return self._updated_at
+
+    def refresh(self):
+        res = self.db.execute_query(
+            "SELECT version, updated_at, months FROM DataVersion WHERE id = 1", name='data_version'
+        )
+        version, updated_at, months = res[0]
+
+        # The stored months only describe the last bump, what changed with any missed one is unknown
+        if self._version is None or version != self._version + 1:
+            months = None
+
+        self._set(version, updated_at, months=months)
+
+    def bump(self, months: T.Iterable[date] = None, db: Database = None) -> int:
+        """Bumps the stamp once the new data is committed. `months` narrows down what changed"""
+        if months is not None:
+            months = sorted(set(months))
+
+        res = (db or self.db).execute_query(
+            "UPDATE DataVersion SET version = version + 1, updated_at = NOW(), months = %s "
+            "WHERE id = 1 RETURNING version, updated_at",
+            (months,),
+            name='data_version_bump',
+        )
+
+        version, updated_at = res[0]
+        self._set(version, updated_at, months=months)
+
+        return version
+
+    def subscribe(self, listener: 'DataVersion.TListener'):
+        self._listeners.append(listener)
+
+    def _set(self, version: int, updated_at: datetime, months: T.Optional[T.List[date]]):
+        with self._lock:
+            changed = self._version is not None and version != self._version
+
+            self._version = version
+            self._updated_at = updated_at
+            self._checked_at = time.monotonic()
+
+        if not changed:
+            return
+
+        logger.info(f"Data version changed to {version}")
+        for listener in self._listeners:
+            listener(version, months)
+
+
 def init_tables(db: Database, config: Config):
-    logger.info("Loading SQL Script")
+    # Imported here as it builds on this module
+    from geoapp.migrations import migrate
 
-    with open('config/db.sql', 'r') as f:
-        sql = f.read()
+    logger.info("Migrating Database")
+    migrate(db)
 
-    logger.info("Initializing Database")
-    db.execute_statement(sql)
 
-    if config.test:
-        return
+def load_initial_data(db: Database, config: Config):
+    """Loads the configured CSV files into the tables still empty, then builds what derives from them.
+
+    Run by `flask init-data` before serving, as it may take long and must only run once.
+    """
+    # Imported here as it builds on this module
+    from geoapp.loader import CsvLoader
 
     logger.info("Loading data")
-    with db.atomic():
-        res = db.execute_query("SELECT COUNT(*) FROM PostalCodes")
-        if not res[0][0]:
-            load_database(db, "PostalCodes", config.data.postalcodes)
+    loaded = False
+    loader = CsvLoader(db, chunk_size=config.data.load_chunk_size, workers=config.data.load_workers)
 
-        res = db.execute_query("SELECT COUNT(*) FROM Payments")
+    # Each table is loaded in a transaction of its own, postal codes first so payments can refer to them
+    for table, path in (("PostalCodes", config.data.postalcodes), ("Payments", config.data.payments)):
+        res = db.execute_query(f"SELECT COUNT(*) FROM {table}")
         if not res[0][0]:
-            load_database(db, "Payments", config.data.payments)
+            loader.load(table, path)
+            loaded = True
+
+    if loaded:
+        partition_payments(db)
+
+    res = db.execute_query(
+        "SELECT EXISTS (SELECT 1 FROM Payments) AND NOT EXISTS (SELECT 1 FROM PaymentsByMonthPostalCode)"
+    )
+    if loaded or res[0][0]:
+        refresh_rollups(db)
+
+    if loaded:
+        data_version.bump(db=db)
 
 
 def init(config: Config) -> Database:
@@ -241,8 +1240,72 @@ def init(config: Config) -> Database:
     init_tables(database, config)
 
 
-def load_database(db: Database, table_name: str, path: str):
-    db.execute_statement(f"COPY {table_name} FROM '{path}' csv header")
+def partition_payments(db: Database) -> T.List[date]:
+    """Gives the months of payments loaded into the default partition a partition of their own"""
+    months = [month for month, in db.execute_query("SELECT partition_payments()")]
+    if months:
+        logger.info(f"Created partitions of Payments for {', '.join(month.strftime('%Y-%m') for month in months)}")
+
+    return months
+
+
+def refresh_rollups(db: Database, months: T.Iterable[date] = None):
+    """Rebuilds the Payments rollups, either entirely or only for the given months.
+
+    All of it in a single transaction, readers keep seeing the former rollups until it commits.
+    """
+    if months is None:
+        where, params = "", None
+    else:
+        where, params = "WHERE p_month = ANY(%s) ", (list(months),)
+
+    logger.info("Refreshing rollups")
+    with db.atomic():
+        db.execute_statement(f"DELETE FROM PaymentsByMonthPostalCode {where}", params)
+        db.execute_statement(
+            "INSERT INTO PaymentsByMonthPostalCode (p_month, postal_code_id, p_age, p_gender, amount) "
+            "SELECT p_month, postal_code_id, p_age, p_gender, SUM(amount) "
+            f"FROM Payments {where}"
+            "GROUP BY p_month, postal_code_id, p_age, p_gender",
+            params
+        )
+
+        # The coarser rollup is built from the finer one rather than from the raw payments
+        db.execute_statement(f"DELETE FROM PaymentsByMonth {where}", params)
+        db.execute_statement(
+            "INSERT INTO PaymentsByMonth (p_month, p_age, p_gender, amount) "
+            "SELECT p_month, p_age, p_gender, SUM(amount) "
+            f"FROM PaymentsByMonthPostalCode {where}"
+            "GROUP BY p_month, p_age, p_gender",
+            params
+        )
+
+
+def _detach(conn: PsycopgConnection):
+    """Closes a connection inherited from the parent process without ending its session.
+
+    Closing it as is would tell the server the session is over, for the parent as well, so its socket
+    is pointed at /dev/null first.
+    """
+    devnull = os.open(os.devnull, os.O_RDWR)
+    try:
+        os.dup2(devnull, conn.fileno())
+        conn.close()
+    except (OSError, psycopg2.Error):
+        pass
+    finally:
+        os.close(devnull)
+
+
+def _after_fork():
+    database.after_fork()
+    data_version.after_fork()
+
+
+def _numbered_placeholders(query: str) -> str:
+    """`query` with its `%s` placeholders numbered the way asyncpg takes them, `$1`, `$2`..."""
+    numbers = itertools.count(1)
+    return re.sub(r'%([s%])', lambda match: f"${next(numbers)}" if match.group(1) == 's' else '%', query)
 
 
 def _csv_lines(path: str) -> T.Iterable:
@@ -261,3 +1324,9 @@ if settings.db_config.database_class not in locals():
 
 database_class = locals().get(settings.db_config.database_class)
 database = database_class()
+data_version = DataVersion(database, check_interval=settings.cache.version_check_interval)
+
+data_version.subscribe(database.data_changed)
+
+# Workers of pre-fork servers must not share the connections of the process they were forked from
+os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,447 @@
+import logging
+import struct
+import threading
+import time
+import typing as T
+
+from geoapp import db, metrics
+from geoapp.spatial import Bounds, STRTree
+from geoapp.topology import Topology
+
+logger = logging.getLogger(__name__)
+
+
+TDatabase = T.Type[db.Database]
+Coordinates = T.List[T.Any]
+
+
+class InvalidGeometry(Exception):
+    pass
+
+
+WKB_TYPES = {
+    1: 'Point',
+    2: 'LineString',
+    3: 'Polygon',
+    4: 'MultiPoint',
+    5: 'MultiLineString',
+    6: 'MultiPolygon',
+}
+
+EWKB_SRID_FLAG = 0x20000000
+EWKB_Z_FLAG = 0x80000000
+EWKB_M_FLAG = 0x40000000
+
+
+class SimplificationLevel(T.NamedTuple):
+    min_zoom: int
+    tolerance: float
+    precision: T.Optional[int]
+
+
+# From full resolution to coarsest. Tolerances are in degrees, about half a pixel at `min_zoom`.
+LEVELS = (
+    SimplificationLevel(min_zoom=15, tolerance=0.0, precision=None),
+    SimplificationLevel(min_zoom=13, tolerance=0.00005, precision=5),
+    SimplificationLevel(min_zoom=11, tolerance=0.0002, precision=4),
+    SimplificationLevel(min_zoom=9, tolerance=0.0008, precision=4),
+    SimplificationLevel(min_zoom=0, tolerance=0.003, precision=3),
+)
+
+
+def level_for(zoom: int = None, tolerance: float = None) -> int:
+    """Coarsest simplification level within `tolerance`, or the one meant for `zoom`. Full resolution by default."""
+    if tolerance is not None:
+        return max(i for i, level in enumerate(LEVELS) if level.tolerance <= tolerance)
+
+    if zoom is not None:
+        return next(i for i, level in enumerate(LEVELS) if zoom >= level.min_zoom)
+
+    return 0
+
+
+def decode_wkb(wkb: T.Union[str, bytes]) -> dict:
+    """Decodes (hex) WKB or PostGIS EWKB into a GeoJSON geometry. Only 2D geometries are supported."""
+    if isinstance(wkb, str):
+        try:
+            wkb = bytes.fromhex(wkb)
+        except ValueError:
+            raise InvalidGeometry("Geometry is not hex encoded")
+
+    try:
+        geometry, _ = _read_geometry(memoryview(wkb), 0)
+    except struct.error:
+        raise InvalidGeometry("Truncated geometry")
+
+    return geometry
+
+
+def _read_geometry(buffer: memoryview, offset: int) -> T.Tuple[dict, int]:
+    order = '<' if buffer[offset] == 1 else '>'
+    (type_,) = struct.unpack_from(f'{order}I', buffer, offset + 1)
+    offset += 5
+
+    if type_ & (EWKB_Z_FLAG | EWKB_M_FLAG):
+        raise InvalidGeometry("Only 2D geometries are supported")
+
+    if type_ & EWKB_SRID_FLAG:
+        offset += 4
+
+    type_ &= 0xFFFF
+    if type_ not in WKB_TYPES:
+        raise InvalidGeometry(f"Unsupported geometry type {type_}")
+
+    name = WKB_TYPES[type_]
+
+    if name == 'Point':
+        x, y = struct.unpack_from(f'{order}2d', buffer, offset)
+        return {"type": name, "coordinates": [x, y]}, offset + 16
+
+    if name == 'LineString':
+        coordinates, offset = _read_points(buffer, offset, order)
+        return {"type": name, "coordinates": coordinates}, offset
+
+    if name == 'Polygon':
+        coordinates, offset = _read_rings(buffer, offset, order)
+        return {"type": name, "coordinates": coordinates}, offset
+
+    (count,) = struct.unpack_from(f'{order}I', buffer, offset)
+    offset += 4
+
+    parts = []
+    for _ in range(count):
+        part, offset = _read_geometry(buffer, offset)
+        parts.append(part["coordinates"])
+
+    return {"type": name, "coordinates": parts}, offset
+
+
+def _read_rings(buffer: memoryview, offset: int, order: str) -> T.Tuple[Coordinates, int]:
+    (count,) = struct.unpack_from(f'{order}I', buffer, offset)
+    offset += 4
+
+    rings = []
+    for _ in range(count):
+        ring, offset = _read_points(buffer, offset, order)
+        rings.append(ring)
+
+    return rings, offset
+
+
+def _read_points(buffer: memoryview, offset: int, order: str) -> T.Tuple[Coordinates, int]:
+    (count,) = struct.unpack_from(f'{order}I', buffer, offset)
+    offset += 4
+
+    values = struct.unpack_from(f'{order}{count * 2}d', buffer, offset)
+    points = [[values[i], values[i + 1]] for i in range(0, len(values), 2)]
+
+    return points, offset + count * 16
+
+
+def geometry_bounds(geometry: dict) -> Bounds:
+    xs, ys = [], []
+
+    def walk(coordinates: Coordinates):
+        if coordinates and isinstance(coordinates[0], (int, float)):
+            xs.append(coordinates[0])
+            ys.append(coordinates[1])
+        else:
+            for part in coordinates:
+                walk(part)
+
+    walk(geometry["coordinates"])
+
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def wkb_srid(wkb: str) -> T.Optional[int]:
+    header = bytes.fromhex(wkb[:18])
+    order = '<' if header[0] == 1 else '>'
+    (type_,) = struct.unpack_from(f'{order}I', header, 1)
+
+    if not type_ & EWKB_SRID_FLAG:
+        return None
+
+    return struct.unpack_from(f'{order}I', header, 5)[0]
+
+
+def encode_wkb(geometry: dict, srid: int = None) -> str:
+    """Encodes a GeoJSON geometry as little endian hex (E)WKB, the way PostGIS prints geometries"""
+    return _write_geometry(geometry["type"], geometry["coordinates"], srid).hex().upper()
+
+
+def _write_geometry(name: str, coordinates: Coordinates, srid: int = None) -> bytes:
+    type_ = {value: key for key, value in WKB_TYPES.items()}[name]
+
+    if srid is None:
+        wkb = struct.pack('<BI', 1, type_)
+    else:
+        wkb = struct.pack('<BII', 1, type_ | EWKB_SRID_FLAG, srid)
+
+    if name == 'Point':
+        return wkb + struct.pack('<2d', *coordinates)
+
+    if name == 'LineString':
+        return wkb + _write_points(coordinates)
+
+    if name == 'Polygon':
+        return wkb + struct.pack('<I', len(coordinates)) + b''.join(_write_points(ring) for ring in coordinates)
+
+    part = name[len('Multi'):]
+    return wkb + struct.pack('<I', len(coordinates)) + b''.join(_write_geometry(part, c) for c in coordinates)
+
+
+def _write_points(points: Coordinates) -> bytes:
+    return struct.pack(f'<I{len(points) * 2}d', len(points), *(value for point in points for value in point))
+
+
+class PostalCodeGeometry:
+    def __init__(self, id_: int, code: str, wkb: str):
+        self.id = id_
+        self.code = code
+        self.wkb = wkb
+
+        self._geojson: T.Optional[dict] = None
+        self._bounds: T.Optional[Bounds] = None
+        # Simplified GeoJSON geometries by level, set by the store
+        self.levels: T.Dict[int, dict] = {}
+        self._wkb_levels: T.Dict[int, str] = {}
+
+    @property
+    def geojson(self) -> dict:
+        if self._geojson is None:
+            self._geojson = decode_wkb(self.wkb)
+
+        return self._geojson
+
+    @property
+    def bounds(self) -> 'Bounds':
+        if self._bounds is None:
+            self._bounds = geometry_bounds(self.geojson)
+
+        return self._bounds
+
+    def render(self, geometry_format: str, level: int = 0) -> T.Union[str, dict]:
+        if level not in self.levels:
+            # Full resolution, or a geometry that couldn't be simplified
+            return self.geojson if geometry_format == 'geojson' else self.wkb
+
+        if geometry_format == 'geojson':
+            return self.levels[level]
+
+        if level not in self._wkb_levels:
+            self._wkb_levels[level] = encode_wkb(self.levels[level], wkb_srid(self.wkb))
+
+        return self._wkb_levels[level]
+
+
+class GeometryStore:
+    """Postal code geometries, read once from `PostalCodes` (or its CSV export) and kept in memory.
+
+    Lets aggregate queries return postal code ids only, the geometry being merged in afterwards.
+    Reloads lazily after the data version changes or when asked for an unknown postal code.
+    """
+
+    def __init__(
+            self,
+            database: TDatabase = None,
+            path: str = None,
+            prerender: bool = False,
+            version: db.DataVersion = None,
+            quantization: int = 100000,
+    ):
+        if database is None:
+            database = db.database
+
+        if version is None:
+            version = db.data_version
+
+        self.db = database
+        self.path = path
+        self.prerender = prerender
+        self.quantization = quantization
+
+        self._by_id: T.Optional[T.Dict[int, PostalCodeGeometry]] = None
+        # Topologies of the geometries by simplification level, built on first use
+        self._topologies: T.Dict[int, Topology] = {}
+        self._index: T.Optional[STRTree] = None
+        self._levels: T.Set[int] = set()
+        self._lock = threading.Lock()
+        # Mean time to decode a geometry, measured the first time they all are after a load
+        self._decode_seconds: T.Optional[float] = None
+        self._stats = {
+            "loads": 0,
+            "load_seconds": 0.0,
+            "requests": 0,
+            "bytes_saved": 0,
+            "decode_seconds_saved": 0.0,
+            "merge_seconds": 0.0,
+        }
+
+        version.subscribe(self._on_data_changed)
+
+    @property
+    def by_id(self) -> T.Dict[int, PostalCodeGeometry]:
+        if self._by_id is None:
+            with self._lock:
+                if self._by_id is None:
+                    self._load()
+
+        return self._by_id
+
+    def get(self, id_: int) -> PostalCodeGeometry:
+        geometries = self.by_id
+
+        if id_ not in geometries:
+            self.reload()
+            geometries = self.by_id
+
+        return geometries[id_]
+
+    def peek(self, id_: int) -> T.Optional[PostalCodeGeometry]:
+        """The geometry of `id_` if already loaded, without ever loading any"""
+        return (self._by_id or {}).get(id_)
+
+    def ids(self) -> T.List[int]:
+        return sorted(self.by_id)
+
+    @property
+    def index(self) -> STRTree:
+        """R-tree of the bounds of the postal codes, keyed by postal code id"""
+        geometries = self.by_id
+
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    decoded = self._decodable(geometries)
+                    self._index = STRTree({id_: geometries[id_].bounds for id_ in decoded})
+
+        return self._index
+
+    def ids_within(self, bounds: Bounds) -> T.List[int]:
+        """Ids of the postal codes whose bounds intersect `bounds`"""
+        return sorted(self.index.query(bounds))
+
+    def simplify(self, level: int):
+        """Precomputes simplified geometries for a level of `LEVELS`, simplifying borders shared by
+        neighbouring postal codes only once so they stay shared"""
+        if level == 0 or level in self._levels:
+            return
+
+        simplified = self.topology(level)
+        geometries = self.by_id
+
+        with self._lock:
+            if level in self._levels:
+                return
+
+            for id_, geojson in simplified.geometries().items():
+                geometries[id_].levels[level] = geojson
+
+            self._levels.add(level)
+
+    def topology(self, level: int = 0) -> Topology:
+        """Topology of the postal codes keyed by id, simplified to a level of `LEVELS`"""
+        geometries = self.by_id
+
+        with self._lock:
+            if level not in self._topologies:
+                started = time.perf_counter()
+
+                if 0 not in self._topologies:
+                    self._topologies[0] = Topology.from_geometries(self._decodable(geometries))
+
+                if level:
+                    self._topologies[level] = self._topologies[0].simplify(
+                        LEVELS[level].tolerance, LEVELS[level].precision
+                    )
+
+                logger.info(f"Built the postal code topology of level {level} in {time.perf_counter() - started:.3f}s")
+
+            return self._topologies[level]
+
+    def reload(self):
+        with self._lock:
+            self._load()
+
+    def record_request(self, bytes_saved: int, merge_seconds: float, decodes_saved: int = 0):
+        """Accounts for a request merging geometries from the store: the bytes it didn't fetch along with its
+        turnover, the geometries it didn't decode and the time merging took"""
+        decode_seconds_saved = decodes_saved * (self._decode_seconds or 0.0)
+
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["bytes_saved"] += bytes_saved
+            self._stats["decode_seconds_saved"] += decode_seconds_saved
+            self._stats["merge_seconds"] += merge_seconds
+
+        metrics.geometry_bytes_saved.inc(bytes_saved)
+        metrics.geometry_decode_seconds_saved.inc(decode_seconds_saved)
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        requests = stats["requests"] or 1
+
+        return {
+            **stats,
+            "geometries": len(self._by_id or {}),
+            "bytes": sum(len(geometry.wkb) for geometry in (self._by_id or {}).values()),
+            "bytes_saved_per_request": stats["bytes_saved"] / requests,
+            "decode_seconds_saved_per_request": stats["decode_seconds_saved"] / requests,
+            "merge_seconds_per_request": stats["merge_seconds"] / requests,
+        }
+
+    def _load(self):
+        started = time.perf_counter()
+
+        if self.path:
+            rows = ((int(id_), code, the_geom) for the_geom, code, id_ in db._csv_lines(self.path))
+        else:
+            rows = self.db.execute_query("SELECT id, code, the_geom FROM PostalCodes", name='postal_codes')
+
+        geometries = {id_: PostalCodeGeometry(id_, code, the_geom) for id_, code, the_geom in rows}
+
+        self._decode_seconds = None
+        if self.prerender:
+            self._decodable(geometries)
+
+        self._by_id = geometries
+        self._topologies = {}
+        self._index = None
+        self._levels = set()
+
+        elapsed = time.perf_counter() - started
+        self._stats["loads"] += 1
+        self._stats["load_seconds"] += elapsed
+        logger.info(f"Loaded {len(geometries)} postal code geometries in {elapsed:.3f}s")
+
+    def _decodable(self, geometries: T.Dict[int, PostalCodeGeometry]) -> T.Dict[int, dict]:
+        if self._decode_seconds is not None:
+            return _decodable(geometries)
+
+        started = time.perf_counter()
+        decoded = _decodable(geometries)
+        self._decode_seconds = (time.perf_counter() - started) / (len(geometries) or 1)
+
+        return decoded
+
+    def _on_data_changed(self, version: int, months: T.Optional[T.List]):
+        # Bumps narrowed down to months only changed payments, postal codes are left as they were
+        if months is None:
+            self._by_id = None
+
+
+def _decodable(geometries: T.Dict[int, PostalCodeGeometry]) -> T.Dict[int, dict]:
+    """Decoded polygons by postal code id, skipping (and warning about) those that can't be decoded"""
+    decoded = {}
+    for id_, geometry in geometries.items():
+        try:
+            geojson = geometry.geojson
+        except InvalidGeometry:
+            logger.warning(f"Could not decode the geometry of postal code {geometry.code}")
+            continue
+
+        if geojson["type"] in ('Polygon', 'MultiPolygon'):
+            decoded[id_] = geojson
+
+    return decoded
@@ -1,40 +1,141 @@
+import functools
 import typing as T
 
-from flask import Blueprint, request
+from flask import Blueprint, Response, json, make_response, request, stream_with_context
 
-from geoapp.DTOs import QueryRequestModel
-from geoapp.services import PostgresQueryService
+from config import settings
+from geoapp import metrics
+from geoapp.cache import build_cache
+from geoapp.conditional import STALE_HEADERS, Validators, tracking_staleness
+from geoapp.DTOs import (
+    MAP_FORMATS,
+    DashboardRequestModel,
+    MapRequestModel,
+    QueryRequestModel,
+    TurnoverRequestModel,
+    ValidationError,
+)
+from geoapp.geometry import level_for
+from geoapp.services import CachedQueryService, build_geometry_store, build_query_service
+from geoapp.tiles import InvalidTile, TileService
 
 # Services to use in handlers
-query_service = PostgresQueryService()
+geometries = build_geometry_store(settings)
+query_service = build_query_service(settings, geometries)
+tile_service = TileService(
+    query_service,
+    geometries,
+    cache_backend=build_cache(settings.tile_cache) if settings.tile_cache.enabled else None,
+)
 
 
 query_blueprint = Blueprint('dashboard', __name__)
+metrics_blueprint = Blueprint('metrics', __name__)
+
+
+def conditional(view: T.Callable) -> T.Callable:
+    """Tags the responses of `view` with the data version, answering 304 before it runs to clients holding
+    the current one. Responses served outdated data by the cache are not tagged, so they are never validated
+    by a version they don't reflect."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs) -> Response:
+        validators = Validators.of(request)
+        if validators.matches(request):
+            return Response(status=304, headers=validators.headers)
+
+        with tracking_staleness() as stale:
+            response = make_response(view(*args, **kwargs))
+
+        if response.status_code == 200:
+            response.headers.update(STALE_HEADERS if stale.is_set() else validators.headers)
+
+        return response
+
+    return wrapper
 
 
 @query_blueprint.route('/map', methods=('GET',))
+@conditional
 def get_map() -> T.Tuple:
+    query: MapRequestModel = MapRequestModel.from_request(request)
+    level = level_for(zoom=query.zoom, tolerance=query.tolerance)
+    headers = {'Content-Type': MAP_FORMATS[query.map_format], 'Vary': 'Accept'}
+
+    if query.map_format == 'topojson':
+        topology = query_service.get_map_topology(query.start_date, query.end_date, level=level, bbox=query.bbox)
+        return topology, 200, headers
+
+    if query.stream:
+        results = query_service.stream_map(query.start_date, query.end_date, level=level, bbox=query.bbox)
+        return Response(stream_with_context(_stream_results(results)), status=200, headers=headers)
+
+    return query_service.get_map(query.start_date, query.end_date, level=level, bbox=query.bbox), 200, headers
+
+
+@query_blueprint.route('/map/tiles/<int:z>/<int:x>/<int:y>.mvt', methods=('GET',))
+@conditional
+def get_map_tile(z: int, x: int, y: int) -> Response:
     query: QueryRequestModel = QueryRequestModel.from_request(request)
-    return query_service.get_map(query.start_date, query.end_date), 200
+
+    try:
+        tile = tile_service.get_tile(query.start_date, query.end_date, z, x, y)
+    except InvalidTile as ex:
+        raise ValidationError(message=str(ex), status_code=404)
+
+    return Response(tile, status=200, mimetype='application/vnd.mapbox-vector-tile')
 
 
 @query_blueprint.route('/turnover', methods=('GET',))
+@conditional
 def get_turnover() -> T.Tuple:
-    query: QueryRequestModel = QueryRequestModel.from_request(request)
-    return query_service.get_turnover(query.start_date, query.end_date), 200
+    query: TurnoverRequestModel = TurnoverRequestModel.from_request(request)
+    return query_service.get_turnover(query.start_date, query.end_date, by=query.by), 200
 
 
 @query_blueprint.route('/turnover/age-gender', methods=('GET',))
+@conditional
 def get_turnover_by_age_and_gender() -> T.Tuple:
     query: QueryRequestModel = QueryRequestModel.from_request(request)
     return query_service.get_turnover_by_age_and_gender(query.start_date, query.end_date), 200
 
 
 @query_blueprint.route('/turnover/time-gender', methods=('GET',))
+@conditional
 def get_turnover_by_time_and_gender() -> T.Tuple:
     query: QueryRequestModel = QueryRequestModel.from_request(request)
     return query_service.get_turnover_by_time_and_gender(query.start_date, query.end_date), 200
 
 
+@query_blueprint.route('/dashboard', methods=('GET',))
+@conditional
+def get_dashboard() -> T.Tuple:
+    query: DashboardRequestModel = DashboardRequestModel.from_request(request)
+    level = level_for(zoom=query.zoom, tolerance=query.tolerance)
+    return query_service.get_dashboard(query.start_date, query.end_date, level=level), 200
+
+
+@query_blueprint.route('/cache/stats', methods=('GET',))
+def get_cache_stats() -> T.Tuple:
+    if not isinstance(query_service, CachedQueryService):
+        return {"message": "Caching is disabled"}, 404
+
+    return query_service.stats(), 200
+
+
+@metrics_blueprint.route('/metrics', methods=('GET',))
+def get_metrics() -> Response:
+    return metrics.render()
+
+
+def _stream_results(results: T.Iterator[dict]) -> T.Iterator[str]:
+    """Serializes results as `{"results": [...]}` one at a time"""
+    yield '{"results": ['
+
+    for i, result in enumerate(results):
+        yield (',' if i else '') + json.dumps(result)
+
+    yield ']}'
+
+
 def validation_error_handler(ex):
     return {"message": ex.message}, ex.status_code
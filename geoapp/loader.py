@@ -0,0 +1,379 @@
+import csv
+from datetime import date
+from decimal import Decimal, InvalidOperation
+import io
+import logging
+import queue
+import threading
+import time
+import typing as T
+
+from geoapp import db
+from geoapp.models import Age, Gender
+
+logger = logging.getLogger(__name__)
+
+
+TDatabase = T.Type[db.Database]
+Chunk = T.Tuple[io.StringIO, int]
+
+
+class LoadError(Exception):
+    pass
+
+
+class InvalidRow(LoadError):
+    pass
+
+
+class UnknownTable(LoadError):
+    pass
+
+
+def _decimal(value: str) -> str:
+    if not Decimal(value).is_finite():
+        raise ValueError(f"{value} is not a finite number")
+    return value
+
+
+def _date(value: str) -> str:
+    return date.fromisoformat(value).isoformat()
+
+
+def _integer(value: str) -> str:
+    return str(int(value))
+
+
+def _one_of(enum: T.Type) -> T.Callable[[str], str]:
+    values = {member.value for member in enum}
+
+    def convert(value: str) -> str:
+        if value not in values:
+            raise ValueError(f"{value} is not one of {', '.join(sorted(values))}")
+        return value
+
+    return convert
+
+
+def _postal_code(value: str) -> str:
+    if len(value) != 5 or not value.isdigit():
+        raise ValueError(f"{value} is not a postal code")
+    return value
+
+
+def _hex(value: str) -> str:
+    bytes.fromhex(value)
+    return value
+
+
+# Columns each loadable table is copied into, and how each CSV value is validated and transformed.
+# Only these names ever make it into the generated COPY statements.
+TABLES: T.Dict[str, T.Dict[str, T.Callable[[str], str]]] = {
+    'PostalCodes': {
+        'the_geom': _hex,
+        'code': _postal_code,
+        'id': _integer,
+    },
+    'Payments': {
+        'amount': _decimal,
+        'p_month': _date,
+        'p_age': _one_of(Age),
+        'p_gender': _one_of(Gender),
+        'postal_code_id': _integer,
+        'id': _integer,
+    },
+}
+
+
+class LoadReport(T.NamedTuple):
+    table: str
+    rows: int
+    rejected: int
+    seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"Loaded {self.rows} rows into {self.table} in {self.seconds:.1f}s "
+            f"({self.rows_per_second:.0f} rows/s), {self.rejected} rejected"
+        )
+
+
+class IngestReport(T.NamedTuple):
+    loaded: LoadReport
+    inserted: int
+    updated: int
+    months: T.List[date]
+
+    def __str__(self) -> str:
+        months = ', '.join(month.strftime('%Y-%m') for month in self.months) or 'none'
+        return f"{self.loaded}. Inserted {self.inserted} and updated {self.updated} payments, months changed: {months}"
+
+
+class CsvLoader:
+    """Streams CSV files into the database through `COPY ... FROM STDIN`.
+
+    The file is read from the app side, so it doesn't need to be on the database server. Rows are
+    validated and transformed in chunks of `chunk_size`, each chunk being a `COPY` of its own. With
+    several `workers`, chunks are spread over as many connections, each loading its share in its own
+    transaction; those only commit once every worker copied its chunks without errors.
+    Up to `max_errors` invalid rows are skipped (and logged) before the load is aborted.
+    """
+
+    def __init__(
+            self,
+            database: TDatabase = None,
+            chunk_size: int = 50000,
+            workers: int = 1,
+            max_errors: int = 0,
+            progress_interval: float = 5.0,
+    ):
+        if database is None:
+            database = db.database
+
+        if workers > 1 and not isinstance(database, db.PooledPostgresDatabase):
+            logger.warning(f"{type(database).__name__} has a single connection, loading with one worker")
+            workers = 1
+
+        self.db = database
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.max_errors = max_errors
+        self.progress_interval = progress_interval
+
+    def load(self, table: str, path: str, into: str = None) -> LoadReport:
+        """Loads the rows of `table` found in the file at `path`, into another table with the same columns if given"""
+        table = _table_name(table)
+        columns = list(TABLES[table])
+        target = into or table
+        progress = _Progress(target, self.progress_interval)
+
+        logger.info(f"Loading {path} into {target} with {self.workers} worker(s)")
+        chunks = self._chunks(table, path, progress)
+
+        if self.workers > 1:
+            self._load_in_parallel(target, columns, chunks, progress)
+        else:
+            self.db.copy_rows(target, columns, _tracked(chunks, progress))
+
+        report = progress.report()
+        logger.info(str(report))
+
+        return report
+
+    def _chunks(self, table: str, path: str, progress: '_Progress') -> T.Iterator[Chunk]:
+        """Validated rows of the file, as CSV buffers of up to `chunk_size` rows ready to be copied"""
+        converters = TABLES[table]
+
+        with open(path, newline='') as f:
+            reader = csv.reader(f)
+
+            header = next(reader, None)
+            if header is None:
+                raise LoadError(f"{path} is empty")
+
+            missing = [column for column in converters if column not in header]
+            if missing:
+                raise LoadError(f"{path} lacks columns {', '.join(missing)}")
+
+            positions = [header.index(column) for column in converters]
+
+            buffer, rows = io.StringIO(), 0
+            writer = csv.writer(buffer)
+
+            for row in reader:
+                try:
+                    writer.writerow([convert(row[i]) for convert, i in zip(converters.values(), positions)])
+                except (ValueError, IndexError, InvalidOperation) as ex:
+                    rejected = progress.reject()
+                    if rejected > self.max_errors:
+                        raise InvalidRow(f"Invalid row at line {reader.line_num} of {path}: {ex}")
+
+                    logger.warning(f"Skipping invalid row at line {reader.line_num} of {path}: {ex}")
+                    continue
+
+                rows += 1
+                if rows == self.chunk_size:
+                    buffer.seek(0)
+                    yield buffer, rows
+
+                    buffer, rows = io.StringIO(), 0
+                    writer = csv.writer(buffer)
+
+            if rows:
+                buffer.seek(0)
+                yield buffer, rows
+
+    def _load_in_parallel(self, table: str, columns: T.List[str], chunks: T.Iterator[Chunk], progress: '_Progress'):
+        work: queue.Queue = queue.Queue(maxsize=self.workers * 2)
+        # Workers wait there for each other before committing, a failure breaks it so all of them roll back
+        barrier = threading.Barrier(self.workers)
+        errors: T.List[Exception] = []
+
+        def worker():
+            finished = False
+
+            def pulled() -> T.Iterator[io.StringIO]:
+                nonlocal finished
+
+                for buffer, rows in iter(work.get, None):
+                    if errors:
+                        raise LoadError("Load aborted")
+
+                    yield buffer
+                    progress.add(rows)
+
+                finished = True
+                barrier.wait()
+
+            try:
+                self.db.copy_rows(table, columns, pulled())
+            except Exception as ex:
+                errors.append(ex)
+                barrier.abort()
+
+                # Keep on draining, so the reader never blocks on a full queue
+                while not finished and work.get() is not None:
+                    pass
+
+        threads = [threading.Thread(target=worker, name=f"loader-{i}", daemon=True) for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for chunk in chunks:
+                if errors:
+                    break
+                work.put(chunk)
+        except Exception as ex:
+            errors.insert(0, ex)
+            barrier.abort()
+        finally:
+            for _ in threads:
+                work.put(None)
+
+            for thread in threads:
+                thread.join()
+
+        # The first error is the cause, the others are workers giving up because of it
+        causes = [error for error in errors if not isinstance(error, threading.BrokenBarrierError)]
+        if causes:
+            raise causes[0]
+        if errors:
+            raise errors[0]
+
+
+def ingest_payments(path: str, database: TDatabase = None, chunk_size: int = 50000, max_errors: int = 0) -> IngestReport:
+    """Upserts the payments of the CSV file at `path`, keyed by id, then refreshes what derives from them.
+
+    Rows are copied into a staging table first and swapped in with a single statement, so readers never see
+    a payment missing. Rows identical to the stored ones are left alone: ingesting the same file twice is a
+    no-op. Only the rollups of the months that changed are rebuilt, and subscribers of the data version are
+    told which months those are.
+    """
+    if database is None:
+        database = db.database
+
+    # Same connection throughout, as the temporary staging table only lives within it
+    with database.atomic():
+        database.execute_statement(
+            "CREATE TEMPORARY TABLE IF NOT EXISTS PaymentsStaging (LIKE Payments INCLUDING DEFAULTS)"
+        )
+        database.execute_statement("TRUNCATE PaymentsStaging")
+
+        report = CsvLoader(database, chunk_size=chunk_size, max_errors=max_errors).load(
+            'Payments', path, into='PaymentsStaging'
+        )
+        changes = database.execute_query(_UPSERT_PAYMENTS)
+
+        database.execute_statement("DROP TABLE PaymentsStaging")
+
+    db.partition_payments(database)
+
+    deleted = sum(count for change, _, count in changes if change == 'deleted')
+    inserted = sum(count for change, _, count in changes if change == 'inserted')
+    months = sorted({month for _, month, _ in changes})
+
+    if months:
+        db.refresh_rollups(database, months)
+        db.data_version.bump(months=months, db=database)
+
+    ingest = IngestReport(report, inserted=inserted - deleted, updated=deleted, months=months)
+    logger.info(str(ingest))
+
+    return ingest
+
+
+# Deleting and inserting again, rather than `ON CONFLICT`, handles payments moved to another month just the same.
+# The last occurrence of a payment in the file wins.
+_UPSERT_PAYMENTS = """
+WITH staged AS (
+    SELECT DISTINCT ON (id) amount, p_month, p_age, p_gender, postal_code_id, id
+    FROM PaymentsStaging
+    ORDER BY id, ctid DESC
+), changed AS (
+    SELECT * FROM staged s
+    WHERE NOT EXISTS (
+        SELECT 1 FROM Payments p
+        WHERE p.id = s.id
+        AND (p.amount, p.p_month, p.p_age, p.p_gender, p.postal_code_id)
+            = (s.amount, s.p_month, s.p_age, s.p_gender, s.postal_code_id)
+    )
+), deleted AS (
+    DELETE FROM Payments p USING changed c WHERE p.id = c.id
+    RETURNING p.p_month
+), inserted AS (
+    INSERT INTO Payments (amount, p_month, p_age, p_gender, postal_code_id, id)
+    SELECT amount, p_month, p_age, p_gender, postal_code_id, id FROM changed
+    RETURNING p_month
+)
+SELECT 'deleted', p_month, COUNT(*) FROM deleted GROUP BY p_month
+UNION ALL
+SELECT 'inserted', p_month, COUNT(*) FROM inserted GROUP BY p_month
+"""
+
+
+class _Progress:
+    def __init__(self, table: str, interval: float):
+        self.table = table
+        self.interval = interval
+
+        self.rows = 0
+        self.rejected = 0
+        self._started = time.perf_counter()
+        self._logged = self._started
+        self._lock = threading.Lock()
+
+    def add(self, rows: int):
+        with self._lock:
+            self.rows += rows
+            now = time.perf_counter()
+
+            if now - self._logged >= self.interval:
+                self._logged = now
+                logger.info(f"{self.table}: {self.rows} rows loaded ({self.rows / (now - self._started):.0f} rows/s)")
+
+    def reject(self) -> int:
+        with self._lock:
+            self.rejected += 1
+            return self.rejected
+
+    def report(self) -> LoadReport:
+        return LoadReport(self.table, self.rows, self.rejected, time.perf_counter() - self._started)
+
+
+def _tracked(chunks: T.Iterator[Chunk], progress: _Progress) -> T.Iterator[io.StringIO]:
+    for buffer, rows in chunks:
+        yield buffer
+        progress.add(rows)
+
+
+def _table_name(table: str) -> str:
+    for name in TABLES:
+        if name.lower() == table.lower():
+            return name
+
+    raise UnknownTable(f"Only {', '.join(TABLES)} can be loaded, got {table}")
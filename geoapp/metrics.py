@@ -0,0 +1,260 @@
+import bisect
+import contextlib
+import functools
+import threading
+import time
+import typing as T
+
+from flask import Flask, Response, g, request
+
+# Upper bounds of histogram buckets, in seconds, bytes and rows
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+Labels = T.Tuple[str, ...]
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, description: str, labels: T.Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+        self._lock = threading.Lock()
+
+    def render(self) -> T.List[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}", *self._samples()]
+
+    def _samples(self) -> T.Iterator[str]:
+        raise NotImplementedError
+
+    def _label_values(self, labels: T.Dict[str, T.Any]) -> Labels:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {', '.join(self.labels)}, got {', '.join(labels)}")
+
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format_labels(self, values: Labels, **extra: str) -> str:
+        pairs = [*zip(self.labels, values), *extra.items()]
+        if not pairs:
+            return ''
+
+        return '{' + ','.join(f'{label}="{_escape(value)}"' for label, value in pairs) + '}'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, description: str, labels: T.Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self._values: T.Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        values = self._label_values(labels)
+
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._label_values(labels), 0)
+
+    def _samples(self) -> T.Iterator[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+
+        for label_values, value in values:
+            yield f"{self.name}{self._format_labels(label_values)} {_number(value)}"
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        values = self._label_values(labels)
+
+        with self._lock:
+            self._values[values] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            description: str,
+            labels: T.Sequence[str] = (),
+            buckets: T.Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+        # Per label values: observations per bucket (the last one past every bound), sum
+        self._counts: T.Dict[Labels, T.List[int]] = {}
+        self._sums: T.Dict[Labels, float] = {}
+
+    def observe(self, value: float, **labels):
+        values = self._label_values(labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts = self._counts.get(values)
+            if counts is None:
+                counts = self._counts[values] = [0] * (len(self.buckets) + 1)
+                self._sums[values] = 0.0
+
+            counts[bucket] += 1
+            self._sums[values] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def timed(self, **labels) -> T.Callable[[T.Callable], T.Callable]:
+        """Decorator observing how long each call of a function takes"""
+        def decorator(function: T.Callable) -> T.Callable:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            return sum(self._counts.get(self._label_values(labels), ()))
+
+    def sum(self, **labels) -> float:
+        with self._lock:
+            return self._sums.get(self._label_values(labels), 0.0)
+
+    def _samples(self) -> T.Iterator[str]:
+        with self._lock:
+            series = sorted((values, list(counts), self._sums[values]) for values, counts in self._counts.items())
+
+        for label_values, counts, total in series:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _number(bound)
+                yield f"{self.name}_bucket{self._format_labels(label_values, le=le)} {cumulative}"
+
+            yield f"{self.name}_sum{self._format_labels(label_values)} {_number(total)}"
+            yield f"{self.name}_count{self._format_labels(label_values)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: T.Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(line for metric in self._metrics.values() for line in metric.render()) + '\n'
+
+
+registry = Registry()
+
+request_duration = registry.register(Histogram(
+    'geoapp_request_duration_seconds', "Time to answer requests, up to the first byte of streamed ones",
+    labels=('route', 'method', 'status'),
+))
+response_bytes = registry.register(Histogram(
+    'geoapp_response_bytes', "Size of response bodies, streamed ones excluded",
+    labels=('route',), buckets=SIZE_BUCKETS,
+))
+query_duration = registry.register(Histogram(
+    'geoapp_db_query_duration_seconds', "Time to execute SQL queries and fetch their rows",
+    labels=('query',),
+))
+query_rows = registry.register(Histogram(
+    'geoapp_db_query_rows', "Rows fetched by SQL queries",
+    labels=('query',), buckets=ROW_BUCKETS,
+))
+slow_queries = registry.register(Counter(
+    'geoapp_db_slow_queries_total', "SQL queries slower than the configured threshold",
+    labels=('query',),
+))
+statement_preparations = registry.register(Counter(
+    'geoapp_db_statement_preparations_total', "Queries prepared as statements, once per connection running them",
+    labels=('query',),
+))
+statement_prepare_duration = registry.register(Histogram(
+    'geoapp_db_statement_prepare_seconds', "Time to parse and analyze queries into prepared statements",
+    labels=('query',),
+))
+statement_reuses = registry.register(Counter(
+    'geoapp_db_statement_reuses_total', "Runs of queries already prepared on their connection",
+    labels=('query',),
+))
+statement_seconds_saved = registry.register(Counter(
+    'geoapp_db_statement_seconds_saved_total', "Preparation time spared by reusing prepared statements, at its mean",
+    labels=('query',),
+))
+replica_reads = registry.register(Counter(
+    'geoapp_db_replica_reads_total', "Read-only queries answered by each replica, or the primary",
+    labels=('target',),
+))
+geometry_bytes_saved = registry.register(Counter(
+    'geoapp_geometry_bytes_saved_total', "Geometry bytes merged from memory rather than fetched with turnover rows",
+))
+geometry_decode_seconds_saved = registry.register(Counter(
+    'geoapp_geometry_decode_seconds_saved_total', "Time spared decoding geometries kept decoded, at their mean",
+))
+columnar_bytes = registry.register(Gauge(
+    'geoapp_columnar_bytes', "Memory taken by the payments loaded in memory, per column and in total",
+    labels=('column',),
+))
+processing_duration = registry.register(Histogram(
+    'geoapp_processing_duration_seconds', "Time spent shaping query results into responses",
+    labels=('step',),
+))
+
+
+def instrument(app: Flask):
+    """Times every request of `app` per route and measures the responses"""
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def observe(response: Response) -> Response:
+        started = g.pop('request_started', None)
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+        if started is not None:
+            request_duration.observe(
+                time.perf_counter() - started, route=route, method=request.method, status=response.status_code
+            )
+
+        if not response.is_streamed:
+            response_bytes.observe(response.calculate_content_length() or 0, route=route)
+
+        return response
+
+
+def render() -> Response:
+    return Response(registry.render(), mimetype=None, content_type=CONTENT_TYPE)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
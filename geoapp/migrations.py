@@ -0,0 +1,80 @@
+import logging
+import os
+import re
+import typing as T
+
+from geoapp.db import Database
+
+logger = logging.getLogger(__name__)
+
+
+MIGRATIONS_PATH = 'config/migrations'
+# Taken by the transaction of each migration, so processes starting together don't apply one twice
+LOCK_ID = 7310
+
+
+class InvalidMigration(Exception):
+    pass
+
+
+class Migration(T.NamedTuple):
+    version: str
+    path: str
+
+    @property
+    def sql(self) -> str:
+        with open(self.path) as f:
+            return f.read()
+
+
+def migrations(path: str = MIGRATIONS_PATH) -> T.List[Migration]:
+    """Migrations found in `path`, named like `0001_description.sql`, in the order they apply in"""
+    found = []
+
+    for name in sorted(os.listdir(path)):
+        if not name.endswith('.sql'):
+            continue
+
+        if not re.fullmatch(r'\d{4}_\w+\.sql', name):
+            raise InvalidMigration(f"{name} isn't named like 0001_description.sql")
+
+        found.append(Migration(version=name[:-len('.sql')], path=os.path.join(path, name)))
+
+    return found
+
+
+def applied(db: Database) -> T.Set[str]:
+    return {version for version, in db.execute_query("SELECT version FROM SchemaMigrations")}
+
+
+def migrate(db: Database, path: str = MIGRATIONS_PATH) -> T.List[str]:
+    """Applies the migrations of `path` not applied yet, each in a transaction of its own along with its record.
+
+    Every transaction takes a lock released when it ends, even when it fails, and only then checks whether its
+    migration is applied, so processes starting together don't apply the same migration twice.
+    """
+    done = []
+
+    with db.atomic():
+        db.execute_query("SELECT pg_advisory_xact_lock(%s)", (LOCK_ID,))
+        db.execute_statement(
+            "CREATE TABLE IF NOT EXISTS SchemaMigrations ("
+            "version TEXT NOT NULL PRIMARY KEY, "
+            "applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW())"
+        )
+
+    for migration in migrations(path):
+        with db.atomic():
+            db.execute_query("SELECT pg_advisory_xact_lock(%s)", (LOCK_ID,))
+            if migration.version in applied(db):
+                continue
+
+            logger.info(f"Applying migration {migration.version}")
+            # Versions are checked against their file name pattern above, they can be inlined.
+            # Without params, `%` in the migration isn't taken as a placeholder either.
+            db.execute_statement(
+                f"{migration.sql}\n;INSERT INTO SchemaMigrations (version) VALUES ('{migration.version}')"
+            )
+            done.append(migration.version)
+
+    return done
@@ -13,3 +13,10 @@ class Age(str, enum.Enum):
     Between45And54 = "45-54"
     Between55And64 = "55-64"
     MoreThan64 = ">=65"
+
+
+class Dimension(str, enum.Enum):
+    Month = "month"
+    PostalCode = "postal_code"
+    Age = "age"
+    Gender = "gender"
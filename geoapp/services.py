@@ -1,23 +1,57 @@
 import abc
+import asyncio
+import contextlib
 from datetime import date, timedelta
+import itertools
+import logging
+import threading
+import time
 import typing as T
 
 from dateutil.relativedelta import relativedelta
 
-from geoapp import db
-from geoapp.models import Age, Gender
+from config.config import CoalescingConfig, Config
+from geoapp import cache, columnar, conditional, db, metrics
+from geoapp.coalescing import SingleFlight
+from geoapp.geometry import Bounds, GeometryStore
+from geoapp.models import Age, Dimension, Gender
+
+logger = logging.getLogger(__name__)
 
 
 TDatabase = T.Type[db.Database]
+TCacheBackend = T.Type[cache.CacheBackend]
+
+# Postal codes whose streamed results are merged with their geometries per trip to a thread
+STREAM_BATCH = 100
+
+
+class InvalidQueryService(Exception):
+    pass
+
+
+class InvalidDimension(ValueError):
+    pass
 
 
 class AbstractQueryService(abc.ABC):
     @abc.abstractmethod
-    def get_map(self, start_date: date, end_date: date) -> dict:
+    def get_map(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> dict:
         pass
 
     @abc.abstractmethod
-    def get_turnover(self, start_date: date, end_date: date, by: T.Iterable[str]) -> dict:
+    def get_map_topology(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> dict:
+        """The map as a TopoJSON topology, postal codes sharing the arcs of their common borders"""
+        pass
+
+    def stream_map(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> T.Iterator[dict]:
+        """The results of `get_map` one at a time. Services able to produce them incrementally override it."""
+        yield from self.get_map(start_date, end_date, level, bbox)["results"]
+
+    @abc.abstractmethod
+    def get_turnover(self, start_date: date, end_date: date, by: T.Iterable[str] = ()) -> dict:
+        """Turnover grouped by `by`, any of `Dimension`, as dictionaries nested in that order, or the total
+        without `by`. Every month, age and gender of the range is a key, and every postal code with payments in it."""
         pass
 
     @abc.abstractmethod
@@ -28,15 +62,33 @@ class AbstractQueryService(abc.ABC):
     def get_turnover_by_time_and_gender(self, start_date: date, end_date: date) -> dict:
         pass
 
+    @abc.abstractmethod
+    def get_turnover_by_postal_code(
+            self, start_date: date, end_date: date, postal_code_ids: T.Iterable[int] = None) -> dict:
+        """Turnover by age and gender keyed by postal code id, only of `postal_code_ids` when given"""
+        pass
+
+    def get_dashboard(self, start_date: date, end_date: date, level: int = 0) -> dict:
+        """What every widget of the dashboard shows, keyed by the method computing it"""
+        return {
+            "turnover": self.get_turnover(start_date, end_date),
+            "turnover_by_age_and_gender": self.get_turnover_by_age_and_gender(start_date, end_date),
+            "turnover_by_time_and_gender": self.get_turnover_by_time_and_gender(start_date, end_date),
+            "map": self.get_map(start_date, end_date, level),
+        }
+
 
 class DummyQueryService(AbstractQueryService):
     def __init__(self, data: dict):
         self._data = data
 
-    def get_map(self, start_date: date, end_date: date) -> dict:
+    def get_map(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> dict:
         return self._data['map']
 
-    def get_turnover(self, start_date: date, end_date: date) -> dict:
+    def get_map_topology(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> dict:
+        return self._data['map_topology']
+
+    def get_turnover(self, start_date: date, end_date: date, by: T.Iterable[str] = ()) -> dict:
         return self._data['turnover']
 
     def get_turnover_by_age_and_gender(self, start_date: date, end_date: date) -> dict:
@@ -45,95 +97,916 @@ class DummyQueryService(AbstractQueryService):
     def get_turnover_by_time_and_gender(self, start_date: date, end_date: date) -> dict:
         return self._data['turnover_by_time_gender']
 
+    def get_turnover_by_postal_code(
+            self, start_date: date, end_date: date, postal_code_ids: T.Iterable[int] = None) -> dict:
+        return self._data['turnover_by_postal_code']
+
+
+class Source(T.NamedTuple):
+    table: str
+    dimensions: T.FrozenSet[str]
+
+
+class DimensionSpec(T.NamedTuple):
+    # Column grouped by. Only these ever make it into the SQL generated for `get_turnover`.
+    column: str
+    # Every key of the dimension within a date range, None for those keyed by what has payments in it
+    keys: T.Optional[T.Callable[[date, date], T.List]]
+    # Result key out of a column value
+    key: T.Callable[[T.Any], T.Any]
+
+
+DIMENSIONS = {
+    Dimension.Month: DimensionSpec(
+        'p_month', lambda start, end: _months_between(start, end), lambda value: value.strftime('%Y-%m')
+    ),
+    Dimension.PostalCode: DimensionSpec('postal_code_id', None, int),
+    Dimension.Age: DimensionSpec('p_age', lambda start, end: list(Age), Age),
+    Dimension.Gender: DimensionSpec('p_gender', lambda start, end: list(Gender), Gender),
+}
+
+
+# Tables holding payments, from smallest to largest. All of them share column names.
+SOURCES = (
+    Source('PaymentsByMonth', frozenset({'month', 'age', 'gender'})),
+    Source('PaymentsByMonthPostalCode', frozenset({'month', 'postal_code', 'age', 'gender'})),
+    Source('Payments', frozenset({'month', 'postal_code', 'age', 'gender'})),
+)
+
 
 class PostgresQueryService(AbstractQueryService):
     class DatabaseNotInitialized(Exception):
         pass
 
-    def __init__(self, database: TDatabase = None):
+    def __init__(
+            self,
+            database: TDatabase = None,
+            use_rollups: bool = True,
+            geometries: GeometryStore = None,
+            geometry_format: str = 'wkb',
+    ):
         if database is None:
             database = db.database
 
+        if geometries is None:
+            geometries = GeometryStore(database)
+
         self.db = database
+        self.sources = SOURCES if use_rollups else SOURCES[-1:]
+        self.geometries = geometries
+        self.geometry_format = geometry_format
+
+    def source_for(self, *dimensions: str) -> str:
+        """Returns the smallest table that can be grouped by all of `dimensions`"""
+        for source in self.sources:
+            if source.dimensions.issuperset(dimensions):
+                return source.table
+
+        raise ValueError(f"No source can serve dimensions {dimensions}")
+
+    def get_map(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> dict:
+        """Turnover by age and gender of each postal code, along with its geometry simplified to `level`.
+        Only postal codes intersecting `bbox` are aggregated when it is given."""
+        postal_code_ids = None if bbox is None else self.geometries.ids_within(bbox)
+        aggregates = self.get_turnover_by_postal_code(start_date, end_date, postal_code_ids)["results"]
+        return _render_map(aggregates, self.geometries, self.geometry_format, level)
+
+    def get_map_topology(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> dict:
+        postal_code_ids = None if bbox is None else self.geometries.ids_within(bbox)
+        aggregates = self.get_turnover_by_postal_code(start_date, end_date, postal_code_ids)["results"]
+        return _render_topology(aggregates, self.geometries, level)
+
+    def stream_map(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> T.Iterator[dict]:
+        """Streams the map from a server-side cursor, only holding one postal code in memory at a time"""
+        postal_code_ids = None if bbox is None else self.geometries.ids_within(bbox)
+        query, params = self._map_stream_query(start_date, end_date, postal_code_ids)
+        rows = self.db.reader().stream_query(query, params, name='map_stream')
+
+        yield from _stream_map(_aggregates_by_postal_code(rows), self.geometries, self.geometry_format, level)
+
+    def get_turnover_by_postal_code(
+            self, start_date: date, end_date: date, postal_code_ids: T.Iterable[int] = None) -> dict:
+        query, params = self._turnover_by_postal_code_query(start_date, end_date, postal_code_ids)
+        res = self.db.reader().execute_query(query, params, name='turnover_by_postal_code', prepare=True)
 
-    def get_map(self, start_date: date, end_date: date) -> dict:
-        res = self.db.execute_query(
-            "WITH aggregate AS ("
-            "SELECT pc.code, ps.p_age, ps.p_gender, SUM(ps.amount) AS sum_amount "
-            "FROM PostalCodes pc JOIN Payments ps "
-            "ON pc.id = ps.postal_code_id "
-            "WHERE ps.p_month >= %s AND ps.p_month <= %s "
-            "GROUP BY pc.code, ps.p_age, ps.p_gender)\n"
-            "SELECT pc.code, the_geom AS geometry, p_age, p_gender, sum_amount "
-            "FROM PostalCodes pc JOIN aggregate a "
-            "ON pc.code = a.code;",
-            (start_date, end_date)
+        return _turnover_by_postal_code_results(res)
+
+    def get_dashboard(self, start_date: date, end_date: date, level: int = 0) -> dict:
+        """Every widget of the dashboard out of a single scan.
+
+        Two grouping sets are enough: turnover by postal code, age and gender for the map, and by
+        month, age and gender, small enough to roll up into the other widgets here. Each extra
+        grouping set costs another hash table per row, more than these few rows take to sum up.
+        """
+        query, params = self._dashboard_query(start_date, end_date)
+        res = self.db.reader().execute_query(query, params, name='dashboard', prepare=True)
+
+        return self._dashboard_results(res, start_date, end_date, level)
+
+    def _dashboard_query(self, start_date: date, end_date: date) -> T.Tuple[str, tuple]:
+        source = self.source_for('month', 'postal_code', 'age', 'gender')
+        query = (
+            "SELECT GROUPING(postal_code_id), p_month, postal_code_id, p_age, p_gender, SUM(amount) "
+            f"FROM {source} "
+            "WHERE p_month >= %s AND p_month <= %s "
+            "GROUP BY GROUPING SETS ((p_month, p_age, p_gender), (postal_code_id, p_age, p_gender))"
         )
 
-        data = {}
-        for code, geometry, age, gender, sum_ in res:
-            if code not in data:
-                data[code] = _get_base_dictionary()
+        return query, (start_date, end_date)
+
+    def _dashboard_results(self, res: T.Iterable[T.Tuple], start_date: date, end_date: date, level: int) -> dict:
+        with metrics.processing_duration.time(step='dashboard'):
+            total = None
+            by_age_and_gender = _get_aggregate_by_age_and_gender_dictionary()
+            by_time_and_gender = _get_aggregate_by_time_and_gender_dictionary(start_date, end_date)
+            by_postal_code = {}
 
-            data[code]["geometry"] = geometry
-            data[code]["aggregate"][age][gender] += sum_
+            for by_month, month, postal_code_id, age, gender, amount in res:
+                if by_month:
+                    total = amount if total is None else total + amount
+                    by_age_and_gender[age][gender] += amount
+                    by_time_and_gender[month.strftime('%Y-%m')][gender] += amount
+                else:
+                    if postal_code_id not in by_postal_code:
+                        by_postal_code[postal_code_id] = _get_aggregate_by_age_and_gender_dictionary()
+
+                    by_postal_code[postal_code_id][age][gender] += amount
 
         return {
-            "results": [
-                {
-                    "geometry": data[code]["geometry"],
-                    "turnover": data[code]["aggregate"]
-                }
-                for code in data
-            ]
+            "turnover": {"results": total},
+            "turnover_by_age_and_gender": {"results": by_age_and_gender},
+            "turnover_by_time_and_gender": {"results": by_time_and_gender},
+            "map": _render_map(by_postal_code, self.geometries, self.geometry_format, level),
         }
 
-    def get_turnover(self, start_date: date, end_date: date) -> dict:
-        res = self.db.execute_query(
-            "SELECT SUM(amount) FROM Payments WHERE p_month >= %s AND p_month <= %s",
-            (start_date, end_date)
+    def _turnover_by_postal_code_query(
+            self, start_date: date, end_date: date, postal_code_ids: T.Iterable[int] = None) -> T.Tuple[str, tuple]:
+        source = self.source_for('month', 'postal_code', 'age', 'gender')
+        query = (
+            "SELECT postal_code_id, p_age, p_gender, SUM(amount) "
+            f"FROM {source} "
+            "WHERE p_month >= %s AND p_month <= %s "
         )
+        params = [start_date, end_date]
 
-        return {
-            "results": res[0][0]
-        }
+        if postal_code_ids is not None:
+            query += "AND postal_code_id = ANY(%s) "
+            params.append(list(postal_code_ids))
+
+        return query + "GROUP BY postal_code_id, p_age, p_gender", tuple(params)
+
+    def _map_stream_query(
+            self, start_date: date, end_date: date, postal_code_ids: T.Iterable[int] = None) -> T.Tuple[str, tuple]:
+        query, params = self._turnover_by_postal_code_query(start_date, end_date, postal_code_ids)
+
+        # Rows of postal codes sharing a code come one after the other, so they can be merged on the fly
+        query = (
+            "SELECT t.* "
+            f"FROM ({query}) t JOIN PostalCodes ON PostalCodes.id = t.postal_code_id "
+            "ORDER BY PostalCodes.code, t.postal_code_id"
+        )
+
+        return query, params
+
+    def get_turnover(self, start_date: date, end_date: date, by: T.Iterable[str] = ()) -> dict:
+        by = _check_dimensions(by)
+        query, params, name = self._turnover_query(start_date, end_date, by)
+        res = self.db.reader().execute_query(query, params, name=name, prepare=True)
+
+        return _turnover_results(res, by, start_date, end_date, name)
+
+    def _turnover_query(self, start_date: date, end_date: date, by: T.List[Dimension]) -> T.Tuple[str, tuple, str]:
+        """The query of `get_turnover`, its params and the name it's measured under"""
+        source = self.source_for('month', *by)
+        columns = [DIMENSIONS[dimension].column for dimension in by]
+
+        query = (
+            f"SELECT {', '.join([*columns, 'SUM(amount)'])} "
+            f"FROM {source} "
+            "WHERE p_month >= %s AND p_month <= %s"
+        )
+        if columns:
+            query += f" GROUP BY {', '.join(columns)}"
+
+        name = '_'.join(['turnover_by', *by]) if by else 'turnover'
+
+        return query, (start_date, end_date), name
 
     def get_turnover_by_age_and_gender(self, start_date: date, end_date: date) -> dict:
-        res = self.db.execute_query(
-            "SELECT p_age, p_gender, SUM(amount) "
-            "FROM Payments "
-            "WHERE p_month >= %s AND p_month <= %s "
-            "GROUP BY p_age, p_gender",
-            (start_date, end_date)
+        return self.get_turnover(start_date, end_date, by=(Dimension.Age, Dimension.Gender))
+
+    def get_turnover_by_time_and_gender(self, start_date: date, end_date: date) -> dict:
+        return self.get_turnover(start_date, end_date, by=(Dimension.Month, Dimension.Gender))
+
+
+class AsyncPostgresQueryService:
+    """`PostgresQueryService` awaiting its queries on a `db.AsyncPostgresDatabase`, for the ASGI app.
+
+    The SQL and the shaping of its results are those of `PostgresQueryService`, only running queries differs.
+    Loading geometries and merging them with results runs in threads, the event loop only awaits.
+    """
+
+    def __init__(
+            self,
+            database: 'db.AsyncPostgresDatabase',
+            use_rollups: bool = True,
+            geometries: GeometryStore = None,
+            geometry_format: str = 'wkb',
+    ):
+        if geometries is None:
+            geometries = GeometryStore()
+
+        self.db = database
+        self.geometries = geometries
+        self.geometry_format = geometry_format
+        # Builds queries and shapes their results, never runs any
+        self._queries = PostgresQueryService(database, use_rollups, geometries, geometry_format)
+
+    async def get_map(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> dict:
+        postal_code_ids = await self._ids_within(bbox)
+        aggregates = (await self.get_turnover_by_postal_code(start_date, end_date, postal_code_ids))["results"]
+        return await asyncio.to_thread(_render_map, aggregates, self.geometries, self.geometry_format, level)
+
+    async def get_map_topology(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> dict:
+        postal_code_ids = await self._ids_within(bbox)
+        aggregates = (await self.get_turnover_by_postal_code(start_date, end_date, postal_code_ids))["results"]
+        return await asyncio.to_thread(_render_topology, aggregates, self.geometries, level)
+
+    async def stream_map(
+            self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> T.AsyncIterator[dict]:
+        postal_code_ids = await self._ids_within(bbox)
+        query, params = self._queries._map_stream_query(start_date, end_date, postal_code_ids)
+        await asyncio.to_thread(self.geometries.simplify, level)
+
+        # Rows come sorted by code, those of a code are merged once the next code shows up, a batch at a time
+        code, group, groups = None, [], []
+        async for row in self.db.stream_query(query, params, name='map_stream'):
+            geometry = self.geometries.peek(row[0]) or await asyncio.to_thread(self.geometries.get, row[0])
+            if group and geometry.code != code:
+                groups.append(group)
+                group = []
+
+                if len(groups) == STREAM_BATCH:
+                    for result in await asyncio.to_thread(self._stream_groups, groups, level):
+                        yield result
+                    groups = []
+
+            code = geometry.code
+            group.append(row)
+
+        groups.append(group)
+        for result in await asyncio.to_thread(self._stream_groups, groups, level):
+            yield result
+
+    async def get_turnover_by_postal_code(
+            self, start_date: date, end_date: date, postal_code_ids: T.Iterable[int] = None) -> dict:
+        query, params = self._queries._turnover_by_postal_code_query(start_date, end_date, postal_code_ids)
+        res = await self.db.execute_query(query, params, name='turnover_by_postal_code')
+
+        return _turnover_by_postal_code_results(res)
+
+    async def get_dashboard(self, start_date: date, end_date: date, level: int = 0) -> dict:
+        query, params = self._queries._dashboard_query(start_date, end_date)
+        res = await self.db.execute_query(query, params, name='dashboard')
+
+        return await asyncio.to_thread(self._queries._dashboard_results, res, start_date, end_date, level)
+
+    async def get_turnover(self, start_date: date, end_date: date, by: T.Iterable[str] = ()) -> dict:
+        by = _check_dimensions(by)
+        query, params, name = self._queries._turnover_query(start_date, end_date, by)
+        res = await self.db.execute_query(query, params, name=name)
+
+        return _turnover_results(res, by, start_date, end_date, name)
+
+    async def get_turnover_by_age_and_gender(self, start_date: date, end_date: date) -> dict:
+        return await self.get_turnover(start_date, end_date, by=(Dimension.Age, Dimension.Gender))
+
+    async def get_turnover_by_time_and_gender(self, start_date: date, end_date: date) -> dict:
+        return await self.get_turnover(start_date, end_date, by=(Dimension.Month, Dimension.Gender))
+
+    async def _ids_within(self, bbox: T.Optional[Bounds]) -> T.Optional[T.List[int]]:
+        return None if bbox is None else await asyncio.to_thread(self.geometries.ids_within, bbox)
+
+    def _stream_groups(self, groups: T.List[T.List[T.Tuple]], level: int) -> T.List[dict]:
+        rows = [row for group in groups for row in group]
+        return list(_stream_map(_aggregates_by_postal_code(rows), self.geometries, self.geometry_format, level))
+
+
+class ColumnarQueryService(AbstractQueryService):
+    """Answers queries from an in-memory `columnar.ColumnStore` instead of querying the database.
+
+    Payments are loaded on first use, either from the database or straight from the CSV exports,
+    and loaded again after the data version changes or `reload` is called. With `use_cube`, they are folded into a
+    `columnar.PrefixSumCube` instead, which is only extended when new months are loaded. The memory
+    they take is reported on /metrics.
+    """
+
+    def __init__(
+            self,
+            database: TDatabase = None,
+            payments_path: str = None,
+            postal_codes_path: str = None,
+            version: db.DataVersion = None,
+            use_cube: bool = False,
+            geometries: GeometryStore = None,
+            geometry_format: str = 'wkb',
+    ):
+        if database is None:
+            database = db.database
+
+        if version is None:
+            version = db.data_version
+
+        if geometries is None:
+            geometries = GeometryStore(database, path=postal_codes_path, version=version)
+
+        self.db = database
+        self.payments_path = payments_path
+        self.postal_codes_path = postal_codes_path
+        self.use_cube = use_cube
+        self.geometries = geometries
+        self.geometry_format = geometry_format
+
+        self._store: T.Optional[T.Union[columnar.ColumnStore, columnar.PrefixSumCube]] = None
+        self._appended_months: T.Set[date] = set()
+        self._lock = threading.Lock()
+
+        version.subscribe(self._on_data_changed)
+
+    @property
+    def store(self) -> T.Union[columnar.ColumnStore, columnar.PrefixSumCube]:
+        if self._store is None or self._appended_months:
+            with self._lock:
+                if self._store is None:
+                    self._load()
+                elif self._appended_months:
+                    self._append()
+
+        return self._store
+
+    def reload(self, months: T.Iterable[date] = None):
+        """Reads payments again on next use, only those of `months` when a cube can be extended with them"""
+        months = None if months is None else set(months)
+        store = self._store
+        appendable = (
+            isinstance(store, columnar.PrefixSumCube)
+            and months
+            and min(columnar.month_ordinal(month) for month in months) > store.last_month
         )
 
+        if appendable:
+            self._appended_months.update(months)
+        else:
+            self._store = None
+
+    def get_map(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> dict:
+        postal_code_ids = None if bbox is None else self.geometries.ids_within(bbox)
+        aggregates = self.get_turnover_by_postal_code(start_date, end_date, postal_code_ids)["results"]
+        return _render_map(aggregates, self.geometries, self.geometry_format, level)
+
+    def get_map_topology(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> dict:
+        postal_code_ids = None if bbox is None else self.geometries.ids_within(bbox)
+        aggregates = self.get_turnover_by_postal_code(start_date, end_date, postal_code_ids)["results"]
+        return _render_topology(aggregates, self.geometries, level)
+
+    def stream_map(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> T.Iterator[dict]:
+        postal_code_ids = None if bbox is None else self.geometries.ids_within(bbox)
+        aggregates = self.get_turnover_by_postal_code(start_date, end_date, postal_code_ids)["results"]
+        by_code = sorted(aggregates.items(), key=lambda item: (self.geometries.get(item[0]).code, item[0]))
+
+        yield from _stream_map(by_code, self.geometries, self.geometry_format, level)
+
+    def get_turnover_by_postal_code(
+            self, start_date: date, end_date: date, postal_code_ids: T.Iterable[int] = None) -> dict:
+        store = self.store
+        present, sums = store.by_postal_code_age_and_gender(start_date, end_date)
+        wanted = None if postal_code_ids is None else set(postal_code_ids)
+
+        data = {}
+        for index, matrix in zip(present, sums):
+            postal_code_id = int(store.postal_code_ids[index])
+            if wanted is not None and postal_code_id not in wanted:
+                continue
+
+            data[postal_code_id] = aggregate = _get_aggregate_by_age_and_gender_dictionary()
+            _fill_age_and_gender(aggregate, matrix)
+
+        return {
+            "results": data
+        }
+
+    def get_turnover(self, start_date: date, end_date: date, by: T.Iterable[str] = ()) -> dict:
+        by = _check_dimensions(by)
+        store = self.store
+
+        if not by:
+            return {
+                "results": store.total(start_date, end_date)
+            }
+
+        first, sums, counts = store.group_by(start_date, end_date, by)
+        axes = [dimension for dimension in columnar.AXES if dimension in by]
+        keys_by_axis = {
+            Dimension.Month: lambda offset: columnar.month_from_ordinal(first + offset).strftime('%Y-%m'),
+            Dimension.PostalCode: lambda index: int(store.postal_code_ids[index]),
+            Dimension.Age: lambda index: list(Age)[index],
+            Dimension.Gender: lambda index: list(Gender)[index],
+        }
+        present = {Dimension.PostalCode: [int(store.postal_code_ids[index]) for index in counts.nonzero()[0]]}
+
+        data = _get_dense_dictionary(by, start_date, end_date, present)
+
+        for cell in zip(*sums.nonzero()):
+            index = dict(zip(axes, cell))
+            keys = [keys_by_axis[dimension](index[dimension]) for dimension in by]
+            _add_to_dense_dictionary(data, keys, float(sums[cell]))
+
+        return {
+            "results": data
+        }
+
+    def get_turnover_by_age_and_gender(self, start_date: date, end_date: date) -> dict:
         data = _get_aggregate_by_age_and_gender_dictionary()
+        _fill_age_and_gender(data, self.store.by_age_and_gender(start_date, end_date))
+
+        return {
+            "results": data
+        }
+
+    def get_turnover_by_time_and_gender(self, start_date: date, end_date: date) -> dict:
+        first, sums = self.store.by_month_and_gender(start_date, end_date)
+        data = _get_aggregate_by_time_and_gender_dictionary(start_date, end_date)
 
-        for age, gender, amount in res:
-            data[age][gender] += amount
+        for offset, row in enumerate(sums):
+            key = columnar.month_from_ordinal(first + offset).strftime('%Y-%m')
+            for gender, amount in zip(Gender, row):
+                data[key][gender] += float(amount)
 
         return {
             "results": data
         }
 
+    def _load(self):
+        self._appended_months = set()
+        store = columnar.ColumnStore.from_rows(self._read(), self.geometries.ids())
+        if self.use_cube:
+            store = columnar.PrefixSumCube.from_store(store)
+
+        self._store = store
+        self._measure()
+
+        logger.info(f"Loaded payments in memory, using {store.nbytes['total']} bytes")
+
+    def _append(self):
+        months, self._appended_months = self._appended_months, set()
+        store = columnar.ColumnStore.from_rows(self._read(months), self.geometries.ids())
+
+        if self._store.can_append(store):
+            logger.info(f"Appending {len(store)} payments to the prefix sum cube")
+            self._store = self._store.append(store)
+            self._measure()
+        else:
+            self._load()
+
+    def _measure(self):
+        for column, size in self._store.nbytes.items():
+            metrics.columnar_bytes.set(size, column=column)
+
+    def _read(self, months: T.Set[date] = None) -> T.Iterable[T.Tuple]:
+        """Payments, optionally only of some `months`"""
+        if self.payments_path:
+            payments = (
+                (p_month, p_age, p_gender, postal_code_id, amount)
+                for amount, p_month, p_age, p_gender, postal_code_id, _ in db._csv_lines(self.payments_path)
+                if months is None or date.fromisoformat(p_month) in months
+            )
+        else:
+            query = "SELECT p_month, p_age, p_gender, postal_code_id, amount FROM Payments"
+            params = None
+            if months is not None:
+                query += " WHERE p_month = ANY(%s)"
+                params = (list(months),)
+
+            payments = self.db.execute_query(query, params, name='columnar_payments')
+
+        return payments
+
+    def _on_data_changed(self, version: int, months: T.Optional[T.List[date]]):
+        self.reload(months)
+
+
+class CachedQueryService(AbstractQueryService):
+    """Serves the results of another query service from a cache.
+
+    Entries are stamped with the last data version that changed any month of their date range, so
+    anything computed before a load is never served after it, while loads of other months leave them be.
+    The exception are entries computed by `warming()`: once outdated, they keep being served until the
+    warmer refreshes them, so loads don't leave popular queries to compute from scratch. Serving them is
+    reported to `conditional.tracking_staleness()`, so responses don't get tagged with a version they predate.
+    """
+
+    def __init__(
+            self,
+            service: AbstractQueryService,
+            cache_backend: TCacheBackend,
+            version: db.DataVersion = None,
+            popularity: cache.PopularityTracker = None,
+    ):
+        if version is None:
+            version = db.data_version
+
+        self.service = service
+        self.cache = cache_backend
+        self.version = version
+        self.popularity = popularity or cache.PopularityTracker()
+
+        # Version every month has last changed at, on top of the last version that changed everything
+        self._base_version: T.Optional[int] = None
+        self._month_versions: T.Dict[date, int] = {}
+        # Keys computed by the last warm-up, and those of them being refreshed after a data change
+        self._warm_keys: T.Set[str] = set()
+        self._refreshing: T.Set[str] = set()
+        self._stale_served = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        self.version.subscribe(self._on_data_changed)
+
+    def get_map(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> dict:
+        return self._cached('get_map', start_date, end_date, level, bbox)
+
+    def get_map_topology(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> dict:
+        return self._cached('get_map_topology', start_date, end_date, level, bbox)
+
+    def get_dashboard(self, start_date: date, end_date: date, level: int = 0) -> dict:
+        return self._cached('get_dashboard', start_date, end_date, level)
+
+    def stream_map(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> T.Iterator[dict]:
+        """Serves a cached map when there is one, streams from the service otherwise without caching,
+        since holding the whole map in memory is what streaming avoids.
+        The cache is looked up on the call rather than once iterating, before the response headers are sent."""
+        args = (start_date, end_date, level, bbox)
+        value = self._lookup(self._key('get_map', *args), self._range_version(start_date, end_date))
+
+        if value is not cache.MISSING:
+            return iter(value["results"])
+
+        return self.service.stream_map(*args)
+
+    def get_turnover(self, start_date: date, end_date: date, by: T.Iterable[str] = ()) -> dict:
+        return self._cached('get_turnover', start_date, end_date, tuple(_check_dimensions(by)))
+
+    def get_turnover_by_age_and_gender(self, start_date: date, end_date: date) -> dict:
+        return self._cached('get_turnover_by_age_and_gender', start_date, end_date)
+
     def get_turnover_by_time_and_gender(self, start_date: date, end_date: date) -> dict:
-        res = self.db.execute_query(
-            "SELECT TO_CHAR(p_month, 'yyyy-mm'), p_gender, SUM(amount) "
-            "FROM Payments "
-            "WHERE p_month >= %s AND p_month <= %s "
-            "GROUP BY TO_CHAR(p_month, 'yyyy-mm'), p_gender",
-            (start_date, end_date)
+        return self._cached('get_turnover_by_time_and_gender', start_date, end_date)
+
+    def get_turnover_by_postal_code(
+            self, start_date: date, end_date: date, postal_code_ids: T.Iterable[int] = None) -> dict:
+        if postal_code_ids is not None:
+            postal_code_ids = tuple(sorted(postal_code_ids))
+
+        return self._cached('get_turnover_by_postal_code', start_date, end_date, postal_code_ids)
+
+    @contextlib.contextmanager
+    def warming(self):
+        """Queries made by this thread within the block are computed unless up to date, and kept being
+        served once outdated until the next warm-up, which is up to the caller to run after data changes.
+        They replace the queries of the last warm-up."""
+        self._local.warm_keys = set()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._warm_keys = self._local.warm_keys
+                self._refreshing.clear()
+            self._local.warm_keys = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            warming = {
+                "warm_entries": len(self._warm_keys),
+                "refreshing": len(self._refreshing),
+                "stale_served": self._stale_served,
+            }
+
+        return {**self.cache.stats(), **warming, "data_version": self.version.current()}
+
+    def _cached(self, method: str, *args) -> dict:
+        key = self._key(method, *args)
+        version = self._range_version(*args[:2])
+
+        warm_keys = getattr(self._local, 'warm_keys', None)
+        if warm_keys is None:
+            self.popularity.record((method, *args))
+        else:
+            warm_keys.add(key)
+
+        value = self._lookup(key, version, serve_stale=warm_keys is None)
+        if value is cache.MISSING:
+            value = getattr(self.service, method)(*args)
+            self.cache.set(key, (version, value))
+
+        if warm_keys is not None:
+            with self._lock:
+                self._refreshing.discard(key)
+
+        return value
+
+    def _lookup(self, key: str, version: int, serve_stale: bool = True) -> T.Any:
+        entry = self.cache.get(key)
+        if entry is cache.MISSING:
+            return entry
+
+        # Other processes may already know of a later version than this one
+        entry_version, value = entry
+        if entry_version >= version:
+            return value
+
+        with self._lock:
+            if serve_stale and key in self._refreshing:
+                self._stale_served += 1
+                conditional.served_stale()
+                return value
+
+        return cache.MISSING
+
+    @staticmethod
+    def _key(method: str, *args) -> str:
+        return ':'.join(str(part) for part in (method, *args))
+
+    def _range_version(self, start_date: date, end_date: date) -> int:
+        current = self.version.current()
+        first_month = start_date.replace(day=1)
+
+        with self._lock:
+            if self._base_version is None:
+                self._base_version = current
+
+            return max(
+                (version for month, version in self._month_versions.items() if first_month <= month <= end_date),
+                default=self._base_version,
+            )
+
+    def _on_data_changed(self, version: int, months: T.Optional[T.List[date]]):
+        with self._lock:
+            if months is None:
+                self._base_version = version
+                self._month_versions.clear()
+            else:
+                self._month_versions.update((month, version) for month in months)
+
+            self._refreshing = set(self._warm_keys)
+
+
+class CoalescingQueryService(AbstractQueryService):
+    """Shares a single run of another query service between concurrent callers asking for the same thing.
+
+    Flattens the load spikes of many users opening the same dashboard at once: the first caller runs the
+    query, the others wait for its result. See `SingleFlight` for how that works across processes.
+    """
+
+    def __init__(self, service: AbstractQueryService, flights: SingleFlight):
+        self.service = service
+        self.flights = flights
+
+    def get_map(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> dict:
+        return self._coalesced('get_map', start_date, end_date, level, bbox)
+
+    def get_map_topology(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> dict:
+        return self._coalesced('get_map_topology', start_date, end_date, level, bbox)
+
+    def get_dashboard(self, start_date: date, end_date: date, level: int = 0) -> dict:
+        return self._coalesced('get_dashboard', start_date, end_date, level)
+
+    def stream_map(self, start_date: date, end_date: date, level: int = 0, bbox: Bounds = None) -> T.Iterator[dict]:
+        """Streams straight from the service, sharing would mean holding the whole map in memory"""
+        return self.service.stream_map(start_date, end_date, level, bbox)
+
+    def get_turnover(self, start_date: date, end_date: date, by: T.Iterable[str] = ()) -> dict:
+        return self._coalesced('get_turnover', start_date, end_date, tuple(_check_dimensions(by)))
+
+    def get_turnover_by_age_and_gender(self, start_date: date, end_date: date) -> dict:
+        return self._coalesced('get_turnover_by_age_and_gender', start_date, end_date)
+
+    def get_turnover_by_time_and_gender(self, start_date: date, end_date: date) -> dict:
+        return self._coalesced('get_turnover_by_time_and_gender', start_date, end_date)
+
+    def get_turnover_by_postal_code(
+            self, start_date: date, end_date: date, postal_code_ids: T.Iterable[int] = None) -> dict:
+        if postal_code_ids is not None:
+            postal_code_ids = tuple(sorted(postal_code_ids))
+
+        return self._coalesced('get_turnover_by_postal_code', start_date, end_date, postal_code_ids)
+
+    def stats(self) -> dict:
+        return self.flights.stats()
+
+    def _coalesced(self, method: str, *args) -> dict:
+        key = ':'.join(str(part) for part in (method, *args))
+        return self.flights.do(key, lambda: getattr(self.service, method)(*args))
+
+
+def build_geometry_store(config: Config) -> GeometryStore:
+    service_config = config.query_service
+
+    if service_config.query_service_class == 'ColumnarQueryService' and service_config.columnar_source == 'csv':
+        return GeometryStore(
+            path=config.data.postalcodes,
+            prerender=service_config.prerender_geometries,
+            quantization=service_config.topology_quantization,
         )
 
-        data = _get_aggregate_by_time_and_gender_dictionary(start_date, end_date)
+    return GeometryStore(
+        prerender=service_config.prerender_geometries,
+        quantization=service_config.topology_quantization,
+    )
+
+
+def build_query_service(config: Config, geometries: GeometryStore = None) -> AbstractQueryService:
+    service_config = config.query_service
+    service_class = service_config.query_service_class
 
-        for tm, gender, amount in res:
-            data[tm][gender] += amount
+    if geometries is None:
+        geometries = build_geometry_store(config)
 
+    if service_class == 'PostgresQueryService':
+        service = PostgresQueryService(geometries=geometries, geometry_format=service_config.geometry_format)
+    elif service_class == 'ColumnarQueryService' and service_config.columnar_source == 'csv':
+        service = ColumnarQueryService(
+            payments_path=config.data.payments,
+            postal_codes_path=config.data.postalcodes,
+            use_cube=service_config.prefix_sum_cube,
+            geometries=geometries,
+            geometry_format=service_config.geometry_format,
+        )
+    elif service_class == 'ColumnarQueryService':
+        service = ColumnarQueryService(
+            use_cube=service_config.prefix_sum_cube,
+            geometries=geometries,
+            geometry_format=service_config.geometry_format,
+        )
+    else:
+        raise InvalidQueryService(f"Query service {service_class} not found")
+
+    # Below the cache, so a burst of misses for the same entry runs a single query
+    if config.coalescing.enabled:
+        service = CoalescingQueryService(service, build_single_flight(config.coalescing))
+
+    if config.cache.enabled:
+        service = CachedQueryService(service, cache.build_cache(config.cache))
+
+    return service
+
+
+def build_single_flight(config: CoalescingConfig) -> SingleFlight:
+    return SingleFlight(lock_dir=config.lock_dir, timeout=config.timeout)
+
+
+def _render_map(aggregates: T.Dict[int, dict], geometries: GeometryStore, geometry_format: str, level: int) -> dict:
+    """Merges turnover by postal code id with the postal code geometries, summing up ids sharing a code"""
+    started = time.perf_counter()
+    bytes_saved = decodes_saved = 0
+    geometries.simplify(level)
+
+    data = {}
+    for postal_code_id, aggregate in aggregates.items():
+        geometry = geometries.get(postal_code_id)
+        if geometry.code not in data:
+            data[geometry.code] = _get_base_dictionary()
+
+        data[geometry.code]["geometry"] = geometry.render(geometry_format, level)
+        if geometry_format == 'geojson':
+            decodes_saved += 1
+
+        for age, genders in aggregate.items():
+            for gender, amount in genders.items():
+                data[geometry.code]["aggregate"][age][gender] += amount
+
+                # What the geometry would have weighted in the result set had it been joined in SQL
+                if amount:
+                    bytes_saved += len(geometry.wkb)
+
+    result = {
+        "results": [
+            {
+                "geometry": data[code]["geometry"],
+                "turnover": data[code]["aggregate"]
+            }
+            for code in data
+        ]
+    }
+
+    elapsed = time.perf_counter() - started
+    geometries.record_request(bytes_saved, elapsed, decodes_saved)
+    metrics.processing_duration.observe(elapsed, step='render_map')
+
+    return result
+
+
+def _stream_map(
+        aggregates: T.Iterable[T.Tuple[int, dict]],
+        geometries: GeometryStore,
+        geometry_format: str,
+        level: int,
+) -> T.Iterator[dict]:
+    """Results of the map one at a time, out of (postal code id, turnover) pairs where ids sharing a
+    code come one after the other"""
+    geometries.simplify(level)
+
+    for code, group in itertools.groupby(aggregates, key=lambda item: geometries.get(item[0]).code):
+        result = {"geometry": None, "turnover": _get_aggregate_by_age_and_gender_dictionary()}
+
+        for postal_code_id, aggregate in group:
+            result["geometry"] = geometries.get(postal_code_id).render(geometry_format, level)
+            for age, genders in aggregate.items():
+                for gender, amount in genders.items():
+                    result["turnover"][age][gender] += amount
+
+        yield result
+
+
+@metrics.processing_duration.timed(step='render_topology')
+def _render_topology(aggregates: T.Dict[int, dict], geometries: GeometryStore, level: int) -> dict:
+    """Attaches turnover by postal code id to the features of the postal code topology, one per code"""
+    ids_by_code: T.Dict[str, T.List[int]] = {}
+    turnover_by_code: T.Dict[str, dict] = {}
+
+    for postal_code_id, aggregate in aggregates.items():
+        code = geometries.get(postal_code_id).code
+        if code not in ids_by_code:
+            ids_by_code[code] = []
+            turnover_by_code[code] = _get_aggregate_by_age_and_gender_dictionary()
+
+        ids_by_code[code].append(postal_code_id)
+        for age, genders in aggregate.items():
+            for gender, amount in genders.items():
+                turnover_by_code[code][age][gender] += amount
+
+    features = [(code, ids, {"turnover": turnover_by_code[code]}) for code, ids in ids_by_code.items()]
+    return geometries.topology(level).to_topojson('postal_codes', features, geometries.quantization)
+
+
+def _turnover_by_postal_code_results(res: T.Iterable[T.Tuple]) -> dict:
+    with metrics.processing_duration.time(step='turnover_by_postal_code'):
+        data = {}
+        for postal_code_id, age, gender, sum_ in res:
+            if postal_code_id not in data:
+                data[postal_code_id] = _get_aggregate_by_age_and_gender_dictionary()
+
+            data[postal_code_id][age][gender] += sum_
+
+    return {
+        "results": data
+    }
+
+
+def _turnover_results(res: T.List[T.Tuple], by: T.List[Dimension], start_date: date, end_date: date, name: str) -> dict:
+    if not by:
         return {
-            "results": data
+            "results": res[0][0]
         }
 
+    with metrics.processing_duration.time(step=name):
+        rows = [
+            ([DIMENSIONS[dimension].key(value) for dimension, value in zip(by, values)], amount)
+            for *values, amount in res
+        ]
+        present = {}
+        if Dimension.PostalCode in by:
+            position = by.index(Dimension.PostalCode)
+            present[Dimension.PostalCode] = sorted({keys[position] for keys, _ in rows})
+
+        data = _get_dense_dictionary(by, start_date, end_date, present)
+
+        for keys, amount in rows:
+            _add_to_dense_dictionary(data, keys, amount)
+
+    return {
+        "results": data
+    }
+
+
+def _aggregates_by_postal_code(rows: T.Iterable[T.Tuple]) -> T.Iterator[T.Tuple[int, dict]]:
+    """(postal code id, turnover) pairs out of (postal code id, age, gender, sum) rows sorted by id"""
+    for postal_code_id, group in itertools.groupby(rows, key=lambda row: row[0]):
+        yield postal_code_id, _aggregate_by_age_and_gender((age, gender, sum_) for _, age, gender, sum_ in group)
+
+
+def _aggregate_by_age_and_gender(rows: T.Iterable[T.Tuple[str, str, T.Any]]) -> dict:
+    data = _get_aggregate_by_age_and_gender_dictionary()
+    for age, gender, amount in rows:
+        data[age][gender] += amount
+
+    return data
+
+
+def _fill_age_and_gender(data: dict, sums: T.Iterable[T.Iterable[float]]):
+    for age, row in zip(Age, sums):
+        for gender, amount in zip(Gender, row):
+            data[age][gender] += float(amount)
+
 
 def _get_base_dictionary() -> dict:
     base = {"geometry": None, "aggregate": {}}
@@ -145,24 +1018,56 @@ def _get_base_dictionary() -> dict:
 
 
 def _get_aggregate_by_age_and_gender_dictionary() -> dict:
-    base = {}
-    for age in Age:
-        base[age] = {}
-        for gender in Gender:
-            base[age][gender] = 0
-    return base
+    return _get_dense_dictionary((Dimension.Age, Dimension.Gender))
 
 
 def _get_aggregate_by_time_and_gender_dictionary(start_date: date, end_date: date) -> dict:
-    base = {}
+    return _get_dense_dictionary((Dimension.Month, Dimension.Gender), start_date, end_date)
+
+
+def _get_dense_dictionary(
+        dimensions: T.Sequence[Dimension],
+        start_date: date = None,
+        end_date: date = None,
+        present: T.Dict[Dimension, T.List] = None,
+):
+    """Nested dictionaries holding a 0 for every key of `dimensions`. Keys of dimensions keyed by what
+    has payments are taken from `present`."""
+    if not dimensions:
+        return 0
+
+    keys = DIMENSIONS[dimensions[0]].keys
+    keys = keys(start_date, end_date) if keys is not None else present[dimensions[0]]
+
+    return {key: _get_dense_dictionary(dimensions[1:], start_date, end_date, present) for key in keys}
+
+
+def _add_to_dense_dictionary(data: dict, keys: T.Sequence, amount: T.Any):
+    for key in keys[:-1]:
+        data = data[key]
+
+    data[keys[-1]] += amount
+
+
+def _check_dimensions(by: T.Iterable[str]) -> T.List[Dimension]:
+    try:
+        dimensions = [Dimension(dimension) for dimension in by]
+    except ValueError:
+        names = ', '.join(dimension.value for dimension in Dimension)
+        raise InvalidDimension(f"Turnover can only be grouped by {names}")
+
+    if len(set(dimensions)) != len(dimensions):
+        raise InvalidDimension("Turnover can't be grouped twice by the same dimension")
+
+    return dimensions
+
+
+def _months_between(start_date: date, end_date: date) -> T.List[str]:
+    months = []
     delta = relativedelta(months=1)
+    start_date = start_date.replace(day=1)
     while start_date <= end_date:
-        key = start_date.strftime('%Y-%m')
+        months.append(start_date.strftime('%Y-%m'))
         start_date += delta
 
-        base[key] = {}
-
-        for gender in Gender:
-            base[key][gender] = 0
-
-    return base
+    return months
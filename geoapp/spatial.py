@@ -0,0 +1,83 @@
+import math
+import typing as T
+
+
+# (min x, min y, max x, max y)
+Bounds = T.Tuple[float, float, float, float]
+# A node is (bounds, children). Children of leaves are the indexed keys, those of inner nodes are nodes.
+Node = T.Tuple[Bounds, T.List[T.Any]]
+
+
+class STRTree:
+    """Static R-tree over bounding boxes, bulk loaded with Sort-Tile-Recursive packing.
+
+    Entries are sorted by the x of their centre, cut into vertical slices, and each slice sorted by y
+    and cut into full nodes, level after level. Nodes barely overlap, so a query visits few of them.
+    The tree can't be modified, build a new one when the indexed boxes change.
+    """
+
+    def __init__(self, items: T.Dict[T.Any, Bounds], node_capacity: int = 16):
+        if node_capacity < 2:
+            raise ValueError("Nodes must hold at least two children")
+
+        self.node_capacity = node_capacity
+        self.size = len(items)
+
+        nodes = self._pack([(bounds, key) for key, bounds in items.items()])
+        self.height = 1
+        while len(nodes) > 1:
+            nodes = self._pack(nodes)
+            self.height += 1
+
+        self.root: T.Optional[Node] = nodes[0] if nodes else None
+
+    def __len__(self) -> int:
+        return self.size
+
+    def query(self, bounds: Bounds) -> T.List[T.Any]:
+        """Keys of the boxes intersecting `bounds`, edges included"""
+        if self.root is None:
+            return []
+
+        found = []
+        stack = [(self.root, 1)]
+        while stack:
+            (node_bounds, children), depth = stack.pop()
+            if not intersects(node_bounds, bounds):
+                continue
+
+            if depth == self.height:
+                found.extend(key for child_bounds, key in children if intersects(child_bounds, bounds))
+            else:
+                stack.extend((child, depth + 1) for child in children)
+
+        return found
+
+    def _pack(self, entries: T.List[T.Tuple[Bounds, T.Any]]) -> T.List[Node]:
+        if not entries:
+            return []
+
+        capacity = self.node_capacity
+        node_count = math.ceil(len(entries) / capacity)
+        slice_size = capacity * math.ceil(math.sqrt(node_count))
+
+        entries = sorted(entries, key=lambda entry: entry[0][0] + entry[0][2])
+
+        nodes = []
+        for start in range(0, len(entries), slice_size):
+            vertical_slice = sorted(entries[start:start + slice_size], key=lambda entry: entry[0][1] + entry[0][3])
+
+            for node_start in range(0, len(vertical_slice), capacity):
+                children = vertical_slice[node_start:node_start + capacity]
+                nodes.append((_union(bounds for bounds, _ in children), children))
+
+        return nodes
+
+
+def intersects(a: Bounds, b: Bounds) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def _union(boxes: T.Iterable[Bounds]) -> Bounds:
+    min_xs, min_ys, max_xs, max_ys = zip(*boxes)
+    return min(min_xs), min(min_ys), max(max_xs), max(max_ys)
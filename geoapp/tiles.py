@@ -0,0 +1,304 @@
+from datetime import date
+import math
+import struct
+import typing as T
+
+from geoapp import cache, conditional, db
+from geoapp.geometry import Bounds, GeometryStore, level_for
+from geoapp.models import Age, Gender
+
+
+TCacheBackend = T.Type[cache.CacheBackend]
+TileRing = T.List[T.Tuple[int, int]]
+
+LAYER_NAME = 'postal_codes'
+MAX_ZOOM = 24
+
+MVT_POLYGON = 3
+MVT_MOVE_TO = 1
+MVT_LINE_TO = 2
+MVT_CLOSE_PATH = 7
+
+
+class InvalidTile(Exception):
+    pass
+
+
+class TileService:
+    """Renders postal codes and their turnover as Mapbox Vector Tiles.
+
+    Turnover comes from the query service, geometries from the geometry store, simplified for the
+    zoom of the tile. Tiles are cached per data version, so hot tiles skip the database entirely.
+    """
+
+    def __init__(
+            self,
+            query_service,
+            geometries: GeometryStore,
+            cache_backend: TCacheBackend = None,
+            version: db.DataVersion = None,
+            extent: int = 4096,
+            buffer: int = 64,
+    ):
+        if version is None:
+            version = db.data_version
+
+        self.query_service = query_service
+        self.geometries = geometries
+        self.cache = cache_backend
+        self.version = version
+        self.extent = extent
+        self.buffer = buffer
+
+        if self.cache is not None:
+            self.version.subscribe(self._on_data_changed)
+
+    def get_tile(self, start_date: date, end_date: date, z: int, x: int, y: int) -> bytes:
+        if not 0 <= z <= MAX_ZOOM or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+            raise InvalidTile(f"Tile {z}/{x}/{y} does not exist")
+
+        if self.cache is None:
+            return self._render(start_date, end_date, z, x, y)
+
+        key = ':'.join(str(part) for part in (self.version.current(), 'tile', start_date, end_date, z, x, y))
+
+        tile = self.cache.get(key)
+        if tile is cache.MISSING:
+            with conditional.tracking_staleness() as stale:
+                tile = self._render(start_date, end_date, z, x, y)
+
+            # Turnover the query cache kept serving past a load is not that of this version
+            if not stale.is_set():
+                self.cache.set(key, tile)
+
+        return tile
+
+    def _render(self, start_date: date, end_date: date, z: int, x: int, y: int) -> bytes:
+        postal_code_ids = self.geometries.ids_within(tile_bounds(z, x, y, margin=self.buffer / self.extent))
+        if not postal_code_ids:
+            return encode_tile(LAYER_NAME, [], self.extent)
+
+        aggregates = self.query_service.get_turnover_by_postal_code(start_date, end_date, postal_code_ids)["results"]
+
+        level = level_for(zoom=z)
+        self.geometries.simplify(level)
+
+        features = []
+        for postal_code_id in postal_code_ids:
+            aggregate = aggregates.get(postal_code_id)
+            if aggregate is None:
+                continue
+
+            geometry = self.geometries.get(postal_code_id)
+            rings = self._project(geometry.render('geojson', level), z, x, y)
+            if not rings:
+                continue
+
+            properties = {"code": geometry.code, "total": 0.0}
+            for age in Age:
+                for gender in Gender:
+                    amount = float(aggregate[age][gender])
+                    properties[f"{age.value}_{gender.value}"] = amount
+                    properties["total"] += amount
+
+            features.append((postal_code_id, properties, rings))
+
+        return encode_tile(LAYER_NAME, features, self.extent)
+
+    def _project(self, geojson: dict, z: int, x: int, y: int) -> T.List[TileRing]:
+        """Rings of a polygon in tile coordinates, clipped to the tile and its buffer, exterior rings
+        wound as the MVT spec expects"""
+        polygons = [geojson["coordinates"]] if geojson["type"] == 'Polygon' else geojson["coordinates"]
+        low, high = -self.buffer, self.extent + self.buffer
+
+        rings = []
+        for polygon in polygons:
+            for i, ring in enumerate(polygon):
+                projected = [_to_tile(lon, lat, z, x, y, self.extent) for lon, lat in ring]
+                clipped = _round_ring(_clip(projected, low, high))
+
+                if len(clipped) < 3 or not _area(clipped):
+                    if i == 0:
+                        # Without its exterior ring, the holes of the polygon are meaningless
+                        break
+                    continue
+
+                # Positive area in tile coordinates (y pointing down) marks exterior rings
+                if (_area(clipped) > 0) != (i == 0):
+                    clipped.reverse()
+
+                rings.append(clipped)
+
+        return rings
+
+    def _on_data_changed(self, version: int, months: T.Optional[T.List[date]]):
+        self.cache.clear()
+
+
+def tile_bounds(z: int, x: int, y: int, margin: float = 0.0) -> Bounds:
+    """Longitude and latitude bounds of a tile, optionally grown by a fraction of its size"""
+    n = 2 ** z
+
+    def lon(tile_x: float) -> float:
+        return tile_x / n * 360.0 - 180.0
+
+    def lat(tile_y: float) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+    return lon(x - margin), lat(y + 1 + margin), lon(x + 1 + margin), lat(y - margin)
+
+
+def _to_tile(lon: float, lat: float, z: int, x: int, y: int, extent: int) -> T.Tuple[float, float]:
+    n = 2 ** z
+    lat = max(min(lat, 85.0511287798), -85.0511287798)
+    sin = math.sin(math.radians(lat))
+
+    tile_x = (lon + 180.0) / 360.0 * n
+    tile_y = (0.5 - math.log((1 + sin) / (1 - sin)) / (4 * math.pi)) * n
+
+    return (tile_x - x) * extent, (tile_y - y) * extent
+
+
+def _clip(ring: T.List[T.Tuple[float, float]], low: float, high: float) -> T.List[T.Tuple[float, float]]:
+    """Sutherland-Hodgman clipping of a ring against the square [low, high]"""
+    edges = (
+        (0, low, lambda value: value >= low),
+        (0, high, lambda value: value <= high),
+        (1, low, lambda value: value >= low),
+        (1, high, lambda value: value <= high),
+    )
+
+    points = ring[:-1] if len(ring) > 1 and ring[0] == ring[-1] else ring
+    for axis, limit, inside in edges:
+        if not points:
+            break
+
+        clipped = []
+        previous = points[-1]
+        for point in points:
+            if inside(point[axis]):
+                if not inside(previous[axis]):
+                    clipped.append(_intersection(previous, point, axis, limit))
+                clipped.append(point)
+            elif inside(previous[axis]):
+                clipped.append(_intersection(previous, point, axis, limit))
+            previous = point
+
+        points = clipped
+
+    return points
+
+
+def _intersection(a: T.Tuple[float, float], b: T.Tuple[float, float], axis: int, limit: float) -> T.Tuple[float, float]:
+    t = (limit - a[axis]) / (b[axis] - a[axis])
+    other = a[1 - axis] + (b[1 - axis] - a[1 - axis]) * t
+
+    return (limit, other) if axis == 0 else (other, limit)
+
+
+def _round_ring(points: T.List[T.Tuple[float, float]]) -> TileRing:
+    ring = []
+    for x, y in points:
+        point = (int(round(x)), int(round(y)))
+        if not ring or point != ring[-1]:
+            ring.append(point)
+
+    while len(ring) > 1 and ring[0] == ring[-1]:
+        ring.pop()
+
+    return ring
+
+
+def _area(ring: TileRing) -> float:
+    return sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(ring, ring[1:] + ring[:1])) / 2
+
+
+# Protocol buffers encoding of https://github.com/mapbox/vector-tile-spec/blob/master/2.1/vector_tile.proto
+
+def encode_tile(layer_name: str, features: T.List[T.Tuple[int, dict, T.List[TileRing]]], extent: int = 4096) -> bytes:
+    keys: T.Dict[str, int] = {}
+    values: T.Dict[T.Any, int] = {}
+
+    encoded_features = []
+    for id_, properties, rings in features:
+        tags = []
+        for key, value in properties.items():
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value), value), len(values)))
+
+        feature = (
+            _field(1, 0) + _varint(id_)
+            + _field(2, 2) + _length_delimited(b''.join(_varint(tag) for tag in tags))
+            + _field(3, 0) + _varint(MVT_POLYGON)
+            + _field(4, 2) + _length_delimited(b''.join(_varint(command) for command in _polygon_commands(rings)))
+        )
+        encoded_features.append(_field(2, 2) + _length_delimited(feature))
+
+    layer = (
+        _field(15, 0) + _varint(2)
+        + _field(1, 2) + _length_delimited(layer_name.encode())
+        + b''.join(encoded_features)
+        + b''.join(_field(3, 2) + _length_delimited(key.encode()) for key in keys)
+        + b''.join(_field(4, 2) + _length_delimited(_value(value)) for _, value in values)
+        + _field(5, 0) + _varint(extent)
+    )
+
+    return _field(3, 2) + _length_delimited(layer)
+
+
+def _polygon_commands(rings: T.List[TileRing]) -> T.Iterator[int]:
+    cursor_x = cursor_y = 0
+
+    for ring in rings:
+        for i, (x, y) in enumerate(ring):
+            if i == 0:
+                yield _command(MVT_MOVE_TO, 1)
+            elif i == 1:
+                yield _command(MVT_LINE_TO, len(ring) - 1)
+
+            yield _zigzag(x - cursor_x)
+            yield _zigzag(y - cursor_y)
+            cursor_x, cursor_y = x, y
+
+        yield _command(MVT_CLOSE_PATH, 1)
+
+
+def _value(value: T.Any) -> bytes:
+    if isinstance(value, str):
+        return _field(1, 2) + _length_delimited(value.encode())
+
+    if isinstance(value, bool):
+        return _field(7, 0) + _varint(int(value))
+
+    if isinstance(value, int):
+        return _field(6, 0) + _varint(_zigzag(value))
+
+    return _field(3, 1) + struct.pack('<d', value)
+
+
+def _command(command: int, count: int) -> int:
+    return (command & 0x7) | (count << 3)
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+def _field(number: int, wire_type: int) -> bytes:
+    return _varint((number << 3) | wire_type)
+
+
+def _length_delimited(payload: bytes) -> bytes:
+    return _varint(len(payload)) + payload
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
@@ -0,0 +1,318 @@
+import typing as T
+
+
+Point = T.Tuple[float, float]
+Arc = T.List[Point]
+Rings = T.List[T.List[int]]
+# Features of a TopoJSON output: (id, keys of the objects making up its geometry, properties)
+Feature = T.Tuple[T.Any, T.List[T.Any], dict]
+
+
+class Topology:
+    """Polygons decomposed into arcs shared between neighbouring rings.
+
+    Rings are cut at junctions, the points where neighbouring rings stop sharing their boundary,
+    and each resulting arc is stored once. Rings refer to arcs by index, `~index` meaning the arc
+    is walked backwards, as in TopoJSON. Simplifying the arcs rather than each ring keeps shared
+    borders identical on both sides, so no gaps or overlaps appear between neighbours.
+    """
+
+    def __init__(self, arcs: T.List[Arc], objects: T.Dict[T.Any, T.Tuple[str, T.List[Rings]]]):
+        self.arcs = arcs
+        # Object key -> (GeoJSON type, polygons as lists of rings of arc references)
+        self.objects = objects
+
+        self._fallback: T.Optional[Topology] = None
+        self._encoded: T.Dict[int, T.Tuple[dict, T.List[T.List[T.List[int]]]]] = {}
+
+    @classmethod
+    def from_geometries(cls, geometries: T.Dict[T.Any, dict]) -> 'Topology':
+        """Builds a topology out of GeoJSON Polygons and MultiPolygons"""
+        polygons_by_key = {key: _polygons(geometry) for key, geometry in geometries.items()}
+
+        junctions = _find_junctions(
+            ring for polygons in polygons_by_key.values() for polygon in polygons for ring in polygon
+        )
+
+        arcs: T.List[Arc] = []
+        index: T.Dict[T.Tuple[Point, ...], int] = {}
+
+        def reference(arc: Arc) -> int:
+            key = tuple(arc)
+            if key in index:
+                return index[key]
+
+            reversed_key = key[::-1]
+            if reversed_key in index:
+                return ~index[reversed_key]
+
+            index[key] = len(arcs)
+            arcs.append(arc)
+            return index[key]
+
+        objects = {}
+        for key, polygons in polygons_by_key.items():
+            objects[key] = (
+                geometries[key]["type"],
+                [[[reference(arc) for arc in _cut(ring, junctions)] for ring in polygon] for polygon in polygons],
+            )
+
+        return cls(arcs, objects)
+
+    def simplify(self, tolerance: float, precision: int = None) -> 'Topology':
+        """Returns a topology whose arcs are simplified with Douglas-Peucker and rounded to `precision`
+        decimals. Arc ends are kept, and so are rings that would collapse below a triangle."""
+        arcs = []
+        for arc in self.arcs:
+            if tolerance > 0:
+                arc = _douglas_peucker(arc, tolerance)
+
+            if precision is not None:
+                arc = _round(arc, precision)
+
+            arcs.append(arc)
+
+        simplified = Topology(arcs, self.objects)
+        simplified._fallback = self
+
+        return simplified
+
+    def geometry(self, key: T.Any) -> dict:
+        type_, polygons = self.objects[key]
+        coordinates = [[self._ring(ring) for ring in polygon] for polygon in polygons]
+
+        if type_ == 'Polygon':
+            return {"type": type_, "coordinates": coordinates[0]}
+
+        return {"type": type_, "coordinates": coordinates}
+
+    def geometries(self) -> T.Dict[T.Any, dict]:
+        return {key: self.geometry(key) for key in self.objects}
+
+    def encoded_arcs(self, quantization: int) -> T.Tuple[dict, T.List[T.List[T.List[int]]]]:
+        """TopoJSON transform and arcs, quantized to a `quantization` wide grid over the bounding box
+        of the topology and delta encoded. Computed once per quantization."""
+        if quantization not in self._encoded:
+            self._encoded[quantization] = _encode_arcs(self.arcs, quantization)
+
+        return self._encoded[quantization]
+
+    def to_topojson(self, name: str, features: T.Iterable[Feature], quantization: int = 100000) -> dict:
+        """A TopoJSON topology holding `features` as a GeometryCollection called `name`.
+
+        Only the arcs the features refer to are included. Objects missing from the topology are
+        skipped, features without any object get a null geometry.
+        """
+        transform, encoded = self.encoded_arcs(quantization)
+        arcs: T.List[T.List[T.List[int]]] = []
+        renumbered: T.Dict[int, int] = {}
+
+        def reference(arc: int) -> int:
+            index = arc if arc >= 0 else ~arc
+            if index not in renumbered:
+                renumbered[index] = len(arcs)
+                arcs.append(encoded[index])
+
+            return renumbered[index] if arc >= 0 else ~renumbered[index]
+
+        geometries = []
+        for id_, keys, properties in features:
+            types, polygons = set(), []
+            for key in keys:
+                if key in self.objects:
+                    type_, key_polygons = self.objects[key]
+                    types.add(type_)
+                    polygons.extend(key_polygons)
+
+            geometry = {"type": None, "id": id_, "properties": properties}
+            if types == {'Polygon'} and len(polygons) == 1:
+                geometry["type"] = 'Polygon'
+                geometry["arcs"] = [[reference(arc) for arc in ring] for ring in polygons[0]]
+            elif polygons:
+                geometry["type"] = 'MultiPolygon'
+                geometry["arcs"] = [[[reference(arc) for arc in ring] for ring in polygon] for polygon in polygons]
+
+            geometries.append(geometry)
+
+        return {
+            "type": 'Topology',
+            "transform": transform,
+            "objects": {name: {"type": 'GeometryCollection', "geometries": geometries}},
+            "arcs": arcs,
+        }
+
+    def arc(self, reference: int) -> Arc:
+        if reference >= 0:
+            return self.arcs[reference]
+
+        return self.arcs[~reference][::-1]
+
+    def _ring(self, references: T.List[int]) -> T.List[T.List[float]]:
+        points = _join(self.arc(reference) for reference in references)
+
+        # A closed ring needs at least 4 points, fall back to a less simplified version
+        if len(points) < 4 and self._fallback is not None:
+            return self._fallback._ring(references)
+
+        return [list(point) for point in points]
+
+
+def _polygons(geometry: dict) -> T.List[T.List[T.List[Point]]]:
+    """Polygons of a geometry as lists of open rings of point tuples"""
+    if geometry["type"] == 'Polygon':
+        polygons = [geometry["coordinates"]]
+    elif geometry["type"] == 'MultiPolygon':
+        polygons = geometry["coordinates"]
+    else:
+        raise ValueError(f"Only polygons can be part of a topology, got {geometry['type']}")
+
+    result = []
+    for polygon in polygons:
+        rings = []
+        for ring in polygon:
+            ring = [tuple(point) for point in ring]
+            if len(ring) > 1 and ring[0] == ring[-1]:
+                ring = ring[:-1]
+            rings.append(ring)
+        result.append(rings)
+
+    return result
+
+
+def _find_junctions(rings: T.Iterable[T.List[Point]]) -> T.Set[Point]:
+    """Points where the boundary shared by two rings starts or ends.
+
+    Those are the points visited with different neighbours by different rings (or by the same ring twice).
+    """
+    neighbours: T.Dict[Point, T.Tuple[Point, Point]] = {}
+    junctions = set()
+
+    for ring in rings:
+        n = len(ring)
+        for i, point in enumerate(ring):
+            previous, next_ = ring[i - 1], ring[(i + 1) % n]
+            pair = (previous, next_) if previous <= next_ else (next_, previous)
+
+            seen = neighbours.setdefault(point, pair)
+            if seen != pair:
+                junctions.add(point)
+
+    return junctions
+
+
+def _cut(ring: T.List[Point], junctions: T.Set[Point]) -> T.List[Arc]:
+    """Splits an open ring into arcs ending at junctions"""
+    starts = [i for i, point in enumerate(ring) if point in junctions]
+
+    if not starts:
+        # Closed arc. Start it at its smallest point so the same ring is always stored the same way.
+        first = min(range(len(ring)), key=ring.__getitem__)
+        rotated = ring[first:] + ring[:first]
+        return [rotated + [rotated[0]]]
+
+    rotated = ring[starts[0]:] + ring[:starts[0]]
+    closed = rotated + [rotated[0]]
+
+    arcs = []
+    start = 0
+    for i in range(1, len(closed)):
+        if closed[i] in junctions or i == len(closed) - 1:
+            arcs.append(closed[start:i + 1])
+            start = i
+
+    return arcs
+
+
+def _encode_arcs(arcs: T.List[Arc], quantization: int) -> T.Tuple[dict, T.List[T.List[T.List[int]]]]:
+    if quantization < 2:
+        raise ValueError("Quantization must be at least 2")
+
+    points = [point for arc in arcs for point in arc]
+    if not points:
+        return {"scale": [1, 1], "translate": [0, 0]}, []
+
+    xs, ys = [x for x, _ in points], [y for _, y in points]
+    x0, y0 = min(xs), min(ys)
+    kx = (max(xs) - x0) / (quantization - 1) or 1
+    ky = (max(ys) - y0) / (quantization - 1) or 1
+
+    encoded = []
+    for arc in arcs:
+        deltas = []
+        previous_x = previous_y = 0
+        for i, (x, y) in enumerate(arc):
+            qx, qy = round((x - x0) / kx), round((y - y0) / ky)
+
+            # Points landing on the same grid cell are dropped, but arcs always keep both ends
+            if i and qx == previous_x and qy == previous_y and i < len(arc) - 1:
+                continue
+
+            deltas.append([qx - previous_x, qy - previous_y])
+            previous_x, previous_y = qx, qy
+
+        encoded.append(deltas)
+
+    return {"scale": [kx, ky], "translate": [x0, y0]}, encoded
+
+
+def _join(arcs: T.Iterable[Arc]) -> Arc:
+    points: Arc = []
+    for arc in arcs:
+        points.extend(arc if not points else arc[1:])
+
+    return points
+
+
+def _douglas_peucker(points: Arc, tolerance: float) -> Arc:
+    if len(points) <= 2:
+        return list(points)
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    squared_tolerance = tolerance * tolerance
+
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+
+        furthest, furthest_distance = None, squared_tolerance
+        for i in range(start + 1, end):
+            distance = _squared_segment_distance(points[i], points[start], points[end])
+            if distance > furthest_distance:
+                furthest, furthest_distance = i, distance
+
+        if furthest is not None:
+            keep[furthest] = True
+            stack.append((start, furthest))
+            stack.append((furthest, end))
+
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def _squared_segment_distance(point: Point, start: Point, end: Point) -> float:
+    x, y = start
+    dx, dy = end[0] - x, end[1] - y
+
+    if dx or dy:
+        t = ((point[0] - x) * dx + (point[1] - y) * dy) / (dx * dx + dy * dy)
+        if t > 1:
+            x, y = end
+        elif t > 0:
+            x, y = x + dx * t, y + dy * t
+
+    dx, dy = point[0] - x, point[1] - y
+    return dx * dx + dy * dy
+
+
+def _round(points: Arc, precision: int) -> Arc:
+    rounded = []
+    for x, y in points:
+        point = (round(x, precision), round(y, precision))
+        if not rounded or point != rounded[-1]:
+            rounded.append(point)
+
+    # Arcs must keep both ends, even when they collapse onto a single point
+    if len(rounded) == 1 and len(points) > 1:
+        rounded.append(rounded[0])
+
+    return rounded
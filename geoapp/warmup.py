@@ -0,0 +1,162 @@
+import contextlib
+from datetime import date, timedelta
+import logging
+import threading
+import time
+import typing as T
+
+from dateutil.relativedelta import relativedelta
+
+from config.config import WarmupConfig
+from geoapp import db
+from geoapp.services import AbstractQueryService, CachedQueryService
+
+logger = logging.getLogger(__name__)
+
+
+# How often the background thread checks for data changes, rather than waiting for requests to notice them
+CHECK_INTERVAL = 1.0
+
+
+TDatabase = T.Type[db.Database]
+Query = T.Tuple[str, tuple]
+
+
+class CacheWarmer:
+    """Precomputes the responses of popular date ranges into the cache of a query service.
+
+    Those are the configured ranges over the months with data, and the queries requested the most of
+    late. With `refresh`, a background thread computes them again after every data change, while the
+    outdated responses keep being served.
+    """
+
+    def __init__(self, service: CachedQueryService, config: WarmupConfig, database: TDatabase = None):
+        if database is None:
+            database = db.database
+
+        self.service = service
+        self.config = config
+        self.db = database
+
+        self._wake = threading.Event()
+        self._thread: T.Optional[threading.Thread] = None
+        self._subscribed = False
+
+        if config.popularity_path:
+            service.popularity.load(config.popularity_path)
+
+    def ranges(self) -> T.List[T.Tuple[date, date]]:
+        first, last = self.db.execute_query(
+            "SELECT MIN(p_month), MAX(p_month) FROM PaymentsByMonth", name='data_months'
+        )[0]
+        if first is None:
+            return []
+
+        ranges = []
+        if self.config.all_data:
+            ranges.append((first, _end_of_month(last)))
+
+        if self.config.years:
+            ranges.extend((date(year, 1, 1), date(year, 12, 31)) for year in range(first.year, last.year + 1))
+
+        if self.config.quarters:
+            quarter = date(first.year, 3 * ((first.month - 1) // 3) + 1, 1)
+            while quarter <= last:
+                ranges.append((quarter, _end_of_month(quarter + relativedelta(months=2))))
+                quarter += relativedelta(months=3)
+
+        for months in self.config.last_months:
+            ranges.append((last - relativedelta(months=months - 1), _end_of_month(last)))
+
+        return list(dict.fromkeys(ranges))
+
+    def queries(self) -> T.List[Query]:
+        configured = [(method, range_) for range_ in self.ranges() for method in self.config.methods]
+        observed = [(method, tuple(args)) for method, *args in self.service.popularity.top(self.config.top_observed)]
+
+        return list(dict.fromkeys(configured + observed))
+
+    def warm(self) -> int:
+        """Computes every query not up to date in the cache, returns how many were run"""
+        started = time.perf_counter()
+        queries = self.queries()
+
+        with self.service.warming() if self.config.refresh else contextlib.nullcontext():
+            for method, args in queries:
+                try:
+                    getattr(self.service, method)(*args)
+                except Exception:
+                    logger.exception(f"Couldn't warm up {method}{args}")
+
+        logger.info(f"Warmed up {len(queries)} queries in {time.perf_counter() - started:.2f}s")
+        return len(queries)
+
+    def start(self, warm: bool = False):
+        """Refreshes warm entries in the background after data changes, and saves popular queries.
+
+        With `warm`, the thread warms the cache up first, so the caller doesn't wait for it. Can be
+        called again in a forked process, where the thread of its parent doesn't run.
+        """
+        if warm:
+            self._wake.set()
+        elif not (self.config.refresh or self.config.popularity_path):
+            return
+
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        if self.config.refresh and not self._subscribed:
+            self.service.version.subscribe(self._on_data_changed)
+            self._subscribed = True
+
+        self._thread = threading.Thread(target=self._run, name='cache-warmer', daemon=True)
+        self._thread.start()
+
+    def _on_data_changed(self, version: int, months: T.Optional[T.List[date]]):
+        self._wake.set()
+
+    def _run(self):
+        saved_at = time.monotonic()
+
+        while True:
+            if self._wake.wait(CHECK_INTERVAL):
+                self._wake.clear()
+                self.warm()
+            elif self.config.refresh:
+                # Notifies `_on_data_changed` of changes made by other processes
+                self.service.version.current()
+
+            if self.config.popularity_path and time.monotonic() - saved_at >= self.config.save_interval:
+                self.service.popularity.save(self.config.popularity_path)
+                saved_at = time.monotonic()
+
+            if not (self.config.refresh or self.config.popularity_path):
+                return
+
+
+def start_warmer(
+        service: AbstractQueryService, config: WarmupConfig, background: bool = True) -> T.Optional[CacheWarmer]:
+    """Warms up the cache of `service` from a background thread, which then keeps it warm if configured so.
+
+    Without `background` it's only warmed up, right away, for processes about to fork: each child starts
+    the thread.
+    """
+    if not config.enabled:
+        return None
+
+    if not isinstance(service, CachedQueryService):
+        logger.warning("Caching is disabled, there is nothing to warm up")
+        return None
+
+    warmer = CacheWarmer(service, config)
+
+    if background:
+        warmer.start(warm=True)
+    else:
+        warmer.warm()
+
+    return warmer
+
+
+def _end_of_month(month: date) -> date:
+    return month.replace(day=1) + relativedelta(months=1) - timedelta(days=1)
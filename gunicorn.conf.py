@@ -0,0 +1,34 @@
+"""Production serving: `gunicorn 'app:create_app()'` runs `server.workers` processes of the app.
+
+The app is built once in the master process. It reads the geometries and warms up the cache there, so
+workers share them copy-on-write, and closes its connections before forking: each worker opens its own
+on first use. Data is loaded beforehand by `flask init-data`, never while starting to serve.
+"""
+import gc
+import multiprocessing
+
+from config import settings
+
+bind = settings.server.bind
+workers = settings.server.workers or multiprocessing.cpu_count()
+threads = settings.server.threads
+timeout = settings.server.timeout
+preload_app = True
+
+# While the app is built, so freed objects don't leave holes in the pages workers share. `gc.freeze` then
+# keeps collections, of the master and of the workers it forks, off the objects built so far.
+gc.disable()
+
+
+def when_ready(server):
+    from app import before_fork
+
+    before_fork(settings)
+    gc.freeze()
+    gc.enable()
+
+
+def post_fork(server, worker):
+    from app import after_fork
+
+    after_fork(settings)
@@ -0,0 +1,204 @@
+import asyncio
+from datetime import date
+import json
+import threading
+import time
+import pytest
+
+from config import settings
+from geoapp import db, services
+from geoapp.asgi import QueryApp
+from geoapp.geometry import GeometryStore
+
+DATE_RANGE = date(2015, 1, 1), date(2015, 2, 28)
+
+
+@pytest.fixture(scope="module")
+def sync_service(database):
+    database.execute_statement(
+        "INSERT INTO PostalCodes (the_geom, code, id) VALUES (%s, %s, %s), (%s, %s, %s), (%s, %s, %s)",
+        ("dummy-geom", 28668, 6179, "other-geom", 28932, 6061, "split-geom", 28668, 6180),
+    )
+    database.execute_statement(
+        "INSERT INTO Payments (amount, p_month, p_age, p_gender, postal_code_id, id) VALUES "
+        f"{','.join(['(%s, %s, %s, %s, %s, %s)'] * 5)}",
+        (
+            10, "2015-01-01", "<=24", "M", 6179, 1117,
+            10, "2015-02-01", "<=24", "M", 6180, 4627,
+            10, "2015-01-01", "25-34", "F", 6061, 10616,
+            10, "2015-02-01", "25-34", "M", 6179, 8095,
+            10, "2015-02-01", "35-44", "F", 6061, 6383,
+        ),
+    )
+    db.refresh_rollups(database)
+
+    yield services.PostgresQueryService(database, geometries=GeometryStore(database))
+
+    database.execute_statement("DELETE FROM PaymentsByMonth")
+    database.execute_statement("DELETE FROM PaymentsByMonthPostalCode")
+    database.execute_statement("DELETE FROM Payments")
+    database.execute_statement("DELETE FROM PostalCodes")
+
+
+def run(test, geometries=None):
+    """Runs `test(service)` in an event loop of its own, asyncpg pools being bound to one"""
+    async def main():
+        database = db.AsyncPostgresDatabase()
+        await database.init(settings.db_config)
+
+        try:
+            return await test(services.AsyncPostgresQueryService(database, geometries=geometries))
+        finally:
+            await database.shutdown()
+
+    return asyncio.run(main())
+
+
+def serve(geometries, path, query_string='', headers=()):
+    """Status, headers and body of a GET request sent to the ASGI app"""
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request'}
+
+    async def send(message):
+        messages.append(message)
+
+    async def test(service):
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': path,
+            'query_string': query_string.encode(),
+            'headers': [(name.encode(), value.encode()) for name, value in headers],
+        }
+        await QueryApp(settings, service)(scope, receive, send)
+
+    run(test, geometries)
+
+    start, *bodies = messages
+    return start['status'], dict(start['headers']), b''.join(body['body'] for body in bodies)
+
+
+class TestAsyncPostgresDatabase:
+    def test_placeholders_are_numbered(self):
+        assert db._numbered_placeholders("a = %s AND b LIKE '5%%' AND c = ANY(%s)") == (
+            "a = $1 AND b LIKE '5%' AND c = ANY($2)"
+        )
+
+    def test_queries_return_tuples(self, database):
+        async def test(service):
+            return await service.db.execute_query("SELECT %s::INT, %s::TEXT", (1, 'a'), name='async_test')
+
+        assert run(test) == [(1, 'a')]
+
+    def test_many_queries_wait_for_a_connection_without_threads(self, database):
+        async def test(service):
+            return await asyncio.gather(*(
+                service.db.execute_query("SELECT pg_sleep(0.05), %s::INT", (i,)) for i in range(40)
+            ))
+
+        results = run(test)
+
+        assert [rows[0][1] for rows in results] == list(range(40))
+
+
+class TestAsyncPostgresQueryService:
+    @pytest.mark.parametrize('method', [
+        'get_map',
+        'get_turnover',
+        'get_turnover_by_age_and_gender',
+        'get_turnover_by_time_and_gender',
+        'get_turnover_by_postal_code',
+        'get_dashboard',
+    ])
+    def test_same_results_as_the_sync_service(self, sync_service, method):
+        async def test(service):
+            return await getattr(service, method)(*DATE_RANGE)
+
+        assert run(test, sync_service.geometries) == getattr(sync_service, method)(*DATE_RANGE)
+
+    def test_stream_map_merges_postal_codes_sharing_a_code(self, sync_service):
+        async def test(service):
+            return [result async for result in service.stream_map(*DATE_RANGE)]
+
+        streamed = run(test, sync_service.geometries)
+
+        assert streamed == list(sync_service.stream_map(*DATE_RANGE))
+        assert [result['turnover']['<=24']['M'] for result in streamed] == [20, 0]
+
+    def test_requests_are_answered_while_maps_render(self, sync_service, monkeypatch):
+        rendering = threading.Event()
+
+        def simplify(level):
+            rendering.set()
+            time.sleep(0.5)
+
+        monkeypatch.setattr(sync_service.geometries, 'simplify', simplify)
+
+        async def test(service):
+            map_ = asyncio.ensure_future(service.get_map(*DATE_RANGE))
+            await asyncio.to_thread(rendering.wait)
+
+            turnover = await service.get_turnover(*DATE_RANGE)
+            rendered = map_.done()
+            await map_
+
+            return turnover, rendered
+
+        assert run(test, sync_service.geometries) == (sync_service.get_turnover(*DATE_RANGE), False)
+
+
+class TestQueryApp:
+    @pytest.fixture
+    def geometries(self, sync_service):
+        return sync_service.geometries
+
+    def test_turnover(self, geometries):
+        status, headers, body = serve(geometries, '/api/turnover', 'startDate=2015-01-01&endDate=2015-02-28')
+
+        assert status == 200
+        assert headers[b'content-type'] == b'application/json'
+        assert json.loads(body) == {"results": "50"}
+
+    def test_responses_match_the_flask_app(self, geometries, app):
+        for path, query in (
+                ('/api/turnover/age-gender', 'startDate=2015-01-01&endDate=2015-02-28'),
+                ('/api/turnover/time-gender', 'startDate=2015-01-01&endDate=2015-02-28'),
+                ('/api/turnover', 'startDate=2015-01-01&endDate=2015-02-28&by=month,age'),
+        ):
+            status, _, body = serve(geometries, path, query)
+            expected = app.test_client().get(f"{path}?{query}")
+
+            assert (status, json.loads(body)) == (expected.status_code, expected.json), path
+
+    def test_streamed_map(self, geometries):
+        status, headers, body = serve(geometries, '/api/map', 'startDate=2015-01-01&endDate=2015-02-28&stream=true')
+
+        assert status == 200
+        assert headers[b'vary'] == b'Accept'
+        assert len(json.loads(body)['results']) == 2
+
+    def test_invalid_params(self, geometries):
+        status, _, body = serve(geometries, '/api/turnover/age-gender', 'startDate=nope')
+
+        assert status == 400
+        assert json.loads(body) == {"message": "Missing or invalid query params"}
+
+    def test_unknown_route(self, geometries):
+        assert serve(geometries, '/api/nope')[0] == 404
+
+    def test_tags_responses_with_the_data_version(self, geometries):
+        query = 'startDate=2015-01-01&endDate=2015-02-28'
+        _, headers, _ = serve(geometries, '/api/turnover', query)
+
+        status, not_modified, body = serve(
+            geometries, '/api/turnover', query, headers=[('If-None-Match', headers[b'etag'].decode())]
+        )
+
+        assert status == 304
+        assert body == b''
+        assert not_modified[b'etag'] == headers[b'etag']
+
+    def test_metrics_are_not_tagged(self, geometries):
+        assert b'etag' not in serve(geometries, '/metrics')[1]
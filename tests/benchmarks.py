@@ -0,0 +1,78 @@
+from datetime import date
+import pytest
+import shapely.wkb
+
+from benchmarks import suite, synthetic
+from geoapp import loader
+
+
+@pytest.fixture
+def generator():
+    return synthetic.Generator(rows=25000, postal_codes=10, months=6, seed=3)
+
+
+@pytest.fixture
+def cleanup(database):
+    yield
+
+    database.execute_statement("DELETE FROM Payments")
+    database.execute_statement("DELETE FROM PostalCodes")
+
+
+class TestGenerator:
+    def test_same_seed_same_rows(self, generator):
+        again = synthetic.Generator(rows=25000, postal_codes=10, months=6, seed=3)
+
+        assert list(generator.payment_rows()) == list(again.payment_rows())
+        assert list(generator.postal_code_rows()) == list(again.postal_code_rows())
+
+    def test_payments_cover_every_month_and_postal_code(self, generator):
+        rows = list(generator.payment_rows())
+
+        assert len(rows) == 25000
+        assert [row[-1] for row in rows] == list(range(1, 25001))
+        assert {row[1] for row in rows} == {f"2015-0{month}-01" for month in range(1, 7)}
+        assert {row[4] for row in rows} == set(range(1, 11))
+
+    def test_postal_codes_are_valid_polygons(self, generator):
+        geometries = [shapely.wkb.loads(bytes.fromhex(geom)) for geom, _, _ in generator.postal_code_rows()]
+
+        assert all(geometry.geom_type == 'Polygon' and geometry.is_valid for geometry in geometries)
+        assert not any(a.intersects(b) for i, a in enumerate(geometries) for b in geometries[i + 1:])
+
+    def test_profile_fits_a_paystats_file(self):
+        profile = synthetic.Profile.from_csv('data/paystats.csv')
+
+        assert set(profile.gender_weights) == {'F', 'M'}
+        assert 10 < profile.amount_mu < 12
+
+    def test_files_load(self, database, generator, cleanup, tmp_path):
+        postal_codes, payments = generator.write(str(tmp_path))
+        csv_loader = loader.CsvLoader(database)
+
+        assert csv_loader.load('PostalCodes', postal_codes).rows == 10
+        assert csv_loader.load('Payments', payments).rows == 25000
+
+
+class TestSuite:
+    def test_percentiles(self):
+        assert suite.percentiles([float(ms) for ms in range(1, 101)]) == pytest.approx((50.5, 95.05, 99.01, 100))
+        assert suite.percentiles([]) == (0.0, 0.0, 0.0, 0.0)
+
+    def test_ranges_end_with_the_data(self):
+        assert list(suite.ranges(date(2015, 1, 1), 12, [12, 1, 24])) == [
+            (1, date(2015, 12, 1), date(2015, 12, 31)),
+            (12, date(2015, 1, 1), date(2015, 12, 31)),
+        ]
+
+    def test_run_counts_calls_and_errors(self):
+        calls = iter(range(1, 100))
+
+        def call():
+            if next(calls) % 4 == 0:
+                raise ValueError()
+
+        result = suite.run('call', 'service', 1, 4, 20, call)
+
+        assert (result.calls, result.errors) == (20, 5)
+        assert result.throughput > 0
@@ -0,0 +1,127 @@
+from datetime import date
+import pytest
+
+from geoapp import cache, services
+
+
+class CountingQueryService(services.DummyQueryService):
+    def __init__(self, data: dict):
+        super().__init__(data)
+        self.calls = 0
+
+    def get_turnover(self, start_date: date, end_date: date, by=()) -> dict:
+        self.calls += 1
+        return super().get_turnover(start_date, end_date, by)
+
+
+@pytest.fixture(params=['memory', 'shared'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        return cache.MemoryCache(max_entries=2)
+
+    return cache.LocalSharedCache(str(tmp_path / 'cache.sqlite'), max_entries=2)
+
+
+class TestCacheBackend:
+    def test_get_returns_stored_value(self, backend):
+        backend.set("key", {"results": 10})
+
+        assert backend.get("key") == {"results": 10}
+        assert backend.stats()['hits'] == 1
+
+    def test_get_missing_key_returns_missing(self, backend):
+        assert backend.get("key") is cache.MISSING
+        assert backend.stats()['misses'] == 1
+
+    def test_set_evicts_least_recently_used(self, backend):
+        backend.set("a", 1)
+        backend.set("b", 2)
+        backend.get("a")
+        backend.set("c", 3)
+
+        assert backend.get("b") is cache.MISSING
+        assert backend.get("a") == 1
+        assert backend.get("c") == 3
+        assert backend.stats()['evictions'] == 1
+
+    def test_expired_entries_are_not_served(self, backend):
+        backend.ttl = -1
+        backend.set("key", 1)
+
+        assert backend.get("key") is cache.MISSING
+        assert backend.stats()['expirations'] == 1
+
+
+class TestPopularityTracker:
+    def test_top_returns_the_most_recorded_keys(self):
+        tracker = cache.PopularityTracker()
+        for key in 'abacab':
+            tracker.record(key)
+
+        assert tracker.top(2) == ['a', 'b']
+
+    def test_only_the_last_keys_count(self):
+        tracker = cache.PopularityTracker(window=3)
+        for key in 'aaabbc':
+            tracker.record(key)
+
+        assert tracker.top(3) == ['b', 'c']
+
+    def test_saved_keys_are_loaded_back(self, tmp_path):
+        tracker, loaded = cache.PopularityTracker(), cache.PopularityTracker()
+        for key in 'abb':
+            tracker.record(key)
+
+        tracker.save(str(tmp_path / 'popularity' / 'keys.pickle'))
+        loaded.load(str(tmp_path / 'popularity' / 'keys.pickle'))
+
+        assert loaded.top(2) == ['b', 'a']
+        assert (tmp_path / 'popularity').stat().st_mode & 0o777 == 0o700
+
+
+class TestCachedQueryService:
+    @pytest.fixture
+    def inner(self):
+        return CountingQueryService({'turnover': {'results': 50}})
+
+    @pytest.fixture
+    def service(self, inner, version):
+        return services.CachedQueryService(inner, cache.MemoryCache(), version)
+
+    @pytest.fixture
+    def date_range(self):
+        return date(2015, 1, 1), date(2015, 2, 28)
+
+    def test_repeated_queries_hit_the_cache(self, service, inner, date_range):
+        assert service.get_turnover(*date_range) == {'results': 50}
+        assert service.get_turnover(*date_range) == {'results': 50}
+
+        assert inner.calls == 1
+        assert service.stats()['hits'] == 1
+
+    def test_different_ranges_are_cached_separately(self, service, inner, date_range):
+        service.get_turnover(*date_range)
+        service.get_turnover(date_range[0], date(2015, 3, 31))
+
+        assert inner.calls == 2
+
+    def test_data_version_bump_invalidates_entries(self, service, inner, version, date_range):
+        service.get_turnover(*date_range)
+        version.bump()
+        service.get_turnover(*date_range)
+
+        assert inner.calls == 2
+
+    def test_bumps_of_other_months_keep_entries(self, service, inner, version, date_range):
+        service.get_turnover(*date_range)
+        version.bump(months=[date(2015, 3, 1)])
+        service.get_turnover(*date_range)
+
+        assert inner.calls == 1
+
+    def test_bumps_of_months_within_the_range_invalidate_entries(self, service, inner, version):
+        service.get_turnover(date(2015, 1, 15), date(2015, 2, 15))
+        version.bump(months=[date(2015, 1, 1)])
+        service.get_turnover(date(2015, 1, 15), date(2015, 2, 15))
+
+        assert inner.calls == 2
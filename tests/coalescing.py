@@ -0,0 +1,172 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+import fcntl
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
+import pytest
+
+from geoapp import coalescing, services
+
+
+class SlowCounter:
+    def __init__(self, delay: float = 0.1):
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+            calls = self.calls
+
+        time.sleep(self.delay)
+        return {"results": calls}
+
+
+class SlowQueryService(services.DummyQueryService):
+    def __init__(self, data: dict):
+        super().__init__(data)
+        self.count = SlowCounter()
+
+    def get_turnover(self, start_date: date, end_date: date, by=()) -> dict:
+        self.count()
+        return super().get_turnover(start_date, end_date, by)
+
+
+def run_concurrently(function, times: int = 8) -> list:
+    with ThreadPoolExecutor(max_workers=times) as executor:
+        return list(executor.map(lambda _: function(), range(times)))
+
+
+def compute_in_process(lock_dir: str, value: int, delay: float, results):
+    flights = coalescing.SingleFlight(lock_dir=lock_dir)
+
+    def compute():
+        time.sleep(delay)
+        return value
+
+    results.put((value, flights.do('key', compute), flights.stats()['shared_across_processes']))
+
+
+def flights_files(flights, key: str) -> list:
+    name = hashlib.sha1(key.encode()).hexdigest()
+    return [f"{name}.lock", f"{name}.result"]
+
+
+class TestSingleFlight:
+    def test_concurrent_callers_share_one_computation(self):
+        flights, compute = coalescing.SingleFlight(), SlowCounter()
+
+        results = run_concurrently(lambda: flights.do('key', compute))
+
+        assert compute.calls == 1
+        assert results == [{"results": 1}] * 8
+        assert flights.stats()['shared'] == 7
+
+    def test_later_callers_compute_again(self):
+        flights, compute = coalescing.SingleFlight(), SlowCounter(delay=0)
+
+        flights.do('key', compute)
+        flights.do('key', compute)
+
+        assert compute.calls == 2
+
+    def test_different_keys_are_computed_separately(self):
+        flights, compute = coalescing.SingleFlight(), SlowCounter()
+        keys = iter(range(4))
+        lock = threading.Lock()
+
+        def call():
+            with lock:
+                key = str(next(keys))
+            return flights.do(key, compute)
+
+        run_concurrently(call, times=4)
+
+        assert compute.calls == 4
+
+    def test_errors_are_raised_to_every_caller(self):
+        flights = coalescing.SingleFlight()
+
+        def fail():
+            time.sleep(0.1)
+            raise ValueError("broken")
+
+        def call():
+            with pytest.raises(ValueError):
+                flights.do('key', fail)
+
+        run_concurrently(call, times=4)
+        assert flights.stats()['in_flight'] == 0
+
+    def test_callers_give_up_waiting_after_the_timeout(self):
+        flights, compute = coalescing.SingleFlight(timeout=0.05), SlowCounter(delay=0.2)
+
+        run_concurrently(lambda: flights.do('key', compute), times=2)
+
+        assert compute.calls == 2
+        assert flights.stats()['timeouts'] == 1
+
+    def test_processes_share_results_through_the_lock_dir(self, tmp_path):
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+
+        leader = context.Process(target=compute_in_process, args=(str(tmp_path), 1, 0.5, results))
+        leader.start()
+        time.sleep(0.2)
+        follower = context.Process(target=compute_in_process, args=(str(tmp_path), 2, 0, results))
+        follower.start()
+
+        leader.join()
+        follower.join()
+
+        assert sorted(results.get(timeout=1) for _ in range(2)) == [(1, 1, 0), (2, 1, 1)]
+
+    def test_lock_dir_is_private(self, tmp_path):
+        lock_dir = tmp_path / 'flights'
+        lock_dir.mkdir(mode=0o777)
+        lock_dir.chmod(0o777)
+
+        coalescing.SingleFlight(lock_dir=str(lock_dir))
+
+        assert lock_dir.stat().st_mode & 0o777 == 0o700
+
+    def test_results_and_lock_files_are_swept_after_the_timeout(self, tmp_path):
+        flights, compute = coalescing.SingleFlight(lock_dir=str(tmp_path), timeout=0.05), SlowCounter(delay=0)
+
+        flights.do('first', compute)
+        assert len(os.listdir(tmp_path)) == 2
+
+        time.sleep(0.1)
+        flights.do('second', compute)
+
+        assert sorted(os.listdir(tmp_path)) == sorted(flights_files(flights, 'second'))
+
+    def test_lock_files_swept_while_waiting_are_not_locked_twice(self, tmp_path):
+        flights = coalescing.SingleFlight(lock_dir=str(tmp_path))
+        path = os.path.join(str(tmp_path), 'key')
+
+        with open(f"{path}.lock", 'a') as held:
+            fcntl.flock(held, fcntl.LOCK_EX)
+            threading.Timer(0.05, os.unlink, (f"{path}.lock",)).start()
+            threading.Timer(0.1, fcntl.flock, (held, fcntl.LOCK_UN)).start()
+
+            lock_file, locked, waited = flights._acquire(path)
+
+        with lock_file:
+            assert locked and waited
+            assert os.stat(f"{path}.lock").st_ino == os.fstat(lock_file.fileno()).st_ino
+
+
+class TestCoalescingQueryService:
+    def test_concurrent_queries_run_once(self):
+        inner = SlowQueryService({'turnover': {'results': 50}})
+        service = services.CoalescingQueryService(inner, coalescing.SingleFlight())
+
+        results = run_concurrently(lambda: service.get_turnover(date(2015, 1, 1), date(2015, 2, 28)))
+
+        assert inner.count.calls == 1
+        assert results == [{'results': 50}] * 8
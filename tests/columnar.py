@@ -0,0 +1,169 @@
+from datetime import date
+import pytest
+
+pytest.importorskip('numpy')
+
+from geoapp import columnar, metrics, services
+
+
+PAYMENTS = (
+    "amount,p_month,p_age,p_gender,postal_code_id,id\n"
+    "10,2015-01-01,<=24,M,6179,1117\n"
+    "10,2015-01-01,<=24,M,6179,4627\n"
+    "10,2015-01-01,25-34,F,6061,10616\n"
+    "10,2015-02-01,25-34,M,6179,8095\n"
+    "10,2015-02-01,35-44,F,6061,6383\n"
+    "10,2015-03-01,35-44,F,6061,6384\n"
+)
+
+POSTAL_CODES = (
+    "the_geom,code,id\n"
+    "dummy-geom,28668,6179\n"
+    "other-geom,28932,6061\n"
+    "unused-geom,28001,6000\n"
+)
+
+
+@pytest.fixture(params=[False, True], ids=['columns', 'cube'])
+def service(request, tmp_path, version):
+    payments = tmp_path / 'paystats.csv'
+    payments.write_text(PAYMENTS)
+    postal_codes = tmp_path / 'postal_codes.csv'
+    postal_codes.write_text(POSTAL_CODES)
+
+    return services.ColumnarQueryService(
+        payments_path=str(payments),
+        postal_codes_path=str(postal_codes),
+        version=version,
+        use_cube=request.param,
+    )
+
+
+@pytest.fixture
+def date_range():
+    return date(2015, 1, 1), date(2015, 2, 28)
+
+
+class TestColumnStore:
+    def test_month_bounds_only_include_months_starting_in_range(self):
+        first, last = columnar.ColumnStore.month_bounds(date(2015, 1, 15), date(2015, 3, 1))
+
+        assert columnar.month_from_ordinal(first) == date(2015, 2, 1)
+        assert columnar.month_from_ordinal(last) == date(2015, 3, 1)
+
+    def test_memory_usage_is_reported_per_column(self, service):
+        usage = service.store.nbytes
+
+        assert usage['total'] == sum(size for column, size in usage.items() if column != 'total')
+        assert {column: metrics.columnar_bytes.value(column=column) for column in usage} == usage
+        assert f'geoapp_columnar_bytes{{column="total"}} {usage["total"]}' in metrics.registry.render()
+
+
+class TestPrefixSumCube:
+    @pytest.fixture
+    def cube(self, service):
+        service.use_cube = True
+        return service.store
+
+    def test_append_extends_the_cube_with_later_months(self, service, cube):
+        with open(service.payments_path, 'a') as f:
+            f.write("15,2015-05-01,<=24,F,6179,9999\n")
+
+        service.reload([date(2015, 5, 1)])
+
+        assert service.store is not cube
+        assert service.store.first_month == cube.first_month
+        assert columnar.month_from_ordinal(service.store.last_month) == date(2015, 5, 1)
+        assert service.get_turnover(date(2015, 1, 1), date(2015, 12, 31))['results'] == 75
+        assert service.get_turnover(date(2015, 4, 1), date(2015, 4, 30))['results'] == 0
+
+    def test_changes_to_loaded_months_rebuild_the_cube(self, service, cube):
+        service.reload([date(2015, 1, 1)])
+
+        assert service._store is None
+
+    def test_ranges_outside_the_cube_are_empty(self, service, cube):
+        first, sums = cube.by_month_and_gender(date(2014, 11, 1), date(2015, 1, 31))
+
+        assert columnar.month_from_ordinal(first) == date(2014, 11, 1)
+        assert sums.tolist() == [[0, 0], [0, 0], [10, 20]]
+        assert cube.total(date(2016, 1, 1), date(2016, 12, 31)) == 0
+
+
+class TestColumnarQueryService:
+    def test_get_turnover_total_returns_50(self, service, date_range):
+        assert service.get_turnover(*date_range)['results'] == 50
+
+    def test_get_turnover_by_age_and_gender_returns_appropriate_results(self, service, date_range):
+        results = service.get_turnover_by_age_and_gender(*date_range)['results']
+
+        assert results['<=24']['M'] == 20
+        assert results['<=24']['F'] == 0
+        assert results['25-34']['M'] == 10
+        assert results['25-34']['F'] == 10
+        assert results['35-44']['F'] == 10
+        assert results['35-44']['M'] == 0
+
+    def test_get_turnover_by_time_and_gender_returns_appropriate_results(self, service, date_range):
+        results = service.get_turnover_by_time_and_gender(*date_range)['results']
+
+        assert list(results) == ['2015-01', '2015-02']
+        assert results['2015-01']['M'] == 20
+        assert results['2015-01']['F'] == 10
+        assert results['2015-02']['F'] == 10
+        assert results['2015-02']['M'] == 10
+
+    def test_get_map_only_returns_postal_codes_with_payments(self, service, date_range):
+        results = sorted(service.get_map(*date_range)['results'], key=lambda x: x['geometry'])
+
+        assert [result['geometry'] for result in results] == ['dummy-geom', 'other-geom']
+        assert results[0]['turnover']['<=24']['M'] == 20
+        assert results[1]['turnover']['35-44']['F'] == 10
+
+    def test_get_turnover_by_postal_code_only_returns_given_ids(self, service, date_range):
+        results = service.get_turnover_by_postal_code(*date_range, postal_code_ids=[6061, 6000])['results']
+
+        assert list(results) == [6061]
+
+    def test_stream_map_yields_the_results_of_get_map(self, service, date_range):
+        streamed = list(service.stream_map(*date_range))
+
+        assert streamed == sorted(service.get_map(*date_range)['results'], key=lambda x: x['geometry'])
+
+    def test_get_dashboard_composes_every_widget(self, service, date_range):
+        dashboard = service.get_dashboard(*date_range)
+
+        assert dashboard['turnover'] == service.get_turnover(*date_range)
+        assert dashboard['map'] == service.get_map(*date_range)
+
+    @pytest.mark.parametrize('by, method', [
+        (['age', 'gender'], 'get_turnover_by_age_and_gender'),
+        (['month', 'gender'], 'get_turnover_by_time_and_gender'),
+        (['postal_code', 'age', 'gender'], 'get_turnover_by_postal_code'),
+    ])
+    def test_get_turnover_by_matches_the_dedicated_methods(self, service, date_range, by, method):
+        assert service.get_turnover(*date_range, by=by) == getattr(service, method)(*date_range)
+
+    def test_get_turnover_by_nests_in_the_given_order(self, service, date_range):
+        results = service.get_turnover(*date_range, by=['gender', 'month'])['results']
+
+        assert results['M'] == {'2015-01': 20, '2015-02': 10}
+        assert results['F'] == {'2015-01': 10, '2015-02': 10}
+
+    def test_reload_picks_up_new_payments(self, service, date_range):
+        assert service.get_turnover(*date_range)['results'] == 50
+
+        with open(service.payments_path, 'a') as f:
+            f.write("15,2015-02-01,<=24,F,6179,9999\n")
+        service.reload()
+
+        assert service.get_turnover(*date_range)['results'] == 65
+
+    def test_data_changes_pick_up_new_payments(self, service, version, date_range):
+        assert service.get_turnover(*date_range)['results'] == 50
+
+        with open(service.payments_path, 'a') as f:
+            f.write("15,2015-02-01,<=24,F,6179,9999\n")
+        version.bump(months=[date(2015, 2, 1)])
+
+        assert service.get_turnover(*date_range)['results'] == 65
@@ -0,0 +1,112 @@
+from datetime import date, timedelta
+import pytest
+from werkzeug.http import http_date
+
+from geoapp import cache, db, handlers, services
+
+TURNOVER = '/api/turnover?startDate=2015-01-01&endDate=2015-01-31'
+
+
+class CountingQueryService(services.DummyQueryService):
+    def __init__(self):
+        super().__init__({})
+        self.calls = 0
+
+    def get_turnover(self, start_date, end_date, by=()) -> dict:
+        self.calls += 1
+        return {"results": self.calls}
+
+
+@pytest.fixture
+def client(app, database):
+    return app.test_client()
+
+
+@pytest.fixture
+def service(monkeypatch):
+    service = CountingQueryService()
+    monkeypatch.setattr(handlers, 'query_service', service)
+    return service
+
+
+@pytest.fixture
+def cached(monkeypatch, service):
+    cached = services.CachedQueryService(service, cache.MemoryCache())
+    monkeypatch.setattr(handlers, 'query_service', cached)
+    return cached
+
+
+class TestConditionalRequests:
+    def test_responses_are_tagged_with_the_data_version(self, client):
+        response = client.get(TURNOVER)
+
+        assert response.status_code == 200
+        assert response.headers['ETag'].startswith(f'W/"{db.data_version.current()}-')
+        assert response.headers['Last-Modified'] == http_date(db.data_version.updated_at.replace(microsecond=0))
+        assert response.headers['Cache-Control'] == 'no-cache'
+
+    def test_current_responses_are_not_computed_again(self, client, service):
+        etag = client.get(TURNOVER).headers['ETag']
+
+        response = client.get(TURNOVER, headers={'If-None-Match': etag})
+
+        assert response.status_code == 304
+        assert response.data == b''
+        assert response.headers['ETag'] == etag
+        assert service.calls == 1
+
+    def test_responses_change_along_with_the_data(self, client):
+        etag = client.get(TURNOVER).headers['ETag']
+
+        db.data_version.bump()
+        response = client.get(TURNOVER, headers={'If-None-Match': etag})
+
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+
+    def test_not_modified_since(self, client, service):
+        updated_at = db.data_version.updated_at
+
+        assert client.get(TURNOVER, headers={'If-Modified-Since': http_date(updated_at)}).status_code == 304
+        assert service.calls == 0
+
+        earlier = http_date(updated_at - timedelta(seconds=1))
+        assert client.get(TURNOVER, headers={'If-Modified-Since': earlier}).status_code == 200
+        assert service.calls == 1
+
+    def test_stale_responses_are_not_tagged_until_refreshed(self, client, service, cached):
+        with cached.warming():
+            cached.get_turnover(date(2015, 1, 1), date(2015, 1, 31))
+        etag = client.get(TURNOVER).headers['ETag']
+
+        db.data_version.bump()
+        stale = client.get(TURNOVER, headers={'If-None-Match': etag})
+
+        assert (stale.status_code, stale.json) == (200, {"results": 1})
+        assert 'ETag' not in stale.headers and 'Last-Modified' not in stale.headers
+        assert stale.headers['Cache-Control'] == 'no-store'
+
+        with cached.warming():
+            cached.get_turnover(date(2015, 1, 1), date(2015, 1, 31))
+        fresh = client.get(TURNOVER, headers={'If-None-Match': etag})
+
+        assert (fresh.status_code, fresh.json) == (200, {"results": 2})
+        assert fresh.headers['ETag'].startswith(f'W/"{db.data_version.current()}-')
+        assert client.get(TURNOVER, headers={'If-None-Match': fresh.headers['ETag']}).status_code == 304
+        assert service.calls == 2
+
+    def test_each_url_and_format_has_its_own_tag(self, client):
+        first = client.get(TURNOVER).headers['ETag']
+        other_range = client.get('/api/turnover?startDate=2015-01-01&endDate=2015-02-28').headers['ETag']
+        other_format = client.get(TURNOVER, headers={'Accept': 'application/geo+json'}).headers['ETag']
+
+        assert len({first, other_range, other_format}) == 3
+
+    def test_errors_are_not_tagged(self, client):
+        response = client.get('/api/turnover?startDate=nope')
+
+        assert response.status_code == 400
+        assert 'ETag' not in response.headers
+
+    def test_cache_stats_are_not_tagged(self, client):
+        assert 'ETag' not in client.get('/api/cache/stats').headers
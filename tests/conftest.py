@@ -1,18 +1,47 @@
+from flask import Flask
 import pytest
+import typing as T
 
-from app import setup
+from app import create_app
 from config import settings
 from geoapp.db import database as db
 from geoapp.services import TDatabase
 
 
 @pytest.fixture(scope="session")
-def database() -> TDatabase:
-    try:
-        settings.test = True
-        setup(settings)
+def app() -> Flask:
+    settings.test = True
+    return create_app(settings)
+
 
+@pytest.fixture(scope="session")
+def database(app) -> TDatabase:
+    try:
         yield db
 
     finally:
         db.teardown()
+
+
+class StaticVersion:
+    """Stands in for `DataVersion`: changes only when bumped, telling its listeners right away"""
+
+    def __init__(self):
+        self.version = 1
+        self.listeners: T.List[T.Callable] = []
+
+    def current(self) -> int:
+        return self.version
+
+    def subscribe(self, listener: T.Callable):
+        self.listeners.append(listener)
+
+    def bump(self, months=None):
+        self.version += 1
+        for listener in self.listeners:
+            listener(self.version, months)
+
+
+@pytest.fixture
+def version() -> StaticVersion:
+    return StaticVersion()
@@ -0,0 +1,388 @@
+from datetime import date
+import os
+import psycopg2
+import pytest
+import threading
+import time
+import typing as T
+
+from config import settings
+from config.config import ReplicaConfig
+from geoapp import db, metrics, services
+
+
+@pytest.fixture
+def pooled(database):
+    pooled = db.PooledPostgresDatabase(settings.db_config)
+    yield pooled
+    pooled.shutdown()
+
+
+@pytest.fixture
+def replicated(database):
+    # Both replicas are the test database itself, under two names of the same server
+    config = database.config.copy(update={
+        'replicas': [ReplicaConfig(host=database.config.host), ReplicaConfig(host='127.0.0.1')],
+        'replica_check_interval': 60,
+    })
+    replicated = db.ReplicatedPostgresDatabase(config)
+    yield replicated
+    replicated.shutdown()
+
+
+@pytest.fixture
+def unreachable(database):
+    config = database.config.copy(update={'replicas': [ReplicaConfig(host='127.0.0.1', port='1')]})
+    replicated = db.ReplicatedPostgresDatabase(config)
+    yield replicated
+    replicated.shutdown()
+
+
+def backend_pid(database) -> int:
+    return database.execute_query("SELECT pg_backend_pid()")[0][0]
+
+
+def eventually(condition: T.Callable[[], bool], timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.01)
+
+    return True
+
+
+class TestPooledPostgresDatabase:
+    def test_connects_on_first_use(self, pooled):
+        assert pooled._pool is None
+
+        assert pooled.execute_query("SELECT 1") == [(1,)]
+        assert pooled._pool.size >= 1
+
+    def test_reconnects_after_shutdown(self, pooled):
+        pooled.execute_query("SELECT 1")
+        pooled.shutdown()
+
+        assert pooled.execute_query("SELECT 1") == [(1,)]
+
+    def test_queries_are_not_sent_again_once_the_connection_drops(self, database):
+        unchecked = db.PooledPostgresDatabase(database.config.copy(update={'pool_health_check': False}))
+        try:
+            database.execute_query("SELECT pg_terminate_backend(%s)", (backend_pid(unchecked),))
+
+            with pytest.raises(psycopg2.OperationalError):
+                unchecked.execute_statement("SELECT 1")
+
+            assert unchecked.execute_query("SELECT 1") == [(1,)]
+        finally:
+            unchecked.shutdown()
+
+    def test_forked_processes_open_connections_of_their_own(self, database):
+        parent = backend_pid(database)
+        read, write = os.pipe()
+
+        child = os.fork()
+        if child == 0:
+            try:
+                os.write(write, str(backend_pid(database)).encode())
+                database.shutdown()
+            finally:
+                os._exit(0)
+
+        os.close(write)
+        os.waitpid(child, 0)
+        with os.fdopen(read) as f:
+            child_backend = int(f.read() or 0)
+
+        assert child_backend not in (0, parent)
+        # The child let go of the connections it inherited without ending their sessions
+        assert backend_pid(database) == parent
+
+    def test_after_fork_detaches_connections(self, pooled):
+        pooled.execute_query("SELECT 1")
+        inherited = pooled._pool
+
+        pooled.after_fork()
+
+        assert pooled._pool is None
+        assert not inherited._idle
+        assert pooled.execute_query("SELECT 1") == [(1,)]
+
+
+class TestReplicatedPostgresDatabase:
+    def reads(self, target: str) -> float:
+        return metrics.replica_reads.value(target=target)
+
+    def test_spreads_reads_over_replicas(self, replicated):
+        replicated.check_replicas()
+        first, second = replicated.replicas
+        before = self.reads(first.address), self.reads(second.address), self.reads('primary')
+
+        for _ in range(4):
+            assert replicated.reader().execute_query("SELECT 1") == [(1,)]
+
+        after = self.reads(first.address), self.reads(second.address), self.reads('primary')
+        assert [a - b for a, b in zip(after, before)] == [2, 2, 0]
+
+    def test_writes_go_to_the_primary(self, replicated):
+        assert replicated.reader() is not replicated
+        assert all(replica._pool is None for replica in replicated.replicas)
+
+        replicated.execute_statement("SELECT 1")
+
+        assert all(replica._pool is None for replica in replicated.replicas)
+
+    def test_streams_from_replicas(self, replicated):
+        replicated.check_replicas()
+        replica = replicated.replicas[0]
+        before = self.reads(replica.address) + self.reads(replicated.replicas[1].address)
+
+        rows = replicated.reader().stream_query("SELECT generate_series(1, 3)")
+
+        assert list(rows) == [(1,), (2,), (3,)]
+        assert self.reads(replica.address) + self.reads(replicated.replicas[1].address) == before + 1
+
+    def test_primary_answers_when_replicas_are_down(self, unreachable):
+        unreachable.check_replicas()
+        before = self.reads('primary')
+
+        assert unreachable.reader().execute_query("SELECT 1") == [(1,)]
+
+        assert not unreachable.replicas[0].healthy
+        assert self.reads('primary') == before + 1
+
+    def test_skips_lagging_replicas(self, replicated):
+        replicated.check_replicas()
+        assert all(replica.lag == 0 for replica in replicated.replicas)
+
+        replicated.replicas[0].lag = replicated.config.replica_max_lag + 1
+
+        assert list(replicated.read_targets()) == [replicated.replicas[1], replicated]
+
+    def test_skips_replicas_behind_the_data_version(self, replicated):
+        replicated.check_replicas()
+        replicated.replicas[1].version -= 1
+
+        assert list(replicated.read_targets()) == [replicated.replicas[0], replicated]
+
+    def test_checks_replicas_again_after_data_changes(self, replicated):
+        replicated.check_replicas()
+        for replica in replicated.replicas:
+            replica.version -= 1
+
+        assert list(replicated.read_targets()) == [replicated]
+
+        replicated.data_changed(replicated.replicas[0].version + 1, None)
+
+        assert eventually(lambda: set(replicated.read_targets()) == {*replicated.replicas, replicated})
+
+    def test_reads_go_with_the_last_check_while_replicas_are_checked(self, replicated, monkeypatch):
+        replicated.check_replicas()
+        checking, release = threading.Event(), threading.Event()
+
+        def check():
+            checking.set()
+            release.wait(5)
+        monkeypatch.setattr(replicated.replicas[0], 'check', check)
+
+        list(replicated.read_targets())
+        replicated.data_changed(replicated.replicas[0].version + 1, None)
+        try:
+            assert checking.wait(5)
+            assert set(replicated.read_targets()) == {*replicated.replicas, replicated}
+        finally:
+            release.set()
+
+    def test_moves_on_from_replicas_going_down(self, replicated):
+        replicated.check_replicas()
+        for replica in replicated.replicas:
+            replica.shutdown()
+            replica.config = replica.config.copy(update={'port': '1'})
+
+        assert replicated.reader().execute_query("SELECT 1") == [(1,)]
+        assert not any(replica.healthy for replica in replicated.replicas)
+
+    def test_moves_on_from_recovery_conflicts(self, replicated, monkeypatch):
+        conflict = (
+            "DO $$ BEGIN RAISE 'canceling statement due to conflict with recovery' "
+            "USING ERRCODE = 'serialization_failure'; END $$"
+        )
+        replicated.check_replicas()
+        for replica in replicated.replicas:
+            monkeypatch.setattr(replica, 'execute_query', lambda *args, replica=replica, **kwargs: (
+                db.PooledPostgresDatabase.execute_query(replica, conflict)
+            ))
+        before = self.reads('primary')
+
+        assert replicated.reader().execute_query("SELECT 1") == [(1,)]
+
+        assert self.reads('primary') == before + 1
+        assert all(replica.healthy for replica in replicated.replicas)
+
+    def test_raises_server_errors(self, replicated):
+        replicated.check_replicas()
+        with pytest.raises(psycopg2.errors.UndefinedTable):
+            replicated.reader().execute_query("SELECT * FROM missing")
+
+        assert all(replica.healthy for replica in replicated.replicas)
+
+    def test_query_service_reads_from_replicas(self, replicated):
+        replicated.check_replicas()
+        service = services.PostgresQueryService(replicated)
+        before = self.reads('primary')
+
+        service.get_turnover(date(2015, 1, 1), date(2015, 12, 31))
+
+        assert self.reads('primary') == before
+
+
+class TestPreparedStatements:
+    QUERY = "SELECT %s::int + 1"
+
+    def preparations(self, name: str = 'plus_one') -> float:
+        return metrics.statement_preparations.value(query=name)
+
+    @pytest.fixture
+    def single(self, database):
+        single = db.PostgresDatabase(database.config)
+        yield single
+        single.shutdown()
+
+    @pytest.fixture
+    def table(self, database):
+        database.execute_statement("CREATE TABLE PreparedStatementsTest (amount integer)")
+        database.execute_statement("INSERT INTO PreparedStatementsTest VALUES (1)")
+        yield 'PreparedStatementsTest'
+        database.execute_statement("DROP TABLE PreparedStatementsTest")
+
+    def test_prepares_once_per_connection(self, single):
+        before = self.preparations(), metrics.statement_reuses.value(query='plus_one')
+
+        for i in range(3):
+            assert single.execute_query(self.QUERY, (i,), name='plus_one', prepare=True) == [(i + 1,)]
+
+        assert self.preparations() == before[0] + 1
+        assert metrics.statement_reuses.value(query='plus_one') == before[1] + 2
+        assert metrics.statement_seconds_saved.value(query='plus_one') > 0
+        assert single.statements[self.QUERY].query_name == 'plus_one'
+
+    def test_same_name_with_other_sql_is_another_statement(self, single):
+        first = single.register_statement(self.QUERY, 'plus_one')
+        second = single.register_statement("SELECT %s::int + 2", 'plus_one')
+
+        assert first.name != second.name
+        assert single.register_statement(self.QUERY) is first
+
+    def test_prepares_again_after_reconnecting(self, single):
+        single.execute_query(self.QUERY, (1,), name='plus_one', prepare=True)
+        before = self.preparations()
+
+        single.shutdown()
+
+        assert single.execute_query(self.QUERY, (1,), name='plus_one', prepare=True) == [(2,)]
+        assert self.preparations() == before + 1
+
+    def test_prepares_again_statements_dropped_from_the_session(self, single):
+        single.execute_query(self.QUERY, (1,), name='plus_one', prepare=True)
+
+        single.execute_statement("DEALLOCATE ALL")
+
+        assert single.execute_query(self.QUERY, (1,), name='plus_one', prepare=True) == [(2,)]
+
+    def test_prepares_again_after_schema_changes(self, pooled, table):
+        query = f"SELECT amount FROM {table}"
+        assert pooled.execute_query(query, name='amounts', prepare=True) == [(1,)]
+        before = self.preparations('amounts')
+
+        pooled.execute_statement(f"ALTER TABLE {table} ALTER COLUMN amount TYPE text")
+
+        assert pooled.execute_query(query, name='amounts', prepare=True) == [('1',)]
+        assert self.preparations('amounts') == before + 1
+
+    def test_can_be_disabled(self, database):
+        single = db.PostgresDatabase(database.config.copy(update={'prepare_statements': False}))
+        try:
+            assert single.execute_query(self.QUERY, (1,), name='plus_one', prepare=True) == [(2,)]
+            assert not single.statements
+        finally:
+            single.shutdown()
+
+    def test_query_service_prepares_its_queries(self, pooled):
+        service = services.PostgresQueryService(pooled)
+
+        service.get_turnover(date(2015, 1, 1), date(2015, 12, 31))
+        service.get_dashboard(date(2015, 1, 1), date(2015, 12, 31))
+
+        assert {statement.query_name for statement in pooled.statements.values()} == {'turnover', 'dashboard'}
+
+
+class TestAtomic:
+    @pytest.fixture
+    def table(self, database):
+        database.execute_statement("CREATE TABLE AtomicTest (id INT)")
+        yield 'AtomicTest'
+        database.execute_statement("DROP TABLE AtomicTest")
+
+    @pytest.fixture(params=['pooled', 'single'])
+    def target(self, request, database):
+        target = db.PooledPostgresDatabase(database.config) if request.param == 'pooled' else \
+            db.PostgresDatabase(database.config)
+        yield target
+        target.shutdown()
+
+    @pytest.fixture
+    def other(self, database):
+        """Another session, to look at what's committed"""
+        other = db.PostgresDatabase(database.config)
+        yield other
+        other.shutdown()
+
+    def ids(self, database, table) -> T.List[int]:
+        return [id_ for id_, in database.execute_query(f"SELECT id FROM {table} ORDER BY id")]
+
+    def test_changes_are_only_seen_once_the_block_exits(self, target, other, table):
+        with target.atomic():
+            target.execute_statement(f"INSERT INTO {table} VALUES (1)")
+            target.execute_statement(f"INSERT INTO {table} VALUES (2)")
+
+            assert self.ids(target, table) == [1, 2]
+            assert self.ids(other, table) == []
+
+        assert self.ids(other, table) == [1, 2]
+
+    def test_errors_leave_no_trace(self, target, other, table):
+        with pytest.raises(ZeroDivisionError):
+            with target.atomic():
+                target.execute_statement(f"INSERT INTO {table} VALUES (1)")
+                1 / 0
+
+        assert self.ids(other, table) == []
+        assert self.ids(target, table) == []
+
+    def test_rollback_effect_leaves_no_trace(self, target, other, table):
+        with target.atomic(effect='rollback'):
+            target.execute_statement(f"INSERT INTO {table} VALUES (1)")
+
+        assert self.ids(other, table) == []
+
+    def test_blocks_within_blocks_are_savepoints(self, target, other, table):
+        with target.atomic():
+            target.execute_statement(f"INSERT INTO {table} VALUES (1)")
+
+            with pytest.raises(psycopg2.errors.UndefinedTable):
+                with target.atomic():
+                    target.execute_statement(f"INSERT INTO {table} VALUES (2)")
+                    target.execute_statement("INSERT INTO Missing VALUES (3)")
+
+            with target.atomic(effect='rollback'):
+                target.execute_statement(f"INSERT INTO {table} VALUES (4)")
+
+            with target.atomic():
+                target.execute_statement(f"INSERT INTO {table} VALUES (5)")
+
+        assert self.ids(other, table) == [1, 5]
+
+    def test_statements_outside_blocks_commit_on_their_own(self, target, other, table):
+        target.execute_statement(f"INSERT INTO {table} VALUES (1)")
+
+        assert self.ids(other, table) == [1]
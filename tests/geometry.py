@@ -0,0 +1,132 @@
+from datetime import date
+import struct
+import pytest
+
+from geoapp import db, geometry, metrics, services
+
+
+SQUARE = [[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 1.0], [0.0, 0.0]]
+
+
+def polygon_wkb(rings, srid: int = None, byte_order: str = '<') -> str:
+    type_ = 3 | (geometry.EWKB_SRID_FLAG if srid else 0)
+    wkb = struct.pack(f'{byte_order}BI', 1 if byte_order == '<' else 0, type_)
+
+    if srid:
+        wkb += struct.pack(f'{byte_order}I', srid)
+
+    wkb += struct.pack(f'{byte_order}I', len(rings))
+    for ring in rings:
+        wkb += struct.pack(f'{byte_order}I', len(ring))
+        for x, y in ring:
+            wkb += struct.pack(f'{byte_order}2d', x, y)
+
+    return wkb.hex().upper()
+
+
+class TestDecodeWKB:
+    def test_decodes_polygon(self):
+        assert geometry.decode_wkb(polygon_wkb([SQUARE])) == {"type": "Polygon", "coordinates": [SQUARE]}
+
+    def test_decodes_big_endian_ewkb_with_srid(self):
+        decoded = geometry.decode_wkb(polygon_wkb([SQUARE], srid=4326, byte_order='>'))
+
+        assert decoded == {"type": "Polygon", "coordinates": [SQUARE]}
+
+    def test_decodes_multipolygon(self):
+        polygon = bytes.fromhex(polygon_wkb([SQUARE]))
+        wkb = struct.pack('<BII', 1, 6, 2) + polygon + polygon
+
+        assert geometry.decode_wkb(wkb) == {"type": "MultiPolygon", "coordinates": [[SQUARE], [SQUARE]]}
+
+    @pytest.mark.parametrize('wkb', ['dummy-geom', polygon_wkb([SQUARE])[:-8]])
+    def test_invalid_geometries_raise(self, wkb):
+        with pytest.raises(geometry.InvalidGeometry):
+            geometry.decode_wkb(wkb)
+
+
+class TestPostalCodeGeometry:
+    def test_render_keeps_wkb_by_default(self):
+        postal_code = geometry.PostalCodeGeometry(1, "28001", polygon_wkb([SQUARE]))
+
+        assert postal_code.render('wkb') == postal_code.wkb
+        assert postal_code.render('geojson') == {"type": "Polygon", "coordinates": [SQUARE]}
+
+    def test_render_simplified_level_reencodes_wkb(self):
+        postal_code = geometry.PostalCodeGeometry(1, "28001", polygon_wkb([SQUARE], srid=4326))
+        postal_code.levels[1] = {"type": "Polygon", "coordinates": [SQUARE]}
+
+        assert postal_code.render('wkb', 1) == postal_code.wkb
+
+
+class TestEncodeWKB:
+    def test_encode_is_the_inverse_of_decode(self):
+        wkb = polygon_wkb([SQUARE], srid=4326)
+
+        assert geometry.encode_wkb(geometry.decode_wkb(wkb), srid=4326) == wkb
+
+
+class TestLevelFor:
+    def test_defaults_to_full_resolution(self):
+        assert geometry.level_for() == 0
+
+    def test_higher_zoom_gets_finer_level(self):
+        assert geometry.level_for(zoom=18) == 0
+        assert geometry.level_for(zoom=12) < geometry.level_for(zoom=5)
+
+    def test_tolerance_picks_coarsest_level_within_it(self):
+        level = geometry.level_for(tolerance=0.001)
+
+        assert geometry.LEVELS[level].tolerance <= 0.001
+        assert geometry.LEVELS[level + 1].tolerance > 0.001
+
+
+class TestGeometryStore:
+    def test_ids_within_skips_undecodable_and_distant_geometries(self, tmp_path):
+        far = [[x + 10, y + 10] for x, y in SQUARE]
+        path = tmp_path / 'postal_codes.csv'
+        path.write_text(
+            "the_geom,code,id\n"
+            f"{polygon_wkb([SQUARE])},28001,1\n"
+            f"{polygon_wkb([far])},28002,2\n"
+            "dummy-geom,28003,3\n"
+        )
+
+        store = geometry.GeometryStore(path=str(path), version=db.DataVersion(None))
+
+        assert store.ids_within((0.5, 0.5, 2, 2)) == [1]
+        assert store.ids_within((-1, -1, 20, 20)) == [1, 2]
+
+    @pytest.fixture
+    def store(self, tmp_path, version):
+        path = tmp_path / 'postal_codes.csv'
+        path.write_text(f"the_geom,code,id\n{polygon_wkb([SQUARE])},28001,1\n{polygon_wkb([SQUARE])},28002,2\n")
+
+        return geometry.GeometryStore(path=str(path), version=version, prerender=True)
+
+    def test_requests_account_for_the_bytes_and_decoding_saved(self, store):
+        bytes_saved, seconds_saved = metrics.geometry_bytes_saved.value(), metrics.geometry_decode_seconds_saved.value()
+        turnover = {'<=24': {'M': 10, 'F': 5}, '25-34': {'M': 0}}
+
+        services._render_map({1: turnover, 2: turnover}, store, 'geojson', level=0)
+
+        stats = store.stats()
+        # Each geometry would have come along with its two rows of turnover
+        assert stats["bytes_saved"] == 4 * len(store.get(1).wkb)
+        assert stats["decode_seconds_saved"] > 0
+        assert stats["requests"] == 1
+        assert metrics.geometry_bytes_saved.value() - bytes_saved == stats["bytes_saved"]
+        assert metrics.geometry_decode_seconds_saved.value() - seconds_saved == pytest.approx(
+            stats["decode_seconds_saved"]
+        )
+
+    def test_payments_changes_keep_the_geometries(self, store, version):
+        geometries = store.by_id
+
+        version.bump(months=[date(2015, 1, 1)])
+        assert store.by_id is geometries
+        assert store.stats()["loads"] == 1
+
+        version.bump()
+        assert store.by_id is not geometries
+        assert store.stats()["loads"] == 2
@@ -0,0 +1,237 @@
+from datetime import date
+import psycopg2
+import pytest
+
+from config import settings
+from geoapp import db, loader
+
+POSTAL_CODES = """the_geom,code,id
+00ff,28668,6179
+ff00,28932,6061
+"""
+
+PAYMENTS = """id,amount,p_month,p_age,p_gender,postal_code_id
+1117,10.5,2015-01-01,<=24,M,6179
+4627,10,2015-02-01,<=24,M,6179
+10616,10,2015-01-01,25-34,F,6061
+8095,10,2015-02-01,25-34,M,6179
+6383,10,2015-02-01,35-44,F,6061
+"""
+
+
+@pytest.fixture
+def files(tmp_path):
+    postal_codes = tmp_path / 'postal_codes.csv'
+    postal_codes.write_text(POSTAL_CODES)
+
+    payments = tmp_path / 'paystats.csv'
+    payments.write_text(PAYMENTS)
+
+    return str(postal_codes), str(payments)
+
+
+@pytest.fixture(autouse=True)
+def cleanup(database):
+    yield
+
+    database.execute_statement("DELETE FROM PaymentsByMonth")
+    database.execute_statement("DELETE FROM PaymentsByMonthPostalCode")
+    database.execute_statement("DELETE FROM Payments")
+    database.execute_statement("DELETE FROM PostalCodes")
+
+
+def count(database, table):
+    return database.execute_query(f"SELECT COUNT(*), COALESCE(SUM(id), 0) FROM {table}")[0]
+
+
+class Watched:
+    """Runs `watch` after every statement executed through `database`"""
+
+    def __init__(self, database, watch):
+        self.database = database
+        self.watch = watch
+
+    def atomic(self, effect: str = 'commit'):
+        return self.database.atomic(effect)
+
+    def execute_statement(self, query, params=None, name=None):
+        self.database.execute_statement(query, params, name)
+        self.watch()
+
+
+class TestCsvLoader:
+    def test_load_copies_every_row_in_chunks(self, database, files):
+        postal_codes, payments = files
+        csv_loader = loader.CsvLoader(database, chunk_size=2)
+
+        csv_loader.load('postalcodes', postal_codes)
+        report = csv_loader.load('Payments', payments)
+
+        assert (report.table, report.rows, report.rejected) == ('Payments', 5, 0)
+        assert count(database, 'Payments') == (5, 1117 + 4627 + 10616 + 8095 + 6383)
+        assert database.execute_query("SELECT amount FROM Payments WHERE id = 1117")[0][0] == pytest.approx(10.5)
+
+    def test_invalid_rows_abort_the_load(self, database, files, tmp_path):
+        postal_codes, _ = files
+        payments = tmp_path / 'invalid.csv'
+        payments.write_text(PAYMENTS + "1,10,2015-13-01,<=24,M,6179\n")
+
+        loader.CsvLoader(database).load('PostalCodes', postal_codes)
+
+        with pytest.raises(loader.InvalidRow, match='line 7'):
+            loader.CsvLoader(database, chunk_size=2).load('Payments', str(payments))
+
+        assert count(database, 'Payments') == (0, 0)
+
+    def test_invalid_rows_are_skipped_up_to_max_errors(self, database, files, tmp_path):
+        postal_codes, _ = files
+        payments = tmp_path / 'invalid.csv'
+        payments.write_text(PAYMENTS + "1,ten,2015-01-01,<=24,M,6179\n2,10,2015-01-01,65+,X,6179\n")
+
+        loader.CsvLoader(database).load('PostalCodes', postal_codes)
+        report = loader.CsvLoader(database, max_errors=2).load('Payments', str(payments))
+
+        assert (report.rows, report.rejected) == (5, 2)
+        assert count(database, 'Payments')[0] == 5
+
+    def test_missing_columns_are_reported(self, database, tmp_path):
+        payments = tmp_path / 'paystats.csv'
+        payments.write_text("id,amount\n1,10\n")
+
+        with pytest.raises(loader.LoadError, match='p_month'):
+            loader.CsvLoader(database).load('Payments', str(payments))
+
+    def test_only_known_tables_can_be_loaded(self, database, files):
+        with pytest.raises(loader.UnknownTable):
+            loader.CsvLoader(database).load('DataVersion', files[0])
+
+    def test_parallel_load_spreads_chunks_over_connections(self, database, files):
+        postal_codes, payments = files
+        csv_loader = loader.CsvLoader(database, chunk_size=1, workers=3)
+
+        csv_loader.load('PostalCodes', postal_codes)
+        report = csv_loader.load('Payments', payments)
+
+        assert report.rows == 5
+        assert count(database, 'Payments') == (5, 1117 + 4627 + 10616 + 8095 + 6383)
+
+    def test_parallel_load_rolls_back_every_worker_on_failure(self, database, files, tmp_path):
+        postal_codes, _ = files
+        payments = tmp_path / 'unknown_postal_code.csv'
+        payments.write_text(PAYMENTS + "1,10,2015-01-01,<=24,M,1\n")
+        csv_loader = loader.CsvLoader(database, chunk_size=1, workers=3)
+
+        csv_loader.load('PostalCodes', postal_codes)
+        with pytest.raises(Exception, match='fk_postal_code_id'):
+            csv_loader.load('Payments', str(payments))
+
+        assert count(database, 'Payments') == (0, 0)
+
+    def test_ids_already_stored_in_another_month_abort_the_load(self, database, files, tmp_path):
+        postal_codes, payments = files
+        again = tmp_path / 'again.csv'
+        again.write_text("id,amount,p_month,p_age,p_gender,postal_code_id\n1117,10,2015-03-01,<=24,M,6179\n")
+        csv_loader = loader.CsvLoader(database)
+
+        csv_loader.load('PostalCodes', postal_codes)
+        csv_loader.load('Payments', payments)
+        db.partition_payments(database)
+
+        with pytest.raises(psycopg2.errors.UniqueViolation, match='paymentids_pkey'):
+            csv_loader.load('Payments', str(again))
+
+        assert count(database, 'Payments') == count(database, 'PaymentIds')
+
+
+class TestIngestPayments:
+    @pytest.fixture(autouse=True)
+    def loaded(self, database, files):
+        postal_codes, payments = files
+
+        loader.CsvLoader(database).load('PostalCodes', postal_codes)
+        loader.CsvLoader(database).load('Payments', payments)
+        db.refresh_rollups(database)
+
+    @pytest.fixture
+    def changes(self, tmp_path):
+        path = tmp_path / 'changes.csv'
+        path.write_text(
+            "amount,p_month,p_age,p_gender,postal_code_id,id\n"
+            # Unchanged, moved to another month, then a new payment
+            "10,2015-02-01,<=24,M,6179,4627\n"
+            "10,2015-03-01,25-34,M,6179,8095\n"
+            "20,2015-03-01,<=24,F,6061,20000\n"
+        )
+        return str(path)
+
+    def test_ingest_upserts_payments_by_id(self, database, changes):
+        report = loader.ingest_payments(changes, database)
+
+        assert (report.loaded.rows, report.inserted, report.updated) == (3, 1, 1)
+        assert count(database, 'Payments') == (6, 1117 + 4627 + 10616 + 8095 + 6383 + 20000)
+        assert database.execute_query("SELECT p_month FROM Payments WHERE id = 8095")[0][0] == date(2015, 3, 1)
+
+    def test_ingest_refreshes_rollups_of_changed_months_only(self, database, changes):
+        version = db.data_version.current()
+        report = loader.ingest_payments(changes, database)
+
+        assert report.months == [date(2015, 2, 1), date(2015, 3, 1)]
+        assert db.data_version.current() == version + 1
+        assert database.execute_query(
+            "SELECT p_month, SUM(amount) FROM PaymentsByMonth GROUP BY p_month ORDER BY p_month"
+        ) == database.execute_query(
+            "SELECT p_month, SUM(amount) FROM Payments GROUP BY p_month ORDER BY p_month"
+        )
+
+    def test_readers_never_see_rollups_half_refreshed(self, database):
+        other = db.PostgresDatabase(database.config)
+        totals = []
+
+        def watch():
+            totals.append(other.execute_query(
+                "SELECT (SELECT SUM(amount) FROM PaymentsByMonth), (SELECT SUM(amount) FROM PaymentsByMonthPostalCode)"
+            )[0])
+
+        try:
+            database.execute_statement("UPDATE Payments SET amount = amount * 2")
+            db.refresh_rollups(Watched(database, watch), [date(2015, 1, 1), date(2015, 2, 1)])
+            watch()
+        finally:
+            other.shutdown()
+
+        assert totals[:-1] == [(pytest.approx(50.5), pytest.approx(50.5))] * 4
+        assert totals[-1] == (pytest.approx(101), pytest.approx(101))
+
+    def test_ingesting_twice_changes_nothing(self, database, changes):
+        loader.ingest_payments(changes, database)
+        version = db.data_version.current()
+
+        report = loader.ingest_payments(changes, database)
+
+        assert (report.inserted, report.updated, report.months) == (0, 0, [])
+        assert db.data_version.current() == version
+
+    def test_other_processes_learn_the_changed_months(self, database, changes):
+        other, changes_seen = db.DataVersion(database, check_interval=0), []
+        other.subscribe(lambda version, months: changes_seen.append(months))
+        other.current()
+
+        loader.ingest_payments(changes, database)
+        other.current()
+
+        assert changes_seen == [[date(2015, 2, 1), date(2015, 3, 1)]]
+
+
+class TestLoadInitialData:
+    def test_only_empty_tables_are_loaded(self, database, files):
+        postal_codes, payments = files
+        config = settings.copy(update={
+            'data': settings.data.copy(update={'postalcodes': postal_codes, 'payments': payments}),
+        })
+
+        db.load_initial_data(database, config)
+        db.load_initial_data(database, config)
+
+        assert count(database, 'PostalCodes')[0] == 2
+        assert count(database, 'Payments')[0] == 5
+        assert database.execute_query("SELECT SUM(amount) FROM PaymentsByMonth")[0][0] == pytest.approx(50.5)
@@ -0,0 +1,82 @@
+import logging
+import pytest
+
+from geoapp import metrics
+
+
+class TestHistogram:
+    def test_render_has_cumulative_buckets_sum_and_count(self):
+        histogram = metrics.Histogram('latency_seconds', "Latency", labels=('route',), buckets=(0.1, 1))
+        histogram.observe(0.05, route='/map')
+        histogram.observe(0.5, route='/map')
+        histogram.observe(2, route='/map')
+
+        assert histogram.render() == [
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{route="/map",le="0.1"} 1',
+            'latency_seconds_bucket{route="/map",le="1"} 2',
+            'latency_seconds_bucket{route="/map",le="+Inf"} 3',
+            'latency_seconds_sum{route="/map"} 2.55',
+            'latency_seconds_count{route="/map"} 3',
+        ]
+
+    def test_labels_must_match(self):
+        histogram = metrics.Histogram('latency_seconds', "Latency", labels=('route',))
+
+        with pytest.raises(ValueError):
+            histogram.observe(1, query='map')
+
+    def test_label_values_are_escaped(self):
+        counter = metrics.Counter('errors_total', "Errors", labels=('message',))
+        counter.inc(message='a "quoted"\nvalue')
+
+        assert counter.render()[-1] == 'errors_total{message="a \\"quoted\\"\\nvalue"} 1'
+
+
+class TestGauge:
+    def test_set_replaces_the_value(self):
+        gauge = metrics.Gauge('memory_bytes', "Memory", labels=('column',))
+        gauge.set(10, column='amounts')
+        gauge.set(4, column='amounts')
+
+        assert gauge.render()[1:] == ['# TYPE memory_bytes gauge', 'memory_bytes{column="amounts"} 4']
+
+
+class TestInstrumentation:
+    @pytest.fixture
+    def client(self, app):
+        return app.test_client()
+
+    def test_requests_are_timed_per_route(self, client):
+        before = metrics.request_duration.count(route='/api/turnover', method='GET', status=200)
+
+        client.get('/api/turnover?startDate=2015-01-01&endDate=2015-01-31')
+
+        assert metrics.request_duration.count(route='/api/turnover', method='GET', status=200) == before + 1
+        assert metrics.response_bytes.count(route='/api/turnover') >= 1
+
+    def test_named_queries_are_timed(self, database):
+        before = metrics.query_duration.count(query='metrics_test')
+
+        database.execute_query("SELECT generate_series(1, 3)", name='metrics_test')
+
+        assert metrics.query_duration.count(query='metrics_test') == before + 1
+        assert metrics.query_rows.sum(query='metrics_test') >= 3
+
+    def test_slow_queries_are_logged(self, database, caplog, monkeypatch):
+        monkeypatch.setattr(database.config, 'slow_query_threshold', 0.0)
+
+        with caplog.at_level(logging.WARNING, logger='geoapp.db.slow'):
+            database.execute_query("SELECT 1", name='metrics_slow_test')
+
+        assert metrics.slow_queries.value(query='metrics_slow_test') == 1
+        assert 'metrics_slow_test' in caplog.text
+
+    def test_metrics_endpoint_serves_prometheus_text(self, client):
+        client.get('/api/turnover?startDate=2015-01-01&endDate=2015-01-31')
+
+        response = client.get('/metrics')
+
+        assert response.content_type.startswith('text/plain; version=0.0.4')
+        assert '# TYPE geoapp_request_duration_seconds histogram' in response.get_data(as_text=True)
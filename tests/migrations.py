@@ -0,0 +1,61 @@
+import psycopg2
+import pytest
+
+from geoapp import migrations
+
+
+@pytest.fixture
+def path(tmp_path):
+    (tmp_path / '0001_create.sql').write_text("CREATE TABLE MigrationsTest (id INT, name TEXT)")
+    (tmp_path / '0002_insert.sql').write_text("INSERT INTO MigrationsTest VALUES (1, '100%')")
+    (tmp_path / 'README').write_text("Not a migration")
+
+    return str(tmp_path)
+
+
+@pytest.fixture
+def cleanup(database):
+    yield
+
+    database.execute_statement("DROP TABLE IF EXISTS MigrationsTest")
+    database.execute_statement("DROP TABLE IF EXISTS MigrationsPartial")
+    database.execute_statement("DELETE FROM SchemaMigrations WHERE version IN ('0001_create', '0002_insert')")
+
+
+class TestMigrate:
+    def test_repository_migrations_are_applied(self, database):
+        assert {migration.version for migration in migrations.migrations()} <= migrations.applied(database)
+
+    def test_pending_migrations_are_applied_in_order_once(self, database, path, cleanup):
+        assert migrations.migrate(database, path) == ['0001_create', '0002_insert']
+        assert migrations.migrate(database, path) == []
+
+        assert database.execute_query("SELECT * FROM MigrationsTest") == [(1, '100%')]
+
+    def test_failed_migrations_are_not_recorded(self, database, path, tmp_path, cleanup):
+        (tmp_path / '0003_broken.sql').write_text("INSERT INTO Missing VALUES (1)")
+
+        with pytest.raises(Exception):
+            migrations.migrate(database, path)
+
+        assert '0003_broken' not in migrations.applied(database)
+        assert '0002_insert' in migrations.applied(database)
+
+    def test_failures_raise_their_own_error_and_release_the_lock(self, database, path, tmp_path, cleanup):
+        (tmp_path / '0003_broken.sql').write_text(
+            "CREATE TABLE MigrationsPartial (id INT); INSERT INTO Missing VALUES (1)"
+        )
+
+        with pytest.raises(psycopg2.errors.UndefinedTable):
+            migrations.migrate(database, path)
+
+        assert not database.execute_query(
+            "SELECT 1 FROM pg_locks WHERE locktype = 'advisory' AND objid = %s", (migrations.LOCK_ID,)
+        )
+        assert not database.execute_query("SELECT to_regclass('MigrationsPartial')")[0][0]
+
+    def test_misnamed_migrations_are_rejected(self, tmp_path):
+        (tmp_path / 'create.sql').write_text("SELECT 1")
+
+        with pytest.raises(migrations.InvalidMigration):
+            migrations.migrations(str(tmp_path))
@@ -1,7 +1,7 @@
 from datetime import date
 import pytest
 
-from geoapp import services
+from geoapp import db, services
 
 
 @pytest.fixture
@@ -38,6 +38,7 @@ class TestMapService:
                     10, "2/1/2015", "35-44", "F", 6061, 6383,
                 ),
             )
+            db.refresh_rollups(database)
 
             yield service
 
@@ -111,3 +112,63 @@ class TestMapService:
         assert int(results['2015-01']['F']) == 10
         assert int(results['2015-02']['F']) == 10
         assert int(results['2015-02']['M']) == 10
+
+    def test_rollups_return_the_same_results_as_payments(self, service, date_range):
+        raw = services.PostgresQueryService(service.db, use_rollups=False)
+
+        assert service.get_turnover(*date_range) == raw.get_turnover(*date_range)
+        assert service.get_turnover_by_age_and_gender(*date_range) == raw.get_turnover_by_age_and_gender(*date_range)
+        assert service.get_turnover_by_time_and_gender(*date_range) == raw.get_turnover_by_time_and_gender(*date_range)
+        assert service.get_map(*date_range) == raw.get_map(*date_range)
+
+    def test_get_turnover_by_postal_code_only_aggregates_given_ids(self, service, date_range):
+        results = service.get_turnover_by_postal_code(*date_range, postal_code_ids=[6061])['results']
+
+        assert list(results) == [6061]
+        assert int(results[6061]['35-44']['F']) == 10
+
+    def test_stream_map_yields_the_results_of_get_map(self, service, date_range):
+        streamed = list(service.stream_map(*date_range))
+
+        assert sorted(streamed, key=lambda x: x['geometry']) == \
+            sorted(service.get_map(*date_range)['results'], key=lambda x: x['geometry'])
+
+    def test_stream_query_fetches_every_row(self, service):
+        rows = service.db.stream_query("SELECT id FROM Payments ORDER BY id", itersize=2)
+
+        assert [id_ for id_, in rows] == [1117, 4627, 6383, 8095, 10616]
+
+    def test_get_dashboard_matches_every_widget(self, service, date_range):
+        dashboard = service.get_dashboard(*date_range)
+
+        assert dashboard['turnover'] == service.get_turnover(*date_range)
+        assert dashboard['turnover_by_age_and_gender'] == service.get_turnover_by_age_and_gender(*date_range)
+        assert dashboard['turnover_by_time_and_gender'] == service.get_turnover_by_time_and_gender(*date_range)
+        assert sorted(dashboard['map']['results'], key=lambda x: x['geometry']) == \
+            sorted(service.get_map(*date_range)['results'], key=lambda x: x['geometry'])
+
+    def test_get_dashboard_without_payments(self, service):
+        dashboard = service.get_dashboard(date(2020, 1, 1), date(2020, 1, 31))
+
+        assert dashboard['turnover'] == {"results": None}
+        assert dashboard['map'] == {"results": []}
+
+    @pytest.mark.parametrize('by, method', [
+        (['age', 'gender'], 'get_turnover_by_age_and_gender'),
+        (['month', 'gender'], 'get_turnover_by_time_and_gender'),
+        (['postal_code', 'age', 'gender'], 'get_turnover_by_postal_code'),
+    ])
+    def test_get_turnover_by_matches_the_dedicated_methods(self, service, date_range, by, method):
+        assert service.get_turnover(*date_range, by=by) == getattr(service, method)(*date_range)
+
+    def test_get_turnover_by_keys_every_postal_code_with_payments(self, service, date_range):
+        results = service.get_turnover(*date_range, by=['month', 'postal_code'])['results']
+
+        assert list(results) == ['2015-01', '2015-02']
+        assert results['2015-01'] == {6061: 10, 6179: 20}
+        assert results['2015-02'] == {6061: 10, 6179: 10}
+
+    @pytest.mark.parametrize('by', [['day'], ['age', 'age'], ['p_age; DROP TABLE Payments']])
+    def test_get_turnover_by_rejects_invalid_dimensions(self, service, date_range, by):
+        with pytest.raises(services.InvalidDimension):
+            service.get_turnover(*date_range, by=by)
@@ -0,0 +1,39 @@
+import random
+import pytest
+
+from geoapp import spatial
+
+
+@pytest.fixture
+def boxes():
+    generator = random.Random(42)
+
+    boxes = {}
+    for key in range(500):
+        x, y = generator.uniform(-10, 10), generator.uniform(-10, 10)
+        boxes[key] = (x, y, x + generator.uniform(0, 1), y + generator.uniform(0, 1))
+
+    return boxes
+
+
+class TestSTRTree:
+    def test_query_matches_brute_force(self, boxes):
+        tree = spatial.STRTree(boxes, node_capacity=8)
+
+        for bounds in [(-1, -1, 1, 1), (-10, -10, 10, 10), (5, -3, 5.5, 8), (20, 20, 30, 30)]:
+            expected = {key for key, box in boxes.items() if spatial.intersects(box, bounds)}
+            assert set(tree.query(bounds)) == expected
+
+    def test_tree_is_packed(self, boxes):
+        tree = spatial.STRTree(boxes, node_capacity=8)
+
+        assert len(tree) == 500
+        assert tree.height == 3
+
+    def test_touching_boxes_intersect(self):
+        tree = spatial.STRTree({'a': (0, 0, 1, 1)})
+
+        assert tree.query((1, 1, 2, 2)) == ['a']
+
+    def test_empty_tree(self):
+        assert spatial.STRTree({}).query((0, 0, 1, 1)) == []
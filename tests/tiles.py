@@ -0,0 +1,110 @@
+from datetime import date
+import mapbox_vector_tile
+import pytest
+
+from geoapp import cache, conditional, geometry, services, tiles
+from tests.geometry import polygon_wkb
+
+
+@pytest.fixture
+def geometries(tmp_path, version):
+    # A postal code around the centre of Madrid
+    ring = [[-3.71, 40.41], [-3.69, 40.41], [-3.69, 40.43], [-3.71, 40.43], [-3.71, 40.41]]
+    path = tmp_path / 'postal_codes.csv'
+    path.write_text(f"the_geom,code,id\n{polygon_wkb([ring], srid=4326)},28013,6179\n")
+
+    return geometry.GeometryStore(path=str(path), version=version)
+
+
+@pytest.fixture
+def service(geometries, version):
+    aggregate = services._get_aggregate_by_age_and_gender_dictionary()
+    aggregate['<=24']['M'] = 10
+
+    query_service = services.DummyQueryService({'turnover_by_postal_code': {'results': {6179: aggregate}}})
+    return tiles.TileService(query_service, geometries, cache.MemoryCache(), version=version)
+
+
+@pytest.fixture
+def date_range():
+    return date(2015, 1, 1), date(2015, 12, 31)
+
+
+class TestTileService:
+    def test_tile_over_postal_code_has_its_feature(self, service, date_range):
+        layers = mapbox_vector_tile.decode(service.get_tile(*date_range, 12, 2005, 1544))
+
+        assert list(layers) == [tiles.LAYER_NAME]
+        assert layers[tiles.LAYER_NAME]['extent'] == 4096
+
+        [feature] = layers[tiles.LAYER_NAME]['features']
+        assert feature['id'] == 6179
+        assert feature['geometry']['type'] == 'Polygon'
+        assert feature['properties']['code'] == '28013'
+        assert feature['properties']['total'] == 10
+        assert feature['properties']['<=24_M'] == 10
+        assert feature['properties']['<=24_F'] == 0
+
+    def test_features_are_clipped_to_the_tile_buffer(self, service, date_range):
+        layers = mapbox_vector_tile.decode(service.get_tile(*date_range, 12, 2005, 1544))
+
+        [ring] = layers[tiles.LAYER_NAME]['features'][0]['geometry']['coordinates']
+        xs, ys = {x for x, _ in ring}, {y for _, y in ring}
+
+        # The postal code reaches past the east edge of the tile, but not past any other
+        assert ring[0] == ring[-1]
+        assert max(xs) == service.extent + service.buffer
+        assert 0 < min(xs) and 0 < min(ys) and max(ys) < service.extent
+
+    def test_tile_elsewhere_is_empty(self, service, date_range):
+        layers = mapbox_vector_tile.decode(service.get_tile(*date_range, 12, 0, 0))
+
+        assert layers[tiles.LAYER_NAME]['features'] == []
+
+    def test_tiles_are_cached(self, service, date_range):
+        service.get_tile(*date_range, 12, 2005, 1544)
+        service.get_tile(*date_range, 12, 2005, 1544)
+
+        assert service.cache.stats()['hits'] == 1
+
+    def test_tiles_of_stale_turnover_are_not_cached(self, service, date_range, monkeypatch):
+        def stale(*args):
+            conditional.served_stale()
+            return {'results': {}}
+
+        monkeypatch.setattr(service.query_service, 'get_turnover_by_postal_code', stale)
+        with conditional.tracking_staleness() as served:
+            service.get_tile(*date_range, 12, 2005, 1544)
+
+        assert served.is_set()
+        assert service.cache.stats()['entries'] == 0
+
+    @pytest.mark.parametrize('z, x, y', [(-1, 0, 0), (2, 4, 0), (2, 0, 4), (25, 0, 0)])
+    def test_tiles_out_of_range_raise(self, service, date_range, z, x, y):
+        with pytest.raises(tiles.InvalidTile):
+            service.get_tile(*date_range, z, x, y)
+
+
+class TestClip:
+    def test_clip_keeps_inner_part_of_ring(self):
+        clipped = tiles._clip([(-10, -10), (10, -10), (10, 10), (-10, 10)], 0, 20)
+
+        assert sorted(clipped) == [(0, 0), (0, 10), (10, 0), (10, 10)]
+
+    def test_clip_drops_rings_outside(self):
+        assert tiles._clip([(30, 30), (40, 30), (40, 40)], 0, 20) == []
+
+
+class TestEncoding:
+    @pytest.mark.parametrize('value, encoded', [(0, 0), (-1, 1), (1, 2), (-2, 3), (2147483647, 4294967294)])
+    def test_zigzag(self, value, encoded):
+        assert tiles._zigzag(value) == encoded
+
+    def test_varint(self):
+        assert tiles._varint(1) == b'\x01'
+        assert tiles._varint(300) == b'\xac\x02'
+
+    def test_square_commands(self):
+        commands = list(tiles._polygon_commands([[(0, 0), (10, 0), (10, 10)]]))
+
+        assert commands == [9, 0, 0, 18, 20, 0, 0, 20, 15]
@@ -0,0 +1,88 @@
+import pytest
+
+from geoapp import topology
+
+
+def square(x: float, y: float, size: float = 1.0, step: float = 0.25) -> dict:
+    """Square ring with intermediate, slightly noisy points along each side"""
+    n = int(size / step)
+    bottom = [(x + i * step, y + (0.001 if i % 2 else 0)) for i in range(n)]
+    right = [(x + size, y + i * step) for i in range(n)]
+    top = [(x + size - i * step, y + size) for i in range(n)]
+    left = [(x, y + size - i * step) for i in range(n)]
+    ring = [list(point) for point in bottom + right + top + left]
+
+    return {"type": "Polygon", "coordinates": [ring + [ring[0]]]}
+
+
+class TestTopology:
+    def test_shared_borders_are_stored_once(self):
+        topo = topology.Topology.from_geometries({'a': square(0, 0), 'b': square(1, 0)})
+
+        shared = [arc for arc in topo.arcs if all(x == 1.0 for x, _ in arc)]
+        assert len(shared) == 1
+
+    def test_geometry_rebuilds_the_original_ring(self):
+        geometries = {'a': square(0, 0), 'b': square(1, 0)}
+        topo = topology.Topology.from_geometries(geometries)
+
+        for key, geometry in geometries.items():
+            ring = topo.geometry(key)["coordinates"][0]
+            original = geometry["coordinates"][0]
+            start = original.index(ring[0])
+
+            assert ring == original[start:-1] + original[:start + 1]
+
+    def test_simplified_neighbours_keep_sharing_their_border(self):
+        topo = topology.Topology.from_geometries({'a': square(0, 0), 'b': square(1, 0)}).simplify(0.01)
+
+        a = {tuple(point) for point in topo.geometry('a')["coordinates"][0]}
+        b = {tuple(point) for point in topo.geometry('b')["coordinates"][0]}
+
+        assert {point for point in a if point[0] == 1.0} == {point for point in b if point[0] == 1.0}
+        assert len(a) < 16
+
+    def test_rings_never_collapse_below_a_triangle(self):
+        topo = topology.Topology.from_geometries({'a': square(0, 0)}).simplify(10)
+
+        assert len(topo.geometry('a')["coordinates"][0]) >= 4
+
+
+def decode_arc(arc, transform):
+    x = y = 0
+    points = []
+    for dx, dy in arc:
+        x, y = x + dx, y + dy
+        points.append((x * transform["scale"][0] + transform["translate"][0],
+                       y * transform["scale"][1] + transform["translate"][1]))
+    return points
+
+
+class TestTopoJSON:
+    def test_arcs_are_quantized_and_delta_encoded(self):
+        topo = topology.Topology.from_geometries({'a': square(0, 0), 'b': square(1, 0)})
+        output = topo.to_topojson('squares', [('a', ['a'], {}), ('b', ['b'], {})], quantization=2001)
+
+        assert output["transform"] == {"scale": [0.001, 0.0005], "translate": [0.0, 0.0]}
+        assert len(output["arcs"]) == len(topo.arcs)
+
+        for arc, original in zip(output["arcs"], topo.arcs):
+            assert all(isinstance(value, int) for delta in arc for value in delta)
+            assert decode_arc(arc, output["transform"]) == pytest.approx(original)
+
+    def test_only_arcs_of_the_features_are_included(self):
+        topo = topology.Topology.from_geometries({'a': square(0, 0), 'b': square(1, 0), 'c': square(5, 5)})
+        output = topo.to_topojson('squares', [('c', ['c'], {"turnover": 10})])
+
+        geometry = output["objects"]["squares"]["geometries"][0]
+        assert geometry == {"type": "Polygon", "id": 'c', "properties": {"turnover": 10}, "arcs": [[0]]}
+        assert len(output["arcs"]) == 1
+
+    def test_several_objects_make_a_multipolygon(self):
+        topo = topology.Topology.from_geometries({'a': square(0, 0), 'c': square(5, 5)})
+        output = topo.to_topojson('squares', [('ac', ['a', 'c'], {}), ('missing', ['d'], {})])
+
+        merged, missing = output["objects"]["squares"]["geometries"]
+        assert merged["type"] == 'MultiPolygon'
+        assert merged["arcs"] == [[[0]], [[1]]]
+        assert missing["type"] is None
@@ -0,0 +1,135 @@
+from datetime import date
+import threading
+import pytest
+
+from config.config import WarmupConfig
+from geoapp import cache, services, warmup
+
+
+class MonthsDatabase:
+    def __init__(self, first: date = None, last: date = None):
+        self.bounds = (first, last)
+
+    def execute_query(self, query, params=None, name=None):
+        return [self.bounds]
+
+
+class VersionedQueryService(services.DummyQueryService):
+    """Answers with the number of times it was called"""
+
+    def __init__(self):
+        super().__init__({})
+        self.calls = 0
+
+    def get_turnover(self, start_date: date, end_date: date, by=()) -> dict:
+        self.calls += 1
+        return {"results": self.calls}
+
+
+@pytest.fixture
+def inner():
+    return VersionedQueryService()
+
+
+@pytest.fixture
+def service(inner, version):
+    return services.CachedQueryService(inner, cache.MemoryCache(), version)
+
+
+@pytest.fixture
+def config():
+    return WarmupConfig(
+        enabled=True, years=False, quarters=False, last_months=[], top_observed=0, methods=['get_turnover']
+    )
+
+
+class TestCacheWarmer:
+    def test_ranges_cover_the_months_with_data(self, service):
+        config = WarmupConfig(last_months=[1, 3])
+        warmer = warmup.CacheWarmer(service, config, MonthsDatabase(date(2015, 2, 1), date(2016, 2, 1)))
+
+        assert warmer.ranges() == [
+            (date(2015, 2, 1), date(2016, 2, 29)),
+            (date(2015, 1, 1), date(2015, 12, 31)),
+            (date(2016, 1, 1), date(2016, 12, 31)),
+            (date(2015, 1, 1), date(2015, 3, 31)),
+            (date(2015, 4, 1), date(2015, 6, 30)),
+            (date(2015, 7, 1), date(2015, 9, 30)),
+            (date(2015, 10, 1), date(2015, 12, 31)),
+            (date(2016, 1, 1), date(2016, 3, 31)),
+            (date(2016, 2, 1), date(2016, 2, 29)),
+            (date(2015, 12, 1), date(2016, 2, 29)),
+        ]
+
+    def test_no_ranges_without_data(self, service):
+        assert warmup.CacheWarmer(service, WarmupConfig(), MonthsDatabase()).ranges() == []
+
+    def test_warm_fills_the_cache(self, service, inner, config):
+        warmer = warmup.CacheWarmer(service, config, MonthsDatabase(date(2015, 1, 1), date(2015, 12, 1)))
+        warmer.warm()
+
+        assert service.get_turnover(date(2015, 1, 1), date(2015, 12, 31)) == {"results": 1}
+        assert inner.calls == 1
+
+    def test_popular_queries_are_warmed_up(self, service, config):
+        config.top_observed = 1
+        service.get_turnover(date(2015, 3, 1), date(2015, 3, 31), by=['age'])
+        warmer = warmup.CacheWarmer(service, config, MonthsDatabase())
+
+        assert warmer.queries() == [('get_turnover', (date(2015, 3, 1), date(2015, 3, 31), ('age',)))]
+
+    def test_outdated_warm_entries_are_served_until_refreshed(self, service, inner, version, config):
+        warmer = warmup.CacheWarmer(service, config, MonthsDatabase(date(2015, 1, 1), date(2015, 12, 1)))
+        warmer.warm()
+        date_range = date(2015, 1, 1), date(2015, 12, 31)
+
+        version.bump(months=[date(2015, 6, 1)])
+        assert service.get_turnover(*date_range) == {"results": 1}
+        assert service.stats()["stale_served"] == 1
+
+        warmer.warm()
+        assert service.get_turnover(*date_range) == {"results": 2}
+        assert inner.calls == 2
+
+    def test_entries_not_warmed_up_are_never_served_outdated(self, service, inner, version, config):
+        warmup.CacheWarmer(service, config, MonthsDatabase(date(2015, 1, 1), date(2015, 12, 1))).warm()
+        service.get_turnover(date(2015, 6, 1), date(2015, 6, 30))
+
+        version.bump()
+
+        assert service.get_turnover(date(2015, 6, 1), date(2015, 6, 30)) == {"results": 3}
+
+    def test_start_again_once_the_thread_is_gone(self, service, version, config):
+        warmer = warmup.CacheWarmer(service, config, MonthsDatabase())
+        warmer.start()
+        first = warmer._thread
+
+        warmer.start()
+        assert warmer._thread is first
+
+        # As in a forked process, where only the forking thread keeps running
+        warmer._thread = threading.Thread(target=lambda: None)
+        warmer._thread.start()
+        warmer._thread.join()
+        warmer.start()
+
+        assert warmer._thread.is_alive()
+        assert len(version.listeners) == 2
+
+    def test_start_warmer_without_background_only_warms_up(self, service, inner, config, monkeypatch):
+        monkeypatch.setattr(warmup.db, 'database', MonthsDatabase(date(2015, 1, 1), date(2015, 12, 1)))
+
+        warmer = warmup.start_warmer(service, config, background=False)
+
+        assert inner.calls == 1
+        assert warmer._thread is None
+
+    def test_start_warmer_warms_up_in_the_background(self, service, inner, config, monkeypatch):
+        config.refresh = False
+        monkeypatch.setattr(warmup.db, 'database', MonthsDatabase(date(2015, 1, 1), date(2015, 12, 1)))
+
+        warmer = warmup.start_warmer(service, config)
+        warmer._thread.join(timeout=5)
+
+        assert inner.calls == 1
+        assert not warmer._thread.is_alive()